@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+#
+# Benchmark lsst-build's prepare and build overhead on synthetic stacks.
+#
+#   benchmark.py run [--products=N] [--max-deps=K] [--output=results.jsonl] ...
+#   benchmark.py compare old.jsonl new.jsonl
+#
+# A synthetic stack of N products is generated, each product being a local
+# bare git repository with a ups/<product>.table file. pkgautoversion and
+# eupspkg are replaced by stub scripts with a configurable sleep or CPU
+# cost, and the EUPS stack is an empty temporary one (real EUPS must still
+# be importable, as lsst-build parses table files with it).
+#
+from __future__ import print_function
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import textwrap
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+import eups                                                     # noqa: E402
+
+from lsst.ci import tsort                                       # noqa: E402
+from lsst.ci.git import Git                                     # noqa: E402
+from lsst.ci.prepare import Product, Manifest, ProductFetcher   # noqa: E402
+from lsst.ci.prepare import VersionDbGit, ExclusionResolver     # noqa: E402
+from lsst.ci.prepare import BuildDirectoryConstructor           # noqa: E402
+from lsst.ci.build import Builder, ProgressReporter             # noqa: E402
+
+
+#############################################################################
+# Synthetic stack generation
+
+def generate_dag(nproducts, max_deps, seed):
+    """Generate a random product DAG with a realistic shape.
+
+        Products are created in topological order; each depends on up to
+        max_deps earlier products, chosen with probability proportional to
+        their current number of dependents (preferential attachment). This
+        yields a few low-level products with a very large fan-out (like
+        base or utils), and a long tail of leaf products.
+
+        Returns:
+            OrderedDict-like list of (productName, [dependencyNames]) tuples.
+    """
+    rng = random.Random(seed)
+    dag = []
+    weights = []
+    for i in range(nproducts):
+        name = "prod%05d" % i
+        deps = set()
+        if i:
+            ndeps = min(i, rng.randint(1, max_deps))
+            total = sum(weights)
+            while len(deps) < ndeps:
+                x = rng.uniform(0, total)
+                for j, w in enumerate(weights):
+                    x -= w
+                    if x <= 0:
+                        break
+                deps.add(j)
+            for j in deps:
+                weights[j] += 1
+        weights.append(1)
+        dag.append((name, sorted(dag[j][0] for j in deps)))
+    return dag
+
+
+def create_repos(dag, repodir):
+    """Create a bare git repository with a ups/<product>.table file for each product."""
+    srcdir = tempfile.mkdtemp(prefix='src-', dir=repodir)
+    ident = ['-c', 'user.name=lsst-build-bench', '-c', 'user.email=bench@localhost']
+    for name, deps in dag:
+        bare = os.path.join(repodir, name + '.git')
+        Git()('init', '-q', '--bare', bare)
+        git = Git(bare)
+        git('symbolic-ref', 'HEAD', 'refs/heads/master')
+
+        worktree = os.path.join(srcdir, name)
+        os.makedirs(os.path.join(worktree, 'ups'))
+        with open(os.path.join(worktree, 'ups', name + '.table'), 'w') as fp:
+            for dep in deps:
+                print('setupRequired(%s)' % dep, file=fp)
+        with open(os.path.join(worktree, 'README'), 'w') as fp:
+            print('Synthetic product %s' % name, file=fp)
+
+        git('--work-tree', worktree, 'add', '-A')
+        git(*(ident + ['--work-tree', worktree, 'commit', '-q', '-m', 'Initial commit']))
+        git(*(ident + ['tag', '-a', '-m', 'Version 1.0', '1.0']))
+    shutil.rmtree(srcdir)
+
+
+def create_versiondb(dbdir):
+    git = Git(dbdir)
+    os.makedirs(dbdir)
+    git('init', '-q')
+    git('config', 'user.name', 'lsst-build-bench')
+    git('config', 'user.email', 'bench@localhost')
+    for d in ('ver_db', 'dep_db', 'manifests'):
+        os.makedirs(os.path.join(dbdir, d))
+        open(os.path.join(dbdir, d, '.gitignore'), 'w').close()
+    git('add', '-A')
+    git('commit', '-q', '-m', 'Empty versiondb')
+
+
+def write_script(fn, text):
+    with open(fn, 'w') as fp:
+        fp.write(textwrap.dedent(text))
+    st = os.stat(fn)
+    os.chmod(fn, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def create_stubs(stubdir, stackdir):
+    """Create stub pkgautoversion, eupspkg and EUPS setups.sh
+
+        The cost of a stub invocation is controlled by the BENCH_COST_SLEEP
+        (seconds of sleep) and BENCH_COST_CPU (seconds of busy loop)
+        environment variables; eupspkg build additionally uses
+        BENCH_BUILD_SLEEP and BENCH_BUILD_CPU.
+    """
+    bindir = os.path.join(stubdir, 'bin')
+    os.makedirs(bindir)
+
+    cost = """\
+        cost() {
+            [ "${1:-0}" = 0 ] || sleep "$1"
+            [ "${2:-0}" = 0 ] || timeout "$2" sh -c 'while :; do :; done' || true
+        }
+        """
+
+    write_script(os.path.join(bindir, 'pkgautoversion'), """\
+        #!/bin/bash
+        %s
+        cost "$BENCH_COST_SLEEP" "$BENCH_COST_CPU"
+        echo "1.0"
+        """ % cost)
+
+    write_script(os.path.join(bindir, 'eupspkg'), """\
+        #!/bin/bash
+        %s
+        for arg; do
+            case "$arg" in
+                PRODUCT=*) PRODUCT="${arg#PRODUCT=}" ;;
+                VERSION=*) VERSION="${arg#VERSION=}" ;;
+            esac
+        done
+        verb="${!#}"
+        cost "$BENCH_COST_SLEEP" "$BENCH_COST_CPU"
+        case "$verb" in
+            build) cost "$BENCH_BUILD_SLEEP" "$BENCH_BUILD_CPU" ;;
+            install) mkdir -p "%s/$PRODUCT/$VERSION/ups" ;;
+            decl) touch "%s/$PRODUCT/$VERSION/ups/pkginfo" ;;
+        esac
+        """ % (cost, stackdir, stackdir))
+
+    # setup and eups are shell functions sourced from $EUPS_DIR/bin/setups.sh
+    write_script(os.path.join(bindir, 'setups.sh'), """\
+        setup() { :; }
+        eups() { echo "%s/$2/$3"; }
+        """ % stackdir)
+
+    return stubdir
+
+
+class StubEups(object):
+    """A stand-in for `eups.Eups` backed by the directories created by the stub eupspkg"""
+
+    class Tags(object):
+        def __init__(self):
+            self.tags = set()
+
+        def getTagNames(self):
+            return list(self.tags)
+
+        def registerTag(self, tag):
+            self.tags.add(tag)
+
+        def saveGlobalTags(self, path):
+            pass
+
+    class Product(object):
+        def __init__(self, dir):
+            self.dir = dir
+            self.tags = []
+
+    def __init__(self, stackdir):
+        self.stackdir = stackdir
+        self.path = [stackdir]
+        self.tags = StubEups.Tags()
+
+    def getProduct(self, name, version, noCache=False):
+        proddir = os.path.join(self.stackdir, name, version)
+        if not os.path.isdir(proddir):
+            raise eups.ProductNotFound(name, version)
+        return StubEups.Product(proddir)
+
+    def declare(self, name, version, tag=None):
+        pass
+
+
+class StubBuilder(Builder):
+    def __init__(self, stubdir, *args, **kwargs):
+        Builder.__init__(self, *args, **kwargs)
+        self.stubdir = stubdir
+
+    def _eups_dir(self):
+        return self.stubdir
+
+
+#############################################################################
+# Benchmarks
+
+class Timer(object):
+    def __init__(self):
+        self.results = dict()
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        t0 = time.time()
+        yield
+        self.results[name] = time.time() - t0
+        print("%-40s %10.3f sec" % (name, self.results[name]), file=sys.stderr)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Redirect lsst-build's progress output to /dev/null"""
+    saved = sys.stderr
+    with open(os.devnull, 'w') as devnull:
+        sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stderr = saved
+
+
+def run_benchmarks(args, workdir):
+    timer = Timer()
+    stderr = sys.stderr
+
+    repodir = os.path.join(workdir, 'repos')
+    stackdir = os.path.join(workdir, 'stack')
+    build_dir = os.path.join(workdir, 'build')
+    dbdir = os.path.join(workdir, 'versiondb')
+    for d in (repodir, build_dir, os.path.join(stackdir, 'ups_db')):
+        os.makedirs(d)
+
+    dag = generate_dag(args.products, args.max_deps, args.seed)
+    with timer('setup.create_repos'):
+        create_repos(dag, repodir)
+    create_versiondb(dbdir)
+    stubdir = create_stubs(os.path.join(workdir, 'stubs'), stackdir)
+
+    os.environ['PATH'] = os.path.join(stubdir, 'bin') + os.pathsep + os.environ['PATH']
+    os.environ['EUPS_PATH'] = stackdir
+    for var, value in (('BENCH_COST_SLEEP', args.stub_sleep), ('BENCH_COST_CPU', args.stub_cpu),
+                       ('BENCH_BUILD_SLEEP', args.build_sleep), ('BENCH_BUILD_CPU', args.build_cpu)):
+        os.environ[var] = str(value)
+
+    eupsObj = eups.Eups()
+    topLevel = [name for name, _ in dag[-args.top_level:]]
+
+    def constructor():
+        pattern = 'file://' + repodir + '/%(product)s.git'
+        fetcher = ProductFetcher(build_dir, None, pattern, [], False)
+        version_db = VersionDbGit(dbdir, eupsObj)
+        return BuildDirectoryConstructor(build_dir, eupsObj, fetcher, version_db, ExclusionResolver([])), \
+            version_db
+
+    # prepare: first (clone) and second (fetch) run
+    p, version_db = constructor()
+    with quiet(), timer('prepare.construct.clone'):
+        manifest = p.construct(topLevel)
+    with timer('versiondb.commit.initial'):
+        version_db.commit(manifest, None)
+
+    p, version_db = constructor()
+    with quiet(), timer('prepare.construct.fetch'):
+        manifest = p.construct(topLevel)
+    with timer('versiondb.commit.reuse'):
+        version_db.commit(manifest, None)
+
+    # versiondb: suffix lookups with a cold and a warm cache
+    products = list(manifest.products.values())
+    version_db = VersionDbGit(dbdir, eupsObj)
+    with timer('versiondb.getSuffix.cold'):
+        for prod in products:
+            version_db.getSuffix(prod.name, '1.0', prod.dependencies)
+    with timer('versiondb.getSuffix.warm'):
+        for prod in products:
+            version_db.getSuffix(prod.name, '1.0', prod.dependencies)
+    with timer('versiondb.getSuffix.new'):
+        for prod in products:
+            version_db.getSuffix(prod.name, '2.0', prod.dependencies)
+    with timer('versiondb.commit.new'):
+        version_db.commit(manifest, None)
+
+    # manifest: topological sort and (de)serialization
+    productDict = dict()
+    for name, deps in dag:
+        productDict[name] = Product(name, '0' * 40, '1.0', [productDict[dep] for dep in deps])
+    edges = [(dep.name, prod.name) for prod in productDict.values() for dep in prod.dependencies]
+    with timer('manifest.tsort'):
+        for _ in range(args.repeat):
+            tsort.tsort(edges)
+    with timer('manifest.fromProductDict'):
+        for _ in range(args.repeat):
+            m = Manifest.fromProductDict(productDict)
+    manifestFn = os.path.join(workdir, 'manifest.txt')
+    with timer('manifest.toFile'):
+        for _ in range(args.repeat):
+            with open(manifestFn, 'w') as fp:
+                m.toFile(fp)
+    with timer('manifest.fromFile'):
+        for _ in range(args.repeat):
+            with open(manifestFn) as fp:
+                Manifest.fromFile(fp)
+
+    # build: scheduling overhead with stub eupspkg
+    if not args.no_build:
+        with open(os.devnull, 'w') as devnull:
+            b = StubBuilder(stubdir, build_dir, manifest, ProgressReporter(devnull), StubEups(stackdir),
+                            prep_jobs=args.prep_jobs)
+            with quiet(), timer('build.build'):
+                b.build()
+            with quiet(), timer('build.build.installed'):
+                b.build()
+
+    sys.stderr = stderr
+    return timer.results
+
+
+def describe():
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    desc, retcode = Git(srcdir).describe('--always', '--dirty', return_status=True)
+    return desc if not retcode else None
+
+
+def cmd_run(args):
+    workdir = tempfile.mkdtemp(prefix='lsst-build-bench-', dir=args.work_dir)
+    try:
+        results = run_benchmarks(args, workdir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+        else:
+            print("work directory kept in %s" % workdir, file=sys.stderr)
+
+    params = dict((k, getattr(args, k)) for k in ('products', 'max_deps', 'top_level', 'seed', 'repeat',
+                                                  'stub_sleep', 'stub_cpu', 'build_sleep', 'build_cpu',
+                                                  'prep_jobs'))
+    record = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'lsst_build': describe(),
+        'params': params,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
+    else:
+        print(json.dumps(record, sort_keys=True, indent=2))
+
+
+def cmd_compare(args):
+    def last_record(fn):
+        with open(fn) as fp:
+            lines = [line for line in fp if line.strip()]
+        return json.loads(lines[-1])
+
+    old, new = last_record(args.old), last_record(args.new)
+    if old['params'] != new['params']:
+        print("warning: benchmark parameters differ", file=sys.stderr)
+
+    print("%-40s %10s %10s %8s" % ("benchmark", "old", "new", "ratio"))
+    for name in sorted(set(old['results']) | set(new['results'])):
+        t_old, t_new = old['results'].get(name), new['results'].get(name)
+        if t_old is None or t_new is None:
+            print("%-40s %10s %10s %8s" % (name, t_old, t_new, "-"))
+        else:
+            ratio = t_new / t_old if t_old else float('inf')
+            print("%-40s %10.3f %10.3f %8.2f" % (name, t_old, t_new, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lsst-build on synthetic product stacks')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('run', help='Run the benchmarks')
+    p.set_defaults(func=cmd_run)
+    p.add_argument('--products', default=200, type=int, help='Number of products in the stack')
+    p.add_argument('--max-deps', default=6, type=int, help='Maximum number of direct dependencies')
+    p.add_argument('--top-level', default=5, type=int, help='Number of top-level products to prepare')
+    p.add_argument('--seed', default=42, type=int, help='Random seed for the DAG generator')
+    p.add_argument('--repeat', default=10, type=int, help='Repetitions of the in-memory benchmarks')
+    p.add_argument('--stub-sleep', default=0, type=float,
+                   help='Seconds each stub pkgautoversion/eupspkg invocation sleeps')
+    p.add_argument('--stub-cpu', default=0, type=float,
+                   help='Seconds of CPU each stub pkgautoversion/eupspkg invocation burns')
+    p.add_argument('--build-sleep', default=0, type=float, help='Additional sleep of `eupspkg build`')
+    p.add_argument('--build-cpu', default=0, type=float, help='Additional CPU time of `eupspkg build`')
+    p.add_argument('--prep-jobs', default=0, type=int,
+                   help='Parallel `eupspkg prep` jobs of Builder.build (0: prep within each build)')
+    p.add_argument('--no-build', action='store_true', help='Skip the Builder.build benchmark')
+    p.add_argument('--work-dir', default=None, type=str, help='Directory for temporary files')
+    p.add_argument('--keep', action='store_true', help="Don't remove the work directory")
+    p.add_argument('--output', type=str, help='Append the results (as a JSON line) to this file')
+
+    p = subparsers.add_parser('compare', help='Compare the last results recorded in two files')
+    p.set_defaults(func=cmd_compare)
+    p.add_argument('old', type=str, help='Baseline results file')
+    p.add_argument('new', type=str, help='New results file')
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,10 @@ from __future__ import print_function
 import eups
 
 import subprocess
+import signal
+import fcntl
+import errno
+import socket
 import textwrap
 import os
 import stat
@@ -14,8 +18,23 @@ import time
 import eups.tags
 import contextlib
 import datetime
+import re
+import hashlib
+import tempfile
+import threading
+import traceback
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from .prepare import Manifest
+from .git import Git, LFS_SKIP_SMUDGE
+from .history import BuildHistory
+from .cache import NullCache, eupsDatabaseFiles
+from .logarchive import LogArchive, installLog
 
 
 def declareEupsTag(tag, eupsObj):
@@ -36,6 +55,11 @@ class ProgressReporter(object):
         def __init__(self, outFileObj, product):
             self.out = outFileObj
             self.product = product
+            self.notes = []
+
+        def addNote(self, note):
+            # additional information to report together with the result (e.g., cache statistics)
+            self.notes.append(note)
 
         def _buildStarted(self):
             self.out.write('%20s: ' % self.product.name)
@@ -65,13 +89,15 @@ class ProgressReporter(object):
             if self.progress_bar:
                 self.out.write(self.progress_bar)
 
+            notes = ''.join('; ' + note for note in self.notes)
+
             # If logfile is None, the product was already installed
             if logfile is None:
-                sys.stderr.write('(already installed).\n')
+                sys.stderr.write('(already installed%s).\n' % notes)
             else:
                 elapsedTime = time.time() - self.t0
                 if retcode:
-                    print("ERROR (%d sec)." % elapsedTime, file=self.out)
+                    print("ERROR (%d sec%s)." % (elapsedTime, notes), file=self.out)
                     print("*** error building product %s." % self.product.name, file=self.out)
                     print("*** exit code = %d" % retcode, file=self.out)
                     print("*** log is in %s" % logfile, file=self.out)
@@ -79,7 +105,7 @@ class ProgressReporter(object):
 
                     os.system("tail -n 10 %s | sed -e 's/^/:::::  /'" % pipes.quote(logfile))
                 else:
-                    print("ok (%.1f sec)." % elapsedTime, file=self.out)
+                    print("ok (%.1f sec%s)." % (elapsedTime, notes), file=self.out)
 
             self.product = None
 
@@ -99,36 +125,963 @@ class ProgressReporter(object):
         progress._finalize()
 
 
+def which(program):
+    """Return the full path to program if found on $PATH, None otherwise"""
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        fn = os.path.join(path, program)
+        if os.path.isfile(fn) and os.access(fn, os.X_OK):
+            return fn
+    return None
+
+
+class CompilerCache(object):
+    """A shared, size-limited ccache compiler cache used by all product builds.
+
+       Compilers are wrapped by putting a directory of symlinks to ccache,
+       named after the compilers, in front of $PATH in each product's build
+       environment (ccache's "masquerade" mode).
+
+       As the cache is shared with other builds running at the same time, each
+       build script has ccache (>= 4.0) log the result of each of its own
+       compilations to a statistics log in the product directory, from which
+       its hit rate is computed (see `logStats`).
+
+       :ivar cache_dir: the ccache directory (CCACHE_DIR)
+       :ivar max_size: maximum cache size (e.g., '20G'), or None to keep ccache's setting
+       :ivar has_statslog: True if ccache supports statistics logs (CCACHE_STATSLOG)
+    """
+    compilers = ('cc', 'c++', 'gcc', 'g++', 'clang', 'clang++', 'gfortran')
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.wrapper_dir = os.path.join(self.cache_dir, 'wrappers')
+
+        self.ccache = which('ccache')
+        if self.ccache is None:
+            raise Exception("ccache not found on $PATH; it is required by --ccache-dir")
+
+        m = re.search(r'version (\d+)', self._ccache('--version'))
+        self.has_statslog = m is not None and int(m.group(1)) >= 4
+
+    def _ccache(self, *args):
+        env = dict(os.environ, CCACHE_DIR=self.cache_dir)
+        return subprocess.check_output([self.ccache] + list(args), env=env)
+
+    def setup(self):
+        """Create the cache and compiler wrapper directories, and apply the size limit"""
+        if not os.path.isdir(self.wrapper_dir):
+            os.makedirs(self.wrapper_dir)
+        for compiler in self.compilers:
+            fn = os.path.join(self.wrapper_dir, compiler)
+            if not os.path.lexists(fn):
+                os.symlink(self.ccache, fn)
+
+        if self.max_size:
+            self._ccache('-M', self.max_size)
+
+    @staticmethod
+    def logStats(statslog):
+        """Return the (hits, misses) counts of the compilations logged in the
+           statistics log statslog (no compilations log nothing)
+        """
+        hits, misses = 0, 0
+        if os.path.exists(statslog):
+            with open(statslog) as fp:
+                for line in fp:
+                    # a '# <source file>' line, followed by its results
+                    result = line.strip()
+                    if result in ('direct_cache_hit', 'preprocessed_cache_hit'):
+                        hits += 1
+                    elif result == 'cache_miss':
+                        misses += 1
+        return hits, misses
+
+    def script(self, productdir, statslog):
+        """Return the shell commands enabling the cache in a product's build
+           script, logging the results of its compilations to statslog
+        """
+        return [
+            'export CCACHE_DIR=%s' % pipes.quote(self.cache_dir),
+            'export CCACHE_BASEDIR=%s' % pipes.quote(productdir),
+            'export CCACHE_STATSLOG=%s' % pipes.quote(statslog),
+            'export PATH=%s:"$PATH"' % pipes.quote(self.wrapper_dir),
+        ]
+
+
+def parseSize(size):
+    """Parse a size such as '500M' or '20G' (suffixes are powers of 1024), returning bytes"""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', size, re.IGNORECASE)
+    if not m:
+        raise Exception("invalid size '%s' (expected, e.g., 500M or 20G)" % size)
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2).upper() or ' '))
+
+
+def diskUsage(path, exclude=()):
+    """Return the total size (in bytes) of the files in the directory tree at path"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [dn for dn in dirnames if dn not in exclude]
+        for fn in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchArea(object):
+    """Local (e.g., tmpfs) scratch space that products are staged into and
+       built in, instead of in their clones in the build directory.
+
+       A product is staged as a git worktree of its clone, checked out at the
+       product's SHA1 (with its git-lfs files pulled), in
+       <scratch_dir>/lsst-build-<hash of build_dir>/<product>. A product that
+       has been prepped in its clone is staged with the prepped tree copied
+       over instead. It is staged only if the size of its checkout fits
+       within max_size (together with everything else staged at the time) and
+       the free space of the scratch filesystem.
+
+       Products may be staged and released from any thread.
+
+       :ivar root: the directory all products are staged in
+       :ivar max_size: the maximum size of root (in bytes), or None
+    """
+
+    # a failed build is assumed to have run out of scratch space if less than this is free
+    min_free = 16 * 1024 ** 2
+
+    def __init__(self, scratch_dir, build_dir, max_size=None):
+        buildDirHash = hashlib.sha1(os.path.abspath(build_dir).encode('utf-8')).hexdigest()[:10]
+        self.root = os.path.join(os.path.abspath(scratch_dir), 'lsst-build-%s' % buildDirHash)
+        self.max_size = max_size
+        self.lock = threading.Lock()    # held while checking for room and staging
+
+    def contains(self, path):
+        return os.path.abspath(path).startswith(self.root + os.sep)
+
+    def _free(self):
+        st = os.statvfs(self.root)
+        return st.f_bavail * st.f_frsize
+
+    def setup(self):
+        """Create the scratch area, removing anything left over by an earlier build"""
+        self.cleanup()
+        os.makedirs(self.root)
+
+    @staticmethod
+    def _copy_tree(src, dst):
+        # copy the working tree at src (but not its .git) into the existing directory dst
+        for fn in os.listdir(src):
+            if fn == '.git':
+                continue
+            srcfn, dstfn = os.path.join(src, fn), os.path.join(dst, fn)
+            if os.path.isdir(srcfn) and not os.path.islink(srcfn):
+                shutil.copytree(srcfn, dstfn, symlinks=True)
+            else:
+                shutil.copy2(srcfn, dstfn)
+
+    def stage(self, product, clonedir, prepped=False):
+        """Stage product from its clone, returning the staged directory, or
+           None if it doesn't fit. If prepped is True, the clone's (prepped)
+           working tree is staged, rather than a fresh checkout.
+        """
+        with self.lock:
+            need = diskUsage(clonedir, exclude=('.git',))
+            if self.max_size is not None and diskUsage(self.root) + need > self.max_size:
+                return None
+            if need + self.min_free > self._free():
+                return None
+
+            stagedir = os.path.join(self.root, product.name)
+            if os.path.exists(stagedir):
+                shutil.rmtree(stagedir)
+            git = Git(clonedir)
+            git.worktree('prune')
+            if prepped:
+                git.worktree('add', '--no-checkout', '--detach', stagedir, product.sha1)
+                self._copy_tree(clonedir, stagedir)
+                Git(stagedir).reset('-q')
+            else:
+                git.worktree('add', '--detach', stagedir, product.sha1, env=LFS_SKIP_SMUDGE)
+                Git(stagedir).lfs_pull_if_tracked()
+            return stagedir
+
+    def exhausted(self, logfile):
+        """Return True if the build that wrote logfile appears to have run out of scratch space"""
+        if self.max_size is not None and diskUsage(self.root) > self.max_size:
+            return True
+        if self._free() < self.min_free:
+            return True
+        with open(logfile) as fp:
+            return 'No space left on device' in fp.read()
+
+    def release(self, stagedir, clonedir):
+        """Remove a staged product"""
+        with self.lock:
+            shutil.rmtree(stagedir, ignore_errors=True)
+            Git(clonedir).worktree('prune', return_status=True)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class SetupCache(object):
+    """A cache of the environments set up by `setup --vro=_build.tags -r .'
+       in product build scripts.
+
+       The first time a product is built with a given set of dependencies,
+       the build script records the environment before and after running
+       setup, and how long setup took. The cache stores the difference
+       between the two (the variables setup set, changed or unset), keyed by
+       the product's name, directory and table file, EUPS_PATH and the exact
+       versions of all of its dependencies (`Product.flat_dependencies`).
+       Later builds with the same key apply the stored difference instead of
+       running setup, unless the variables it changes don't have the same
+       values they had when the entry was created.
+
+       :ivar cache_dir: the directory holding the cache entries
+       :ivar hits: the number of builds that used a cached environment
+       :ivar saved: the total setup time saved by the cache (in seconds)
+    """
+
+    # variables that differ between any two processes, and are not set by setup
+    ignored = frozenset(['_', 'SHLVL', 'PWD', 'OLDPWD'])
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.hits = 0
+        self.saved = 0.
+
+    def key(self, product, productdir):
+        """Return the cache key of product, to be built in productdir"""
+        h = hashlib.sha1()
+        for s in [product.name, productdir, os.environ["EUPS_PATH"]]:
+            h.update((s + '\n').encode('utf-8'))
+
+        try:
+            with open(os.path.join(productdir, 'ups', product.name + '.table'), 'rb') as fp:
+                h.update(fp.read())
+        except IOError:
+            pass
+
+        for dep in sorted(product.flat_dependencies(), key=lambda dep: dep.name):
+            h.update(("%s %s\n" % (dep.name, dep.version)).encode('utf-8'))
+
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key + '.sh')
+
+    def script(self, key):
+        """Return the shell commands setting up the environment in a product's build script"""
+        entry = pipes.quote(self._entry(key))
+        return [
+            'rm -f _build.env.*',
+            'if [ -f %s ] && . %s; then' % (entry, entry),
+            '    echo "Setting up environment from the cache (%s)"' % self._entry(key),
+            '    touch _build.env.hit',
+            'else',
+            '    echo "Setting up environment with EUPS"',
+            '    env -0 > _build.env.before',
+            '    TIMEFORMAT=%R',
+            '    { time setup --vro=_build.tags -r . 2>&1; } 2> _build.env.time',
+            '    env -0 > _build.env.after',
+            'fi',
+        ]
+
+    @staticmethod
+    def _read_env(fn):
+        with open(fn) as fp:
+            items = fp.read().split('\0')
+        return dict(item.split('=', 1) for item in items if '=' in item)
+
+    def _store(self, key, productdir):
+        # Create the cache entry from the environments recorded by the build
+        # script, returning the time setup took
+        before = self._read_env(os.path.join(productdir, '_build.env.before'))
+        after = self._read_env(os.path.join(productdir, '_build.env.after'))
+        with open(os.path.join(productdir, '_build.env.time')) as fp:
+            seconds = float(fp.read().split()[-1])
+
+        changed = sorted(name for name in set(before) | set(after)
+                         if name not in self.ignored and re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name) and
+                         before.get(name) != after.get(name))
+
+        lines = ["# lsst-build cached setup environment; setup took %.1f sec" % seconds,
+                 "# refuse to apply unless the variables have the values they had when recorded"]
+        for name in changed:
+            if name in before:
+                lines.append('[ "${%s+x}" = x ] && [ "$%s" = %s ] || return 1' % (
+                    name, name, pipes.quote(before[name])))
+            else:
+                lines.append('[ -z "${%s+x}" ] || return 1' % name)
+        for name in changed:
+            if name in after:
+                lines.append('export %s=%s' % (name, pipes.quote(after[name])))
+            else:
+                lines.append('unset %s' % name)
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, tmpfn = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.rename(tmpfn, self._entry(key))
+
+        return seconds
+
+    def collect(self, key, productdir):
+        """Update the cache after a product's build script ran, returning a note
+           for the progress report (or None if setup wasn't reached)
+        """
+        if os.path.exists(os.path.join(productdir, '_build.env.hit')):
+            with open(self._entry(key)) as fp:
+                seconds = float(fp.readline().split()[-2])
+            self.hits += 1
+            self.saved += seconds
+            return "setup cached (saved %.1f sec)" % seconds
+
+        if os.path.exists(os.path.join(productdir, '_build.env.after')):
+            self._store(key, productdir)
+            return "setup env recorded"
+
+        return None
+
+
+def processTreeSnapshot(pgid):
+    """Return a list of lines describing the processes in process group pgid, as a tree"""
+    try:
+        text = subprocess.check_output(['ps', '-e', '-o', 'pid=,ppid=,pgid=,etime=,time=,stat=,args='])
+    except (OSError, subprocess.CalledProcessError) as e:
+        return ["(failed to run ps: %s)" % e]
+    if not isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+
+    procs = dict()
+    for line in text.splitlines():
+        arr = line.split(None, 6)
+        if len(arr) >= 6 and int(arr[2]) == pgid:
+            procs[int(arr[0])] = (int(arr[1]), ' '.join(arr[3:]))
+
+    children = dict()
+    for pid, (ppid, _) in procs.items():
+        children.setdefault(ppid, []).append(pid)
+
+    lines = ["%8s %8s %12s %10s %5s %s" % ("PID", "PPID", "ELAPSED", "TIME", "STAT", "COMMAND")]
+
+    def walk(pid, depth):
+        ppid, desc = procs[pid]
+        etime, cputime, stat, args = (desc.split(None, 3) + ['', '', ''])[:4]
+        lines.append("%8d %8d %12s %10s %5s %s%s" % (pid, ppid, etime, cputime, stat, '  ' * depth, args))
+        for child in sorted(children.get(pid, [])):
+            walk(child, depth + 1)
+
+    for pid in sorted(procs):
+        if procs[pid][0] not in procs:
+            walk(pid, 0)
+    return lines
+
+
+class Watchdog(object):
+    """Kills a build script (and all processes it started) once it has run
+       for longer than timeout seconds, or has not written any output for
+       stall_timeout seconds.
+
+       The script must be run in its own process group. When the watchdog
+       fires, it records a snapshot of the process tree, sends SIGTERM to the
+       process group and, if the processes don't exit within grace seconds,
+       SIGKILL.
+
+       :ivar reason: why the watchdog killed the script, or None if it didn't
+       :ivar snapshot: the process tree snapshot (a list of lines), if it did
+    """
+
+    grace = 10
+
+    def __init__(self, timeout=None, stall_timeout=None):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.reason = None
+        self.snapshot = None
+        self.process = None
+        self._aborted = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, process):
+        with self._lock:
+            self.process = process
+            if self._aborted:
+                self.kill()
+        self.t0 = self.lastOutput = time.time()
+        if self.timeout or self.stall_timeout:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def output(self):
+        """Note that the script produced output"""
+        self.lastOutput = time.time()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(1):
+            now = time.time()
+            if self.timeout and now - self.t0 > self.timeout:
+                self.reason = "killed after exceeding the time limit of %d sec" % self.timeout
+            elif self.stall_timeout and now - self.lastOutput > self.stall_timeout:
+                self.reason = "killed after producing no output for %d sec" % self.stall_timeout
+            else:
+                continue
+
+            self.snapshot = processTreeSnapshot(self.process.pid)
+            self.kill(signal.SIGTERM)
+            deadline = time.time() + self.grace
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            self.kill(signal.SIGKILL)
+            return
+
+    def abort(self):
+        """Kill the script (and all processes it started) now, or as soon as
+           it's started; may be called from any thread.
+        """
+        with self._lock:
+            self._aborted = True
+            if self.process is not None:
+                self.kill()
+
+    def kill(self, sig=signal.SIGKILL):
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError:
+            pass
+
+
+class BuildLimits(object):
+    """Per-product limits on build time and time without output, for `Watchdog`.
+
+       A product's time limit is taken from overrides, if given there;
+       otherwise, if history and history_factor are given, it is
+       history_factor times the product's estimated build time (but at least
+       min_timeout); otherwise it is timeout. The limit on the time without
+       output is taken from overrides, or is stall_timeout. Limits of None
+       mean no limit.
+
+       :ivar overrides: dict of product name -> (timeout, stall_timeout)
+    """
+
+    min_timeout = 600
+
+    def __init__(self, timeout=None, stall_timeout=None, history=None, history_factor=None,
+                 overrides=None):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.history = history
+        self.history_factor = history_factor
+        self.overrides = overrides if overrides is not None else dict()
+
+    def get(self, name):
+        """Return the (timeout, stall_timeout) of product name"""
+        timeout, stall_timeout = self.overrides.get(name, (None, None))
+
+        if timeout is None and self.history is not None and self.history_factor:
+            estimate = self.history.estimate(name)
+            if estimate is not None:
+                timeout = max(self.history_factor * estimate, self.min_timeout)
+        if timeout is None:
+            timeout = self.timeout
+        if stall_timeout is None:
+            stall_timeout = self.stall_timeout
+
+        return (timeout, stall_timeout)
+
+    @staticmethod
+    def readOverrides(fn):
+        """Read per-product limits from a file with whitespace-separated
+           (product, timeout[, stall_timeout]) lines; '-' means the default.
+        """
+        overrides = dict()
+        with open(fn) as fp:
+            for line in fp:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                arr = line.split()
+                limits = [None if val == '-' else float(val) for val in arr[1:3]]
+                overrides[arr[0]] = tuple(limits + [None] * (2 - len(limits)))
+        return overrides
+
+
+class BuildRegistry(object):
+    """A registry of the products being built into a stack, shared by all
+       lsst-build processes on the host, ensuring that each product (name,
+       version and SHA1) is built by only one of them at a time.
+
+       A product is claimed by holding an exclusive lock on its file in
+       lock_dir; the file records who holds the claim.
+
+       :ivar lock_dir: the directory holding the lock files
+       :ivar holder: description of this process, recorded in the lock files
+    """
+
+    def __init__(self, lock_dir, build_dir):
+        self.lock_dir = lock_dir
+        self.holder = "pid %d on %s, building in %s" % (os.getpid(), socket.gethostname(),
+                                                        os.path.abspath(build_dir))
+
+    def _lockfile(self, product):
+        key = hashlib.sha1(("%s %s %s" % (product.name, product.version, product.sha1)).encode('utf-8'))
+        return os.path.join(self.lock_dir, "%s-%s.lock" % (product.name, key.hexdigest()[:16]))
+
+    @staticmethod
+    def _trylock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+    def acquire(self, product, progress):
+        """Claim product for building, waiting for whoever holds the claim to
+           release it first (if anyone).
+
+           Returns:
+               (claim, waited) tuple, where claim is to be passed to
+               `release`, and waited is True if it had to wait (and the
+               product may therefore have been built in the meantime).
+        """
+        if not os.path.isdir(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        fd = os.open(self._lockfile(product), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            waited = not self._trylock(fd)
+            if waited:
+                holder = os.read(fd, 1024).decode('utf-8', 'replace').strip()
+                progress.addNote("waited for %s" % (holder or "another lsst-build"))
+                while not self._trylock(fd):
+                    time.sleep(1)
+                    progress.reportProgress()
+
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, (self.holder + '\n').encode('utf-8'))
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd, waited
+
+    def release(self, claim):
+        """Release a claim returned by `acquire`"""
+        os.close(claim)
+
+    def busy(self, product):
+        """Return True if someone (including this process) holds the claim on product"""
+        try:
+            fd = os.open(self._lockfile(product), os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            return not self._trylock(fd)
+        finally:
+            os.close(fd)
+
+
+class PrepStage(object):
+    """Runs `eupspkg prep' for the products to be built ahead of time, in
+       parallel with each other and with the (serialized) product builds.
+
+       Products are prepped in the order given (i.e., the build order), each
+       under a `Watchdog` with the product's limits (see `Builder._watchdog`).
+       Stopping the stage kills the preps still running.
+
+       :ivar builder: the `Builder` the products are prepped for
+       :ivar jobs: the number of products prepped concurrently
+    """
+
+    def __init__(self, builder, products, jobs):
+        self.builder = builder
+        self.jobs = jobs
+
+        self.pending = collections.deque(products)
+        self.done = dict((product.name, threading.Event()) for product in products)
+        self.results = dict()   # product name -> (productdir, retcode, logfile)
+        self.watchdogs = dict()  # product name -> `Watchdog` of its running prep
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.threads = []
+
+    def _worker(self, eupsdir):
+        while True:
+            with self.lock:
+                if self.stopped or not self.pending:
+                    return
+                product = self.pending.popleft()
+                watchdog = self.watchdogs[product.name] = self.builder._watchdog(product)
+
+            try:
+                self.results[product.name] = self.builder._prep_product(product, eupsdir, watchdog)
+            except Exception:
+                self.results[product.name] = (None, 1, traceback.format_exc())
+            with self.lock:
+                del self.watchdogs[product.name]
+            self.done[product.name].set()
+
+    def start(self):
+        eupsdir = self.builder._eups_dir()
+        for _ in range(min(self.jobs, len(self.pending))):
+            thread = threading.Thread(target=self._worker, args=(eupsdir,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def wait(self, product, progress, timeout=None):
+        """Wait for product to be prepped, for at most timeout seconds (if
+           given); a prep that takes longer is killed (or, if it hasn't
+           started yet, cancelled).
+
+            Returns:
+                (productdir, retcode, logfile) tuple, or None if the product
+                isn't being prepped (or was killed). If prepping raised an
+                exception, productdir is None and logfile is the traceback.
+        """
+        event = self.done.get(product.name)
+        if event is None:
+            return None
+
+        deadline = time.time() + timeout if timeout else None
+        while not event.wait(1):
+            progress.reportProgress()
+            if deadline is not None and time.time() > deadline:
+                progress.addNote("prep killed after %d sec" % timeout)
+                with self.lock:
+                    if product in self.pending:
+                        self.pending.remove(product)
+                        return None
+                    if product.name in self.watchdogs:
+                        self.watchdogs[product.name].abort()
+                event.wait()
+                return None
+        return self.results[product.name]
+
+    def stop(self):
+        """Don't start prepping any more products, and kill the running ones"""
+        with self.lock:
+            self.stopped = True
+            for watchdog in self.watchdogs.values():
+                watchdog.abort()
+        for thread in self.threads:
+            thread.join()
+
+
+class DeferredTests(object):
+    """Runs the unit tests of installed products in the background, so that
+       their dependents don't have to wait for them.
+
+       :ivar builder: the `Builder` the products were built by
+       :ivar jobs: the number of test suites run concurrently
+       :ivar failed: list of (`Product`, logfile) tuples of the products whose
+                     unit tests failed
+    """
+
+    def __init__(self, builder, jobs):
+        self.builder = builder
+        self.jobs = jobs
+
+        self.queue = queue.Queue()
+        self.failed = []
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            product, productdir, installdir = item
+            try:
+                retcode, logfile = self.builder._test_product(product, productdir, installdir)
+            except Exception:
+                retcode, logfile = 1, os.path.join(productdir, '_build.tests.log')
+                with open(logfile, 'a') as fp:
+                    fp.write(traceback.format_exc())
+
+            if retcode:
+                with self.lock:
+                    self.failed.append((product, logfile))
+            else:
+                self.builder._release(product)
+
+    def start(self):
+        for _ in range(self.jobs):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, product, productdir, installdir):
+        """Queue the tests of product, built in productdir and installed into installdir"""
+        self.queue.put((product, productdir, installdir))
+
+    def wait(self):
+        """Wait for all queued tests to finish"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
 class Builder(object):
     """Class that builds and installs all products in a manifest.
 
        The result is tagged with the `Manifest`s build ID, if any.
+
+       If incremental is True, each product is built in a git worktree in
+       build_dir/_incremental/<product> rather than in its freshly cleaned
+       clone. The worktree (and the build products within it) is only cleaned
+       when the product's own SHA1 or the EUPS_PATH change, so a product
+       rebuilt only because its dependencies changed is not recompiled from
+       scratch.
+
+       If compiler_cache (a `CompilerCache`) is given, all compilations are
+       done through it, and its hit rate is reported for each product.
+
+       If history (a `BuildHistory`) is given, the duration of each build is
+       recorded in it.
+
+       If setup_cache (a `SetupCache`) is given, the EUPS environment of
+       each product is set up from it when possible, rather than by running
+       setup. The time this saved is reported at the end of the build.
+
+       If scratch (a `ScratchArea`) is given, each product is staged in it
+       when its build starts (after being prepped in its clone), and built
+       there, if there's room; only _build.log (and _build.tests.log) are
+       copied back to the product's clone. A staged build that fails
+       because the scratch area is full is retried in the clone. The scratch
+       area is removed when the build finishes, whether it succeeded or not.
+
+       If limits (a `BuildLimits`) is given, builds (and their prep stages
+       and deferred tests) running for longer than their product's limits are
+       killed by a `Watchdog`; with retry_stalled, killed builds are retried
+       once.
+
+       If registry (a `BuildRegistry`) is given, each product is claimed in
+       it before being built, so that other builders building the same
+       product into the same stack wait for this one (and vice versa), and
+       then just tag the installed product. Installed products that are
+       claimed (e.g., because their deferred tests are still running) are
+       waited for as well.
+
+       If log_archive (a `LogArchive`) is given, all build and test logs are
+       stored in it. Either way, the logs installed with the products are
+       gzip-compressed.
+
+       If prep_jobs is non-zero, `eupspkg prep' of all products that need to
+       be built is run ahead of time by a `PrepStage` with that many parallel
+       jobs, and each product build starts from the already prepped tree.
+
+       If deferred_tests is non-zero, (sconsUtils) products are installed,
+       declared and tagged as soon as they're compiled, and their unit tests
+       are run in the background by `DeferredTests` (that many at a time)
+       while the build continues; the tests of products without an SConstruct
+       file are run as part of their build, as usual. If any tests fail, no further products are built;
+       the product and all of its dependents are reported as failed and
+       untagged once the running tests finish, and the product itself is
+       undeclared and removed from the stack, so that the next build
+       rebuilds (and retests) it. Each product remains claimed in the
+       registry until its tests pass (or it's removed).
     """
-    def __init__(self, build_dir, manifest, progress, eups):
+    def __init__(self, build_dir, manifest, progress, eups, incremental=False, compiler_cache=None,
+                 history=None, prep_jobs=0, deferred_tests=0, setup_cache=None, scratch=None,
+                 limits=None, retry_stalled=False, registry=None, log_archive=None):
         self.build_dir = build_dir
         self.manifest = manifest
         self.progress = progress
         self.eups = eups
+        self.incremental = incremental
+        self.compiler_cache = compiler_cache
+        self.history = history
+        self.prep_jobs = prep_jobs
+        self.prep = None
+        self.deferred_tests = deferred_tests
+        self.tests = None
+        self.setup_cache = setup_cache
+        self.scratch = scratch
+        self.limits = limits
+        self.retry_stalled = retry_stalled
+        self.registry = registry
+        self.log_archive = log_archive
+        self.unstaged = set()   # names of products that mustn't be staged in scratch
+        self.claims = dict()    # product name -> `BuildRegistry` claim held
+        self.deferred = set()   # names of products whose tests were deferred
 
     def _tag_product(self, name, version, tag):
         if tag:
             self.eups.declare(name, version, tag=tag)
 
-    def _build_product(self, product, progress):
-        # run the eupspkg sequence for the product
-        #
-        productdir = os.path.abspath(os.path.join(self.build_dir, product.name))
-        buildscript = os.path.join(productdir, '_build.sh')
-        logfile = os.path.join(productdir, '_build.log')
-        eupsdir = eups.productDir("eups")
-        eupspath = os.environ["EUPS_PATH"]
+    def _untag_product(self, name, version, tag):
+        if tag:
+            self.eups.unassignTag(tag, name, version)
 
-        # construct the tags file with exact dependencies
-        setups = ["\t%-20s %s" % (dep.name, dep.version)
-                  for dep in product.flat_dependencies()]
+    def _remove_product(self, product):
+        # undeclare an installed product, and remove its installation
+        try:
+            eupsProd = self.eups.getProduct(product.name, product.version, noCache=True)
+        except eups.ProductNotFound:
+            return
+        self.eups.undeclare(product.name, product.version)
+        shutil.rmtree(eupsProd.dir, ignore_errors=True)
 
-        # create the buildscript
-        with open(buildscript, 'w') as fp:
+    def _archive_log(self, product, logfile):
+        # store a build log in the log archive (if any); may be called from any thread
+        if self.log_archive is None:
+            return
+        try:
+            self.log_archive.add(logfile, product.name, product.version)
+        except (IOError, OSError) as e:
+            print("warning: failed to archive %s: %s" % (logfile, e), file=sys.stderr)
+
+    def _eups_dir(self):
+        # the directory of the EUPS installation providing setups.sh
+        return eups.productDir("eups")
+
+    def _prepare_worktree(self, product):
+        # Return the incremental build worktree of the product, creating it if
+        # needed, and cleaning it if the product's SHA1 or the stack changed
+        clonedir = os.path.abspath(os.path.join(self.build_dir, product.name))
+        worktree = os.path.abspath(os.path.join(self.build_dir, '_incremental', product.name))
+        stampfn = os.path.join(worktree, '_build.stamp')
+        stamp = "%s %s\n" % (product.sha1, os.environ["EUPS_PATH"])
+
+        # the worktree is orphaned if the clone has been re-created by prepare
+        if os.path.isdir(worktree) and Git(worktree).rev_parse('--git-dir', return_status=True)[1]:
+            shutil.rmtree(worktree)
+
+        if not os.path.isdir(worktree):
+            git = Git(clonedir)
+            git.worktree('prune')
+            git.worktree('add', '--detach', worktree, product.sha1, env=LFS_SKIP_SMUDGE)
+            oldStamp = None
+        else:
+            try:
+                with open(stampfn) as fp:
+                    oldStamp = fp.read()
+            except IOError:
+                oldStamp = None
+
+        if oldStamp != stamp:
+            # check out with smudging skipped, and then all git-lfs objects at once
+            git = Git(worktree)
+            git.checkout('--force', '--detach', product.sha1, env=LFS_SKIP_SMUDGE)
+            git.clean('-d', '-f', '-q', '-x')
+            git.lfs_pull_if_tracked()
+            with open(stampfn, 'w') as fp:
+                fp.write(stamp)
+
+        return worktree
+
+    def _clone_dir(self, product):
+        return os.path.abspath(os.path.join(self.build_dir, product.name))
+
+    def _product_dir(self, product):
+        # the directory the product is prepped in
+        if self.incremental:
+            return self._prepare_worktree(product)
+        return self._clone_dir(product)
+
+    def _stage_product(self, product, productdir, prepped):
+        # the directory the product is built in: productdir staged in scratch
+        # space, if possible. Products are only staged when their build starts,
+        # so that the scratch space holds no more than is being built (and tested).
+        if self.scratch is None or product.name in self.unstaged:
+            return productdir
+        stagedir = self.scratch.stage(product, productdir, prepped)
+        return stagedir if stagedir is not None else productdir
+
+    def _install_dir(self, product):
+        # the directory `eupspkg install' installs the product into
+        return os.path.join(self.eups.path[0], self.eups.flavor, product.name, product.version)
+
+    def _prep_commands(self, product):
+        # commands cleaning up the product directory and running `eupspkg prep'
+        if self.incremental:
+            cleanup = ["# incremental build: the worktree has been cleaned by lsst-build if needed"]
+        else:
+            cleanup = ["git reset --hard",
+                       "git clean -d -f -q -x -e '_build.*'"]
+
+        return ["# clean up the working directory"] + cleanup + [
+            "",
+            "# prepare",
+            "eupspkg PRODUCT=%s VERSION=%s FLAVOR=generic prep" % (product.name, product.version),
+        ]
+
+    # sconsUtils targets built before installing, when the unit tests are deferred
+    untested_targets = ('lib', 'python', 'shebang', 'include', 'version')
+
+    # file created by the build script of a product whose unit tests it deferred
+    deferred_marker = '_build.tests.deferred'
+
+    def _test_commands(self, product):
+        # commands running `eupspkg build', and failing if any unit tests failed
+        return [
+            "eupspkg PRODUCT=%s VERSION=%s FLAVOR=generic build" % (product.name, product.version),
+            "if [ -d  tests/.tests ] && \\",
+            "    [ \"`ls tests/.tests/*\\.failed 2> /dev/null | wc -l`\" -ne 0 ]; then",
+            "    echo \"*** Failed unit tests.\";",
+            "    exit 1",
+            "fi",
+        ]
+
+    def _build_commands(self, product):
+        # commands running `eupspkg build' in the build script
+        if self.tests is None:
+            return self._test_commands(product)
+
+        # build all targets except the tests, which are run by _build.tests.sh; only
+        # sconsUtils products build just the targets in $SCONSFLAGS, so the tests of
+        # any others are run right away
+        return [
+            'rm -f %s' % self.deferred_marker,
+            'if [ -f SConstruct ]; then',
+            '    SCONSFLAGS="$SCONSFLAGS %s" \\' % ' '.join(self.untested_targets),
+            '        eupspkg PRODUCT=%s VERSION=%s FLAVOR=generic build' % (product.name, product.version),
+            '    # unit tests are deferred to _build.tests.sh',
+            '    touch %s' % self.deferred_marker,
+            'else',
+        ] + ['    ' + line for line in self._test_commands(product)] + [
+            'fi',
+        ]
+
+    def _setup_commands(self, setupKey):
+        # commands setting up the product (with _build.tags) in its build script;
+        # setupKey is the product's `SetupCache` key, if the cache is in use
+        if setupKey is not None:
+            return self.setup_cache.script(setupKey)
+        else:
+            return ['echo "Setting up environment with EUPS"',
+                    'setup --vro=_build.tags -r .']
+
+    def _write_script(self, fn, productdir, eupsdir, body):
+        # write out an executable bash script running body in productdir, with EUPS set up
+        with open(fn, 'w') as fp:
             text = textwrap.dedent(
             """\
             #!/bin/bash
@@ -145,83 +1098,333 @@ class Builder(object):
 
             cd "%(productdir)s"
 
-            # clean up the working directory
-            git reset --hard
-            git clean -d -f -q -x -e '_build.*'
-
-            # prepare
-            eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic prep
-
-            # setup the package with its exact dependencies
-            cat > _build.tags <<-EOF
-            %(setups)s
-            EOF
-            set +x
-            echo "Setting up environment with EUPS"
-            setup --vro=_build.tags -r .
-            set -x
-
-            # build
-            eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic config
-            eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic build
-            if [ -d  tests/.tests ] && \
-                [ "`ls tests/.tests/*\.failed 2> /dev/null | wc -l`" -ne 0 ]; then
-                echo "*** Failed unit tests.";
-                exit 1
-            fi
-            eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic install
-
-            # declare to EUPS
-            eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic decl
-
-            # explicitly append SHA1 to pkginfo
-            echo SHA1=%(sha1)s >> $(eups list %(product)s %(version)s -d)/ups/pkginfo
             """ % {
-                    'product': product.name,
-                    'version': product.version,
-                    'sha1': product.sha1,
                     'productdir': productdir,
-                    'setups': '\n            '.join(setups),
                     'eupsdir': eupsdir,
-                    'eupspath': eupspath,
+                    'eupspath': os.environ["EUPS_PATH"],
                 }
             )
 
-            fp.write(text)
+            fp.write(text + body)
 
         # Make executable (equivalent of 'chmod +x $buildscript')
-        st = os.stat(buildscript)
-        os.chmod(buildscript, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        st = os.stat(fn)
+        os.chmod(fn, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
-        # Run the build script
-        with open(logfile, 'w') as logfp:
-            # execute the build file from the product directory, capturing the output and return code
-            process = subprocess.Popen(buildscript, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                       cwd=productdir)
+    def _watchdog(self, product):
+        # a `Watchdog` with the product's limits
+        return Watchdog(*self.limits.get(product.name)) if self.limits is not None else Watchdog()
+
+    def _run_script(self, script, productdir, logfp, progress=None, watchdog=None):
+        # execute the script from the product directory, writing timestamped output to logfp
+        #
+        # The script runs in its own process group, so that the watchdog can kill
+        # everything it started.
+        if watchdog is None:
+            watchdog = Watchdog()
+
+        # A child forked by another thread (e.g., of the `PrepStage`) while the
+        # script was being written holds it open until it execs, which makes
+        # executing the script fail with ETXTBSY for a moment.
+        for attempt in range(10):
+            try:
+                process = subprocess.Popen(script, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           cwd=productdir, preexec_fn=os.setpgrp)
+                break
+            except OSError as e:
+                if e.errno != errno.ETXTBSY or attempt == 9:
+                    raise
+                time.sleep(0.1)
+        watchdog.start(process)
+        try:
             for line in iter(process.stdout.readline, ''):
+                watchdog.output()
                 line = "[%sZ] %s" % (datetime.datetime.utcnow().isoformat(), line)
                 logfp.write(line)
-                progress.reportProgress()
+                if progress is not None:
+                    progress.reportProgress()
+        except BaseException:
+            # e.g., KeyboardInterrupt: the script doesn't get the signal itself
+            watchdog.kill()
+            raise
+        finally:
+            watchdog.stop()
+
+        retcode = process.wait()
+        if watchdog.reason is not None:
+            now = datetime.datetime.utcnow().isoformat()
+            logfp.write("[%sZ] *** lsst-build watchdog: %s; the process tree was:\n" % (now, watchdog.reason))
+            for line in watchdog.snapshot:
+                logfp.write("[%sZ] %s\n" % (now, line))
+            if not retcode:
+                retcode = -signal.SIGKILL
+        return retcode
+
+    def _prep_product(self, product, eupsdir, watchdog=None):
+        # run `eupspkg prep' for the product ahead of its build (see `PrepStage`),
+        # under the given `Watchdog`; may be called from any thread.
+        productdir = self._product_dir(product)
+        prepscript = os.path.join(productdir, '_build.prep.sh')
+        logfile = os.path.join(productdir, '_build.prep.log')
+
+        self._write_script(prepscript, productdir, eupsdir, '\n'.join(self._prep_commands(product)) + '\n')
+        with open(logfile, 'w') as logfp:
+            retcode = self._run_script(prepscript, productdir, logfp, watchdog=watchdog)
+
+        return (productdir, retcode, logfile)
+
+    def _build_product(self, product, progress):
+        # build the product, in scratch space if possible
+        #
+        if self.prep is not None:
+            timeout = self.limits.get(product.name)[0] if self.limits is not None else None
+            prepped = self.prep.wait(product, progress, timeout)
+        else:
+            prepped = None
+        watchdog = self._watchdog(product)
+        eupsProd, retcode, logfile = self._run_build(product, progress, prepped, watchdog)
+        if watchdog.reason is not None:
+            progress.addNote(watchdog.reason)
+            if self.retry_stalled:
+                progress.addNote("retried")
+                watchdog = self._watchdog(product)
+                eupsProd, retcode, logfile = self._run_build(product, progress, None, watchdog)
+                if watchdog.reason is not None:
+                    progress.addNote(watchdog.reason)
+
+        productdir = os.path.dirname(logfile)
+        if self.scratch is None or not self.scratch.contains(productdir):
+            return (eupsProd, retcode, logfile)
+
+        # copy the log back to the clone, and free the scratch space (unless
+        # the deferred tests still need it)
+        clonedir = self._clone_dir(product)
+        shutil.copy2(logfile, clonedir)
+        exhausted = retcode and self.scratch.exhausted(logfile)
+        if eupsProd is None or product.name not in self.deferred:
+            self.scratch.release(productdir, clonedir)
+
+        if exhausted:
+            # remove anything partially installed, and retry in the clone
+            if os.path.isdir(self._install_dir(product)):
+                shutil.rmtree(self._install_dir(product))
+            self.unstaged.add(product.name)
+            progress.addNote("out of scratch space; rebuilt in %s" % clonedir)
+            return self._run_build(product, progress, None, self._watchdog(product))
+
+        return (eupsProd, retcode, os.path.join(clonedir, '_build.log'))
+
+    def _run_build(self, product, progress, prepped, watchdog):
+        # run the eupspkg sequence for the product, under the given `Watchdog`;
+        # prepped is the result of its `PrepStage` (or None if it wasn't prepped
+        # ahead of time)
+        #
+        if prepped is None:
+            productdir = self._stage_product(product, self._product_dir(product), False)
+            prep = self._prep_commands(product)
+        else:
+            productdir, retcode, preplog = prepped
+            if retcode:
+                # the prep stage failed; report its log (or the exception it raised)
+                if productdir is None:
+                    logfile = os.path.abspath(os.path.join(self.build_dir, product.name, '_build.log'))
+                    with open(logfile, 'w') as fp:
+                        fp.write(preplog)
+                else:
+                    logfile = os.path.join(productdir, '_build.log')
+                    shutil.copyfile(preplog, logfile)
+                return (None, retcode, logfile)
+
+            productdir = self._stage_product(product, productdir, True)
+            prep = ["# cleaned up and prepared ahead of time by lsst-build (see _build.prep.log)"]
+
+        buildscript = os.path.join(productdir, '_build.sh')
+        logfile = os.path.join(productdir, '_build.log')
+        eupsdir = self._eups_dir()
+
+        if self.compiler_cache is not None:
+            statslog = os.path.join(productdir, '_build.ccache.log')
+            if os.path.exists(statslog):
+                os.unlink(statslog)
+            ccache = self.compiler_cache.script(productdir, statslog)
+        else:
+            ccache = ["# compiler cache is not in use"]
+
+        # construct the tags file with exact dependencies
+        setups = ["\t%-20s %s" % (dep.name, dep.version)
+                  for dep in product.flat_dependencies()]
+
+        setupKey = self.setup_cache.key(product, productdir) if self.setup_cache is not None else None
+
+        build = self._build_commands(product)
+
+        # create the buildscript
+        text = textwrap.dedent(
+            """\
+        %(prep)s
+
+        # setup the package with its exact dependencies
+        cat > _build.tags <<-EOF
+        %(setups)s
+        EOF
+        set +x
+        %(setup)s
+        set -x
+
+        # wire up the compiler cache
+        %(ccache)s
+
+        # build
+        eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic config
+        %(build)s
+        eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic install
+
+        # declare to EUPS
+        eupspkg PRODUCT=%(product)s VERSION=%(version)s FLAVOR=generic decl
+
+        # explicitly append SHA1 to pkginfo
+        echo SHA1=%(sha1)s >> $(eups list %(product)s %(version)s -d)/ups/pkginfo
+        """ % {
+                'product': product.name,
+                'version': product.version,
+                'sha1': product.sha1,
+                'prep': '\n        '.join(prep),
+                'build': '\n        '.join(build),
+                'setup': '\n        '.join(self._setup_commands(setupKey)),
+                'ccache': '\n        '.join(ccache),
+                'setups': '\n        '.join(setups),
+            }
+        )
+        self._write_script(buildscript, productdir, eupsdir, text)
+
+        # Run the build script; if the product was prepped ahead of time, the
+        # log starts with the output of the prep stage
+        if prepped is not None:
+            shutil.copyfile(prepped[2], logfile)
+        with open(logfile, 'a' if prepped is not None else 'w') as logfp:
+            retcode = self._run_script(buildscript, productdir, logfp, progress, watchdog)
+
+            if self.setup_cache is not None:
+                note = self.setup_cache.collect(setupKey, productdir)
+                if note is not None:
+                    logfp.write("[%sZ] %s\n" % (datetime.datetime.utcnow().isoformat(), note))
+                    progress.addNote(note)
+
+            if self.compiler_cache is not None and self.compiler_cache.has_statslog:
+                hits, misses = self.compiler_cache.logStats(statslog)
+                total = hits + misses
+                if total:
+                    note = "ccache: %d/%d hits (%.0f%%)" % (hits, total, 100. * hits / total)
+                else:
+                    note = "ccache: no compilations"
+                logfp.write("[%sZ] %s\n" % (datetime.datetime.utcnow().isoformat(), note))
+                progress.addNote(note)
+
+        self._archive_log(product, logfile)
 
-        retcode = process.poll()
         if not retcode:
-            # copy the log file to product directory
+            # install a compressed copy of the log file into the product directory
             eupsProd = self.eups.getProduct(product.name, product.version)
-            shutil.copy2(logfile, eupsProd.dir)
+            installLog(logfile, eupsProd.dir)
+
+            if self.tests is not None and os.path.exists(os.path.join(productdir, self.deferred_marker)):
+                self.deferred.add(product.name)
+                self.tests.submit(product, productdir, eupsProd.dir)
+                progress.addNote("tests deferred")
         else:
             eupsProd = None
 
         return (eupsProd, retcode, logfile)
 
+    def _test_product(self, product, productdir, installdir):
+        # run the unit tests of an installed product (see `DeferredTests`); may be
+        # called from any thread.
+        testscript = os.path.join(productdir, '_build.tests.sh')
+        logfile = os.path.join(productdir, '_build.tests.log')
+
+        if self.compiler_cache is not None:
+            statslog = os.path.join(productdir, '_build.tests.ccache.log')
+            ccache = self.compiler_cache.script(productdir, statslog)
+        else:
+            ccache = ["# compiler cache is not in use"]
+
+        setupKey = self.setup_cache.key(product, productdir) if self.setup_cache is not None else None
+
+        body = [
+            "# setup the package with its exact dependencies (see _build.sh)",
+            "set +x",
+        ] + self._setup_commands(setupKey) + [
+            "set -x",
+            "",
+        ] + ccache + [
+            "",
+            "# build again, running the unit tests this time",
+        ] + self._test_commands(product)
+        self._write_script(testscript, productdir, self.eupsdir, '\n'.join(body) + '\n')
+
+        with open(logfile, 'w') as logfp:
+            retcode = self._run_script(testscript, productdir, logfp, watchdog=self._watchdog(product))
+        self._archive_log(product, logfile)
+        installLog(logfile, installdir)
+
+        if self.scratch is not None and self.scratch.contains(productdir):
+            clonedir = self._clone_dir(product)
+            shutil.copy2(logfile, clonedir)
+            self.scratch.release(productdir, clonedir)
+            logfile = os.path.join(clonedir, '_build.tests.log')
+
+        return (retcode, logfile)
+
+    def _claim(self, product, progress):
+        # claim the product in the registry (if any) while it's being built (and
+        # tested), waiting for anyone else's claim
+        if self.registry is None:
+            return
+        claim, waited = self.registry.acquire(product, progress)
+        self.claims[product.name] = claim
+
+    def _release(self, product):
+        # release the claim on the product (if held); may be called from any thread
+        claim = self.claims.pop(product.name, None)
+        if claim is not None:
+            self.registry.release(claim)
+
+    def _built_meanwhile(self, product):
+        # Return the EUPS product if another builder has installed it, None otherwise
+        try:
+            return self.eups.getProduct(product.name, product.version, noCache=True)
+        except eups.ProductNotFound:
+            return None
+
     def _build_product_if_needed(self, product):
         # Build a product if it hasn't been installed already
         #
         with self.progress.newBuild(product) as progress:
             try:
                 # skip the build if the product has been installed
-                eupsProd, retcode, logfile = self.eups.getProduct(product.name, product.version), 0, None
+                eupsProd = self.eups.getProduct(product.name, product.version)
             except eups.ProductNotFound:
-                eupsProd, retcode, logfile = self._build_product(product, progress)
+                eupsProd = None
+            retcode, logfile = 0, None
+
+            # an installed product that is claimed may still fail its (deferred) tests
+            if eupsProd is None or (self.registry is not None and self.registry.busy(product)):
+                tested = False
+                try:
+                    # another builder may have installed it before we got the claim,
+                    # even if we didn't have to wait for it
+                    self._claim(product, progress)
+                    eupsProd = self._built_meanwhile(product)
+                    if eupsProd is None:
+                        t0 = time.time()
+                        eupsProd, retcode, logfile = self._build_product(product, progress)
+                        if self.history is not None:
+                            self.history.record(product.name, product.version, time.time() - t0, retcode)
+                        tested = not retcode and product.name in self.deferred
+                finally:
+                    # the claim is released by `DeferredTests` once the tests pass
+                    if not tested:
+                        self._release(product)
 
             if eupsProd is not None and self.manifest.buildID not in eupsProd.tags:
                 self._tag_product(product.name, product.version, self.manifest.buildID)
@@ -231,24 +1434,115 @@ class Builder(object):
         return retcode == 0
 
     def build(self):
+        if self.scratch is not None:
+            self.scratch.setup()
+        try:
+            return self._build()
+        finally:
+            for name in list(self.claims):
+                self._release(self.manifest.products[name])
+            if self.scratch is not None:
+                self.scratch.cleanup()
+
+    def _build(self):
         # Make sure EUPS knows about the buildID tag
         if self.manifest.buildID:
             declareEupsTag(self.manifest.buildID, self.eups)
 
+        if self.compiler_cache is not None:
+            self.compiler_cache.setup()
+
+        # Start prepping all products that need to be built
+        if self.prep_jobs:
+            toBuild = []
+            for product in self.manifest.products.itervalues():
+                try:
+                    self.eups.getProduct(product.name, product.version)
+                except eups.ProductNotFound:
+                    toBuild.append(product)
+
+            self.prep = PrepStage(self, toBuild, self.prep_jobs)
+            self.prep.start()
+
+        if self.deferred_tests:
+            self.eupsdir = self._eups_dir()
+            self.tests = DeferredTests(self, self.deferred_tests)
+            self.tests.start()
+
         # Build all products
-        for product in self.manifest.products.itervalues():
-            if not self._build_product_if_needed(product):
-                return False
+        ok = True
+        try:
+            for product in self.manifest.products.itervalues():
+                if self.tests is not None and self.tests.failed:
+                    # stop on failed (deferred) tests, as on any other build failure
+                    ok = False
+                    break
+                if not self._build_product_if_needed(product):
+                    ok = False
+                    break
+        finally:
+            if self.prep is not None:
+                self.prep.stop()
+                self.prep = None
+
+        if self.tests is not None:
+            self.tests.wait()
+            if self.tests.failed:
+                self._fail_tested_products(self.tests.failed)
+                ok = False
+            self.tests = None
+
+        if self.setup_cache is not None and self.setup_cache.hits:
+            print("setup environment cache: used for %d products, saving %.1f sec." % (
+                  self.setup_cache.hits, self.setup_cache.saved), file=self.progress.out)
+
+        if not ok:
+            return False
+
+    def _fail_tested_products(self, failed):
+        # Retroactively mark the products whose deferred tests failed, and all
+        # of their dependents, as failed: report them, and remove the build tag.
+        # The failed products are removed from the stack, and their claims released.
+        out = self.progress.out
+        for product, logfile in failed:
+            print("*** unit tests of product %s failed." % product.name, file=out)
+            print("*** log is in %s" % logfile, file=out)
+
+        failedNames = set(product.name for product, _ in failed)
+        affected = [product for product in self.manifest.products.itervalues()
+                    if product.name in failedNames or
+                    any(dep.name in failedNames for dep in product.flat_dependencies())]
+
+        print("*** marking as failed (and removing tag %s from): %s" % (
+              self.manifest.buildID, ', '.join(product.name for product in affected)), file=out)
+        for product in affected:
+            try:
+                eupsProd = self.eups.getProduct(product.name, product.version)
+            except eups.ProductNotFound:
+                continue
+            if self.manifest.buildID in eupsProd.tags:
+                self._untag_product(product.name, product.version, self.manifest.buildID)
+
+        for product, _ in failed:
+            print("*** removing %s %s from the stack." % (product.name, product.version), file=out)
+            try:
+                self._remove_product(product)
+            finally:
+                self._release(product)
 
     @staticmethod
-    def run(args):
+    def run(args, cache=None):
         # Ensure build directory exists and is writable
         build_dir = args.build_dir
         if not os.access(build_dir, os.W_OK):
             raise Exception("Directory '%s' does not exist or isn't writable." % build_dir)
 
+        if cache is None:
+            cache = NullCache()
+
         # Build products
-        eupsObj = eups.Eups()
+        eupsPath = os.environ.get("EUPS_PATH", "")
+        eupsObj = cache.get(('eups', eupsPath), eupsDatabaseFiles(eupsPath), eups.Eups)
 
         progress = ProgressReporter(sys.stderr)
 
@@ -256,6 +1550,38 @@ class Builder(object):
         with open(manifestFn) as fp:
             manifest = Manifest.fromFile(fp)
 
-        b = Builder(build_dir, manifest, progress, eupsObj)
+        if args.ccache_dir:
+            compiler_cache = CompilerCache(args.ccache_dir, args.ccache_size)
+        else:
+            compiler_cache = None
+
+        history = BuildHistory(args.history or os.path.join(build_dir, 'build_history.txt'))
+
+        setup_cache = SetupCache(args.setup_cache_dir) if args.setup_cache_dir else None
+
+        if args.scratch_dir:
+            if args.incremental:
+                raise Exception("--scratch-dir cannot be used together with --incremental")
+            scratch_size = parseSize(args.scratch_size) if args.scratch_size else None
+            scratch = ScratchArea(args.scratch_dir, build_dir, scratch_size)
+        else:
+            scratch = None
+
+        limits = BuildLimits(args.build_timeout, args.stall_timeout, history, args.timeout_factor,
+                             BuildLimits.readOverrides(args.timeouts) if args.timeouts else None)
+
+        if args.no_build_registry:
+            registry = None
+        else:
+            lock_dir = args.build_lock_dir or os.path.join(eupsObj.path[0], '.lsst_build', 'locks')
+            registry = BuildRegistry(lock_dir, build_dir)
+
+        log_archive = LogArchive(args.log_archive) if args.log_archive else None
+
+        b = Builder(build_dir, manifest, progress, eupsObj, incremental=args.incremental,
+                    compiler_cache=compiler_cache, history=history, prep_jobs=args.prep_jobs,
+                    deferred_tests=args.deferred_tests, setup_cache=setup_cache, scratch=scratch,
+                    limits=limits, retry_stalled=args.retry_stalled, registry=registry,
+                    log_archive=log_archive)
         retcode = b.build()
         exit(retcode == 0)
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+#############################################################################
+# Caching of expensive-to-construct objects between runs
+
+import os
+import glob
+
+
+def eupsDatabaseFiles(eupsPath=None):
+    """Return the list of files whose modification invalidates an `eups.Eups` object.
+
+        Covers the ups_db directory of every stack on the EUPS path, as well
+        as the per-product directories and tag files within it (declaring or
+        tagging a product touches one of these).
+    """
+    if eupsPath is None:
+        eupsPath = os.environ.get("EUPS_PATH", "")
+
+    files = []
+    for path in eupsPath.split(':'):
+        if not path:
+            continue
+        upsdb = os.path.join(path, 'ups_db')
+        files.append(upsdb)
+        files += sorted(glob.glob(os.path.join(upsdb, '*')))
+    return files
+
+
+def gitStateFiles(repodir):
+    """Return the list of files whose modification signals a change in a git working copy."""
+    gitdir = os.path.join(repodir, '.git')
+    return [os.path.join(gitdir, fn) for fn in ('HEAD', 'index', 'packed-refs')]
+
+
+class NullCache(object):
+    """A cache that never caches; used when running as a one-shot command."""
+
+    def get(self, key, files, factory):
+        return factory()
+
+
+class WarmCache(object):
+    """Memoize objects until any of the files they were constructed from change.
+
+       Each entry is stamped with the modification times of a list of files;
+       a lookup with a different stamp reconstructs the object.
+    """
+
+    def __init__(self):
+        self.entries = dict()   # key -> (stamp, value)
+
+    @staticmethod
+    def _stamp(files):
+        stamp = []
+        for fn in files:
+            try:
+                st = os.stat(fn)
+                stamp.append((fn, st.st_mtime, st.st_size))
+            except OSError:
+                stamp.append((fn, None, None))
+        return stamp
+
+    def get(self, key, files, factory):
+        """Return the object cached under key, calling factory() if it is missing or stale
+
+            Args:
+                key: a hashable key identifying the object
+                files (list): files whose modification invalidates the object
+                factory (callable): constructs the object
+
+            Returns:
+                The (possibly cached) object.
+        """
+        stamp = self._stamp(files)
+        try:
+            oldStamp, value = self.entries[key]
+            if oldStamp == stamp:
+                return value
+        except KeyError:
+            pass
+
+        value = factory()
+        self.entries[key] = (stamp, value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,159 @@
+from __future__ import print_function
+from __future__ import absolute_import
+#############################################################################
+# Daemon mode: serve prepare/build requests over a UNIX socket
+
+import os
+import sys
+import json
+import socket
+import tempfile
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .cache import WarmCache
+
+
+def defaultSocketPath():
+    return os.path.join(tempfile.gettempdir(), 'lsst-build-%d.sock' % os.getuid())
+
+
+class _SocketWriter(object):
+    """A file-like object forwarding everything written to it to the client"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, s):
+        if s:
+            self.wfile.write((json.dumps({'out': s}) + '\n').encode('utf-8'))
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line.decode('utf-8'))
+
+        out = _SocketWriter(self.wfile)
+        retcode = self.server.daemon.execute(request['argv'], request['cwd'], out)
+
+        self.wfile.write((json.dumps({'exit': retcode}) + '\n').encode('utf-8'))
+
+
+class Daemon(object):
+    """Execute `lsst-build prepare', `build' and `plan' requests received
+       over a UNIX socket, keeping the EUPS, repos.yaml, exclusion map and
+       versiondb state warm between requests.
+
+       The cached objects are invalidated when the files they were
+       constructed from change (see `cache.WarmCache`). Requests are
+       executed one at a time, in the environment the daemon was started in.
+
+       :ivar parser: the `argparse.ArgumentParser` of the lsst-build command
+       :ivar cache: the `cache.WarmCache` shared by all requests
+    """
+
+    commands = ('prepare', 'build', 'plan')
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.cache = WarmCache()
+
+    def execute(self, argv, cwd, out):
+        """Run a single lsst-build command line, writing its output to out.
+
+            Returns:
+                int. the exit code of the command.
+        """
+        if not argv or argv[0] not in self.commands:
+            print("lsst-build daemon: command must be one of: %s" % ', '.join(self.commands), file=out)
+            return 2
+
+        savedCwd = os.getcwd()
+        savedStdout, savedStderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = out
+        try:
+            os.chdir(cwd)
+            args = self.parser.parse_args(argv)
+            args.func(args, cache=self.cache)
+            retcode = 0
+        except SystemExit as e:
+            retcode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc(file=out)
+            retcode = 1
+        finally:
+            sys.stdout, sys.stderr = savedStdout, savedStderr
+            os.chdir(savedCwd)
+
+        return retcode
+
+    def serve(self, socketPath):
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+
+        server = socketserver.UnixStreamServer(socketPath, _RequestHandler)
+        server.daemon = self
+        print("lsst-build daemon: listening on %s" % socketPath, file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socketPath)
+
+    @staticmethod
+    def run(args):
+        try:
+            Daemon(args.parser).serve(args.socket)
+        except KeyboardInterrupt:
+            pass
+
+
+class Client(object):
+    """Thin client forwarding a command line to a running `Daemon`"""
+
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+
+    def call(self, argv, out):
+        """Submit argv to the daemon, copying its output to out.
+
+            Returns:
+                int. the exit code of the command.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socketPath)
+        try:
+            request = {'argv': argv, 'cwd': os.getcwd()}
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+            fp = sock.makefile('rb')
+            for line in iter(fp.readline, b''):
+                msg = json.loads(line.decode('utf-8'))
+                if 'exit' in msg:
+                    return msg['exit']
+                out.write(msg['out'])
+                out.flush()
+        finally:
+            sock.close()
+
+        raise Exception("lsst-build daemon at '%s' closed the connection prematurely" % self.socketPath)
+
+    @staticmethod
+    def run(args):
+        argv = args.command
+        if argv and argv[0] == '--':
+            argv = argv[1:]
+
+        retcode = Client(args.socket).call(argv, sys.stderr)
+        exit(retcode)
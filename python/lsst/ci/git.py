@@ -1,7 +1,16 @@
 #############################################################################
 # Git support
 
+import os
+import signal
 import subprocess
+import threading
+import time
+
+# Environment variables making checkouts leave git-lfs pointer files in
+# place, instead of downloading the objects one at a time while smudging;
+# the objects are then checked out with `git lfs pull' (see `Git.lfs_pull_if_tracked`)
+LFS_SKIP_SMUDGE = {'GIT_LFS_SKIP_SMUDGE': '1'}
 
 
 class GitError:
@@ -18,6 +27,18 @@ class GitError:
                                                                                              self.stderr)
 
 
+class GitTimeout(GitError):
+    def __init__(self, timeout, cmd, output, stderr):
+        GitError.__init__(self, -signal.SIGKILL, cmd, output, stderr)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' was killed after %s seconds.\nstdout:\n%s\nstderr:\n%s" % (self.cmd,
+                                                                                        self.timeout,
+                                                                                        self.output,
+                                                                                        self.stderr)
+
+
 class Git:
     def __init__(self, cwd=None):
         self.cwd = cwd
@@ -28,16 +49,51 @@ class Git:
 
     def __call__(self, *args, **kwargs):
         # Run git with the given arguments, returning stdout.
+        #
+        # If timeout (in seconds) is given, or the threading.Event cancel is
+        # set while git runs, git (and any helper processes it spawned) is
+        # killed; with return_status the exit code is then negative.
+        #
+        # Variables in the env dict are added to git's environment.
 
         return_status = kwargs.get("return_status", False)
+        timeout = kwargs.get("timeout", None)
+        cancel = kwargs.get("cancel", None)
+        env = dict(os.environ, **kwargs["env"]) if kwargs.get("env") else None
 
         # force all cli args into strings
         cmd = ['git'] + [str(x) for x in args]
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.cwd)
-        (stdout, stderr) = process.communicate()
+        if timeout is None and cancel is None:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.cwd,
+                                       env=env)
+            (stdout, stderr) = process.communicate()
+            killed = False
+        else:
+            # run in its own process group, so the whole group can be killed
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.cwd,
+                                       env=env, preexec_fn=os.setsid)
+            output = []
+            reader = threading.Thread(target=lambda: output.extend(process.communicate()))
+            reader.start()
+
+            deadline = time.time() + timeout if timeout is not None else None
+            killed = False
+            while reader.is_alive():
+                reader.join(0.1)
+                expired = deadline is not None and time.time() > deadline
+                cancelled = cancel is not None and cancel.is_set()
+                if not killed and reader.is_alive() and (expired or cancelled):
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                    killed = True
+            (stdout, stderr) = output
         retcode = process.poll()
 
+        if killed and not return_status:
+            raise GitTimeout(timeout, cmd, stdout, stderr)
         if retcode and not return_status:
             raise GitError(retcode, cmd, stdout, stderr)
 
@@ -70,8 +126,23 @@ class Git:
     def tag(self, *args, **kwargs):
         return self('tag', *args, **kwargs)
 
+    def ls_remote(self, *args, **kwargs):
+        return self('ls-remote', *args, **kwargs)
+
     def describe(self, *args, **kwargs):
         return self('describe', *args, **kwargs)
 
     def lfs(self, *args, **kwargs):
         return self('lfs', *args, **kwargs)
+
+    def lfs_pull_if_tracked(self, **kwargs):
+        # Download and check out the git-lfs objects of the working tree, if
+        # any files in it are tracked by git-lfs. Returns True if it pulled.
+        files, retcode = self.lfs('ls-files', '--name-only', return_status=True)
+        if retcode or not files:
+            return False
+        self.lfs('pull', **kwargs)
+        return True
+
+    def worktree(self, *args, **kwargs):
+        return self('worktree', *args, **kwargs)
@@ -0,0 +1,57 @@
+from __future__ import print_function
+#############################################################################
+# Build history
+
+import os
+import time
+
+
+class BuildHistory(object):
+    """A record of past product builds, used to estimate the cost of future ones.
+
+       Stored as a text file with one whitespace-separated
+       (timestamp, product, version, seconds, exit code) line per build.
+
+       :ivar fn: the history file
+    """
+
+    # number of most recent successful builds used to estimate the build time
+    window = 5
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._durations = None
+
+    def record(self, name, version, seconds, retcode):
+        """Append a build of product name/version to the history"""
+        with open(self.fn, 'a') as fp:
+            print("%d %s %s %.1f %d" % (time.time(), name, version, seconds, retcode), file=fp)
+
+        if self._durations is not None and not retcode:
+            self._durations.setdefault(name, []).append(seconds)
+
+    def durations(self):
+        """Return a product name -> list of successful build durations (oldest first) dict"""
+        if self._durations is None:
+            self._durations = dict()
+            if os.path.exists(self.fn):
+                with open(self.fn) as fp:
+                    for line in fp:
+                        arr = line.split()
+                        if len(arr) != 5 or arr[4] != '0':
+                            continue
+                        self._durations.setdefault(arr[1], []).append(float(arr[3]))
+
+        return self._durations
+
+    def estimate(self, name):
+        """Return the expected build time of product name (in seconds), or None if it was never built
+
+           The estimate is the median of the most recent successful builds.
+        """
+        durations = self.durations().get(name)
+        if not durations:
+            return None
+
+        recent = sorted(durations[-self.window:])
+        return recent[len(recent) // 2]
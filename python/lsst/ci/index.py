@@ -0,0 +1,179 @@
+from __future__ import print_function
+#############################################################################
+# Query index over the versiondb history
+
+import os
+import re
+import sys
+import sqlite3
+
+
+class ManifestIndex(object):
+    """An sqlite index of all manifests and dependency tables stored in a versiondb
+
+       The index lives in <versiondb>/.git/lsst-build-index.sqlite, so it is
+       never committed. It is updated incrementally: manifests already
+       indexed, and the parts of the (append-only) dep_db files already read,
+       are skipped. `VersionDbGit.commit` updates it after every commit.
+
+       :ivar dbdir: the versiondb working directory
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS builds (build TEXT PRIMARY KEY, seq INTEGER);
+        CREATE TABLE IF NOT EXISTS products (build TEXT, name TEXT, sha1 TEXT, version TEXT);
+        CREATE INDEX IF NOT EXISTS products_name ON products (name, version);
+        CREATE INDEX IF NOT EXISTS products_sha1 ON products (sha1);
+        CREATE INDEX IF NOT EXISTS products_version ON products (version);
+        CREATE INDEX IF NOT EXISTS products_build ON products (build);
+        CREATE TABLE IF NOT EXISTS deps (name TEXT, version TEXT, suffix INTEGER,
+                                         dep_name TEXT, dep_version TEXT);
+        CREATE INDEX IF NOT EXISTS deps_name ON deps (name, version);
+        CREATE TABLE IF NOT EXISTS dep_files (fn TEXT PRIMARY KEY, offset INTEGER);
+    """
+
+    def __init__(self, dbdir):
+        self.dbdir = dbdir
+        self.fn = os.path.join(dbdir, '.git', 'lsst-build-index.sqlite')
+        self.db = sqlite3.connect(self.fn)
+        self.db.executescript(self.schema)
+
+    @staticmethod
+    def _seq(build):
+        m = re.match(r'^b(\d+)$', build)
+        return int(m.group(1)) if m else None
+
+    def _index_manifest(self, build, fn):
+        rows = []
+        with open(fn) as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith('#') or re.match(r'^\w+=', line):
+                    continue
+                name, sha1, version = line.split()[:3]
+                rows.append((build, name, sha1, version))
+
+        self.db.execute("INSERT INTO builds VALUES (?, ?)", (build, self._seq(build)))
+        self.db.executemany("INSERT INTO products VALUES (?, ?, ?, ?)", rows)
+
+    def _index_dep_file(self, product, fn, offset):
+        with open(fn) as fp:
+            fp.seek(offset)
+            rows = []
+            for line in iter(fp.readline, ''):
+                if not line.endswith('\n'):
+                    # a partially written line; leave it for the next update
+                    break
+                offset += len(line)
+                arr = line.split()
+                if len(arr) == 4:
+                    rows.append((product, arr[0], int(arr[1]), arr[2], arr[3]))
+
+        self.db.executemany("INSERT INTO deps VALUES (?, ?, ?, ?, ?)", rows)
+        self.db.execute("INSERT OR REPLACE INTO dep_files VALUES (?, ?)", (os.path.basename(fn), offset))
+
+    def update(self):
+        """Index the manifests and dependency table entries added since the last update
+
+            Returns:
+                int. the number of newly indexed manifests.
+        """
+        indexed = set(row[0] for row in self.db.execute("SELECT build FROM builds"))
+
+        mandir = os.path.join(self.dbdir, 'manifests')
+        added = 0
+        for fn in os.listdir(mandir):
+            build, ext = os.path.splitext(fn)
+            if ext != '.txt' or fn == 'content_sha.db.txt' or build in indexed:
+                continue
+            self._index_manifest(build, os.path.join(mandir, fn))
+            added += 1
+
+        offsets = dict(self.db.execute("SELECT fn, offset FROM dep_files"))
+        depdir = os.path.join(self.dbdir, 'dep_db')
+        for fn in os.listdir(depdir):
+            product, ext = os.path.splitext(fn)
+            if ext != '.txt':
+                continue
+            absfn = os.path.join(depdir, fn)
+            offset = offsets.get(fn, 0)
+            if os.path.getsize(absfn) > offset:
+                self._index_dep_file(product, absfn, offset)
+
+        self.db.commit()
+        return added
+
+    def products(self, name=None, sha1=None, version=None, build=None):
+        """Return the (build, name, sha1, version) tuples matching all given criteria, oldest build first
+
+            sha1 may be an abbreviated SHA1.
+        """
+        where, params = [], []
+        if name is not None:
+            where.append("p.name = ?")
+            params.append(name)
+        if sha1 is not None:
+            where.append("p.sha1 LIKE ?")
+            params.append(sha1 + '%')
+        if version is not None:
+            where.append("p.version = ?")
+            params.append(version)
+        if build is not None:
+            where.append("p.build = ?")
+            params.append(build)
+
+        sql = "SELECT p.build, p.name, p.sha1, p.version FROM products p JOIN builds b ON p.build = b.build"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY b.seq, b.rowid, p.rowid"
+        return list(self.db.execute(sql, params))
+
+    def changes(self, name):
+        """Return the (build, name, sha1, version) tuples of the builds changing product name's version"""
+        res, last = [], None
+        for row in self.products(name=name):
+            if row[3] != last:
+                res.append(row)
+                last = row[3]
+        return res
+
+    def dependencies(self, name, version):
+        """Return the (suffix, dep_name, dep_version) tuples recorded in dep_db for name's version
+
+            version may be the full XXX+N version, or just XXX (returning the
+            dependencies of all +N suffixes).
+        """
+        m = re.match(r'^(.*)\+(\d+)$', version)
+        if m and not self.db.execute("SELECT 1 FROM deps WHERE name = ? AND version = ? LIMIT 1",
+                                     (name, version)).fetchone():
+            version, suffix = m.group(1), int(m.group(2))
+            return list(self.db.execute("SELECT suffix, dep_name, dep_version FROM deps "
+                                        "WHERE name = ? AND version = ? AND suffix = ? ORDER BY rowid",
+                                        (name, version, suffix)))
+        return list(self.db.execute("SELECT suffix, dep_name, dep_version FROM deps "
+                                    "WHERE name = ? AND version = ? ORDER BY suffix, rowid", (name, version)))
+
+    @staticmethod
+    def run(args, cache=None):
+        index = ManifestIndex(args.version_git_repo)
+        index.update()
+
+        out = sys.stdout
+        if args.deps:
+            if not args.product or not args.version:
+                raise Exception("--deps requires --product and --version")
+            print('# %-8s %-25s %s' % ("suffix", "dependency", "version"), file=out)
+            for suffix, depName, depVersion in index.dependencies(args.product, args.version):
+                print('%-10s %-25s %s' % (suffix, depName, depVersion), file=out)
+            return
+
+        if args.changes:
+            if not args.product:
+                raise Exception("--changes requires --product")
+            rows = index.changes(args.product)
+        else:
+            rows = index.products(name=args.product, sha1=args.sha1, version=args.version, build=args.build)
+
+        print('# %-8s %-25s %-41s %s' % ("build", "product", "SHA1", "version"), file=out)
+        for build, name, sha1, version in rows:
+            print('%-10s %-25s %-41s %s' % (build, name, sha1, version), file=out)
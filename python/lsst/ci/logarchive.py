@@ -0,0 +1,171 @@
+from __future__ import print_function
+#############################################################################
+# Compressed, content-addressed build log archive
+
+import os
+import errno
+import time
+import gzip
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+
+def compressFile(src, dst):
+    """Write a gzip-compressed copy of src to dst, atomically"""
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(dst) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(os.path.basename(src), 'wb', fileobj=raw) as gz:
+                with open(src, 'rb') as fp:
+                    shutil.copyfileobj(fp, gz)
+        os.chmod(tmpfn, 0o644)
+        os.rename(tmpfn, dst)
+    except BaseException:
+        os.unlink(tmpfn)
+        raise
+
+
+def installLog(logfile, destdir):
+    """Install a compressed copy of logfile (as <name>.gz) into destdir, returning its path"""
+    dst = os.path.join(destdir, os.path.basename(logfile) + '.gz')
+    compressFile(logfile, dst)
+    return dst
+
+
+class LogArchive(object):
+    """A content-addressed archive of compressed build logs.
+
+       Each distinct log is stored once, gzip-compressed, as
+       <dir>/objects/<sha1[:2]>/<sha1>.gz; index.txt records one
+       whitespace-separated (timestamp, sha1, product, version, name) line
+       for each distinct (log, product, version, name) added. Adding a log
+       that is already archived refreshes its modification time, which is
+       what `expire` goes by.
+
+       The archive may be shared by several processes (and threads): adding
+       and expiring logs hold an exclusive lock on <dir>/index.lock.
+
+       :ivar dir: the archive directory
+    """
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.indexfn = os.path.join(dir, 'index.txt')
+        self.lockfn = os.path.join(dir, 'index.lock')
+        self._lock = threading.Lock()
+        self._indexed = None
+        self._indexKey = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # hold the archive's lock, against other threads and other processes
+        with self._lock:
+            try:
+                os.makedirs(self.dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd = os.open(self.lockfn, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _stat_index(self):
+        # (inode, size) of the index, which changes when anyone adds to or expires it
+        try:
+            st = os.stat(self.indexfn)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size)
+
+    def _entries(self):
+        # the (sha1, product, version, name) entries in the index, reread if
+        # another process has changed it; the lock must be held
+        key = self._stat_index()
+        if self._indexed is None or key != self._indexKey:
+            self._indexed = set()
+            if key is not None:
+                with open(self.indexfn) as fp:
+                    for line in fp:
+                        arr = line.split()
+                        if len(arr) == 5:
+                            self._indexed.add(tuple(arr[1:]))
+            self._indexKey = key
+        return self._indexed
+
+    def path(self, sha1):
+        return os.path.join(self.dir, 'objects', sha1[:2], sha1 + '.gz')
+
+    @staticmethod
+    def _hash(fn):
+        h = hashlib.sha1()
+        with open(fn, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def add(self, logfile, product, version):
+        """Archive logfile, the log of building product/version, returning its SHA1"""
+        sha1 = self._hash(logfile)
+        objfn = self.path(sha1)
+        with self._locked():
+            if os.path.exists(objfn):
+                os.utime(objfn, None)
+            else:
+                try:
+                    os.makedirs(os.path.dirname(objfn))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                compressFile(logfile, objfn)
+
+            entry = (sha1, product, version, os.path.basename(logfile))
+            if entry not in self._entries():
+                with open(self.indexfn, 'a') as fp:
+                    print("%d %s" % (time.time(), ' '.join(entry)), file=fp)
+                self._indexed.add(entry)
+                self._indexKey = self._stat_index()
+
+        return sha1
+
+    def expire(self, maxAge):
+        """Remove logs not added in the last maxAge seconds
+
+            Returns:
+                (count, size) tuple of the number of removed logs, and the
+                space (in bytes) they took.
+        """
+        cutoff = time.time() - maxAge
+        count, size = 0, 0
+        objdir = os.path.join(self.dir, 'objects')
+        with self._locked():
+            for dirpath, _, filenames in os.walk(objdir, topdown=False):
+                for fn in filenames:
+                    objfn = os.path.join(dirpath, fn)
+                    st = os.stat(objfn)
+                    if st.st_mtime < cutoff:
+                        os.unlink(objfn)
+                        count += 1
+                        size += st.st_size
+                if dirpath != objdir and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+
+            # drop the index entries of the removed logs
+            if count and os.path.exists(self.indexfn):
+                with open(self.indexfn) as fp:
+                    lines = [line for line in fp if len(line.split()) == 5 and
+                             os.path.exists(self.path(line.split()[1]))]
+                fd, tmpfn = tempfile.mkstemp(dir=self.dir)
+                with os.fdopen(fd, 'w') as fp:
+                    fp.writelines(lines)
+                os.chmod(tmpfn, 0o644)
+                os.rename(tmpfn, self.indexfn)
+                self._indexed = None
+
+        return count, size
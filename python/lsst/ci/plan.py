@@ -0,0 +1,131 @@
+from __future__ import print_function
+from __future__ import absolute_import
+#############################################################################
+# Rebuild planner
+
+import sys
+
+from .prepare import Manifest
+from .history import BuildHistory
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%ds" % seconds
+    if seconds < 3600:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%dh %02dm" % (seconds // 3600, (seconds % 3600) // 60)
+
+
+class RebuildPlanner(object):
+    """Determine which products of a new manifest must be rebuilt relative to an old one, and why.
+
+       A product must be rebuilt if its version differs from the one in the
+       old manifest (or if it is not in the old manifest at all). The
+       version changes when the product's own source changes, or when the
+       version of any of its dependencies changes (through the +YYY suffix).
+       Only the manifests are examined; neither EUPS nor git is consulted.
+
+       :ivar old: the `Manifest` of the previous build
+       :ivar new: the `Manifest` of the build being planned
+       :ivar history: a `BuildHistory` used to estimate the rebuild cost, or None
+    """
+
+    def __init__(self, old, new, history=None):
+        self.old = old
+        self.new = new
+        self.history = history
+
+    def _reasons(self, prod, rebuilt):
+        """Return the list of reasons why prod must be rebuilt (empty if it needn't be)"""
+        try:
+            oldProd = self.old.products[prod.name]
+        except KeyError:
+            return ["new product"]
+
+        if oldProd.version == prod.version:
+            return []
+
+        reasons = []
+        if oldProd.sha1 != prod.sha1:
+            reasons.append("own SHA1 changed (%s -> %s)" % (oldProd.sha1[:10], prod.sha1[:10]))
+
+        oldDeps = set(dep.name for dep in oldProd.dependencies)
+        newDeps = set(dep.name for dep in prod.dependencies)
+        if oldDeps != newDeps:
+            changes = ['+' + name for name in sorted(newDeps - oldDeps)] + \
+                      ['-' + name for name in sorted(oldDeps - newDeps)]
+            reasons.append("dependencies changed (%s)" % ', '.join(changes))
+
+        changedDeps = sorted(name for name in newDeps & oldDeps if name in rebuilt)
+        if changedDeps:
+            reasons.append("dependency version changed (%s)" % ', '.join(changedDeps))
+
+        if not reasons:
+            reasons.append("version changed (%s -> %s)" % (oldProd.version, prod.version))
+
+        return reasons
+
+    def plan(self):
+        """Compute the rebuild plan
+
+            Returns:
+                list of (`Product`, reasons) tuples, in build (topological)
+                order, for each product that must be rebuilt; reasons is a
+                list of strings.
+        """
+        rebuilt = set()
+        plan = []
+        for prod in self.new.products.values():
+            reasons = self._reasons(prod, rebuilt)
+            if reasons:
+                rebuilt.add(prod.name)
+                plan.append((prod, reasons))
+
+        return plan
+
+    def estimate(self, plan):
+        """Estimate the cost of a plan from the build history
+
+            Returns:
+                (seconds, unknown) tuple, where seconds is the total
+                estimated build time of the products with a build history,
+                and unknown is the list of names of products without one.
+        """
+        seconds, unknown = 0., []
+        for prod, _ in plan:
+            t = self.history.estimate(prod.name) if self.history is not None else None
+            if t is None:
+                unknown.append(prod.name)
+            else:
+                seconds += t
+        return seconds, unknown
+
+    def report(self, out):
+        plan = self.plan()
+        seconds, unknown = self.estimate(plan)
+
+        print('# %-23s %10s  %s' % ("product", "est. time", "reason"), file=out)
+        for prod, reasons in plan:
+            t = self.history.estimate(prod.name) if self.history is not None else None
+            t = formatDuration(t) if t is not None else '?'
+            print('%-25s %10s  %s' % (prod.name, t, '; '.join(reasons)), file=out)
+
+        removed = [name for name in self.old.products if name not in self.new.products]
+        if removed:
+            print('# removed: %s' % ', '.join(removed), file=out)
+
+        print('# %d of %d products to rebuild; estimated build time: %s' % (
+              len(plan), len(self.new.products), formatDuration(seconds)), file=out)
+        if unknown:
+            print('# (no build history for %d products: %s)' % (len(unknown), ', '.join(unknown)), file=out)
+
+    @staticmethod
+    def run(args, cache=None):
+        old = Manifest.load(args.old_manifest)
+        new = Manifest.load(args.new_manifest)
+
+        history = BuildHistory(args.history) if args.history else None
+
+        RebuildPlanner(old, new, history).report(sys.stdout)
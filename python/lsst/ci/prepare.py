@@ -18,19 +18,82 @@ import collections
 import abc
 import yaml
 import copy
+import json
+import errno
+import threading
+import struct
+import mmap
+import fcntl
+import contextlib
+import sqlite3
 
 from . import tsort
 
-from .git import Git
+from .git import Git, GitError, GitTimeout, LFS_SKIP_SMUDGE
+from .cache import NullCache, eupsDatabaseFiles, gitStateFiles
+from .index import ManifestIndex
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+
+@contextlib.contextmanager
+def productLock(build_dir, product, wait=True):
+    """ Hold an exclusive lock on the product's clone in build_dir, shared
+        with all other lsst-build processes using the build directory,
+        yielding True; with wait=False, yield False at once if the lock is
+        held by someone else.
+
+        The lock is an flock() of build_dir/_locks/<product>, released by
+        the kernel even if the process holding it is killed, so the file can
+        safely be left behind.
+    """
+    lockdir = os.path.join(build_dir, '_locks')
+    try:
+        os.makedirs(lockdir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    fd = os.open(os.path.join(lockdir, product), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)
 
 
 class Product(object):
-    """Class representing an EUPS product to be built"""
+    """Class representing an EUPS product to be built
+
+       The dependencies may be given as a callable returning the list of
+       `Product`s, in which case they're resolved on first access.
+    """
+    __slots__ = ('name', 'sha1', 'version', '_dependencies')
+
     def __init__(self, name, sha1, version, dependencies):
         self.name = name
         self.sha1 = sha1
         self.version = version
-        self.dependencies = dependencies
+        self._dependencies = dependencies
+
+    @property
+    def dependencies(self):
+        if callable(self._dependencies):
+            self._dependencies = self._dependencies()
+        return self._dependencies
+
+    @dependencies.setter
+    def dependencies(self, dependencies):
+        self._dependencies = dependencies
 
     def flat_dependencies(self):
         """Return a flat list of dependencies for the product.
@@ -51,8 +114,23 @@ class Manifest(object):
 
        :ivar products: topologically sorted list of `Product`s
        :ivar buildID:  unique build identifier
+
+       Besides the text format (`toFile`/`fromFile`), manifests can be
+       stored in a compact binary format (`toCompactFile`/`fromCompactFile`),
+       which is read through mmap, and whose dependencies are resolved
+       lazily. The layout (all integers little-endian uint32) is::
+
+           header:   magic, product count, dependency count, string table size,
+                     build ID (string offset, or 0xffffffff if None)
+           products: (name, sha1, version) string offsets, first dependency, dependency count
+           deps:     product IDs (indices into the products table)
+           strings:  NUL-terminated UTF-8 strings
     """
 
+    compactMagic = b'LBMANIF1'
+    _compactHeader = struct.Struct('<8sIIII')
+    _compactProduct = struct.Struct('<IIIII')
+
     def __init__(self, productsList, buildID=None):
         """Construct the manifest
 
@@ -116,6 +194,102 @@ class Manifest(object):
 
         return Manifest(products, buildId)
 
+    def toCompactFile(self, fileObject):
+        """ Serialize the manifest to a (binary) file object, in the compact format """
+        strings = []
+        offsets = dict()
+        size = [0]
+
+        def string(s):
+            try:
+                return offsets[s]
+            except KeyError:
+                data = s.encode('utf-8') + b'\0'
+                offsets[s] = size[0]
+                strings.append(data)
+                size[0] += len(data)
+                return offsets[s]
+
+        ids = dict((name, i) for i, name in enumerate(self.products))
+        records, deps = [], []
+        for prod in self.products.values():
+            depIds = [ids[dep.name] for dep in prod.dependencies]
+            records.append(self._compactProduct.pack(string(prod.name), string(prod.sha1),
+                                                     string(prod.version), len(deps), len(depIds)))
+            deps += depIds
+        buildID = string(self.buildID) if self.buildID is not None else 0xffffffff
+
+        header = self._compactHeader.pack(self.compactMagic, len(records), len(deps), size[0], buildID)
+        fileObject.write(header)
+        fileObject.write(b''.join(records))
+        fileObject.write(struct.pack('<%dI' % len(deps), *deps))
+        fileObject.write(b''.join(strings))
+
+    @staticmethod
+    def isCompactFile(fn):
+        with open(fn, 'rb') as fp:
+            return fp.read(len(Manifest.compactMagic)) == Manifest.compactMagic
+
+    @staticmethod
+    def fromCompactFile(fn):
+        """ Load a manifest stored in the compact format
+
+            The file is mmap-ed; the dependencies of each product are only
+            looked up when first accessed.
+        """
+        with open(fn, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header, record = Manifest._compactHeader, Manifest._compactProduct
+        magic, nprod, ndeps, _, buildIdOff = header.unpack_from(buf, 0)
+        if magic != Manifest.compactMagic:
+            raise Exception("'%s' is not a compact manifest file" % fn)
+        depsOff = header.size + nprod * record.size
+        strOff = depsOff + 4 * ndeps
+
+        def string(off):
+            end = buf.find(b'\0', strOff + off)
+            s = buf[strOff + off:end]
+            return s if isinstance(s, str) else s.decode('utf-8')
+
+        plist = []
+
+        def resolver(first, count):
+            def resolve():
+                return [plist[i] for i in struct.unpack_from('<%dI' % count, buf, depsOff + 4 * first)]
+            return resolve if count else list
+
+        products = collections.OrderedDict()
+        for i in range(nprod):
+            off = header.size + i * record.size
+            nameOff, sha1Off, versionOff, first, count = record.unpack_from(buf, off)
+            name = intern(str(string(nameOff)))
+            prod = Product(name, string(sha1Off), string(versionOff), resolver(first, count))
+            plist.append(prod)
+            products[name] = prod
+
+        buildId = string(buildIdOff) if buildIdOff != 0xffffffff else None
+        return Manifest(products, buildId)
+
+    @staticmethod
+    def load(fn):
+        """ Load a manifest from file fn, in either the text or the compact format """
+        if Manifest.isCompactFile(fn):
+            return Manifest.fromCompactFile(fn)
+        with open(fn) as fp:
+            return Manifest.fromFile(fp)
+
+    @staticmethod
+    def convert(args, cache=None):
+        """ Convert a manifest between the text and the compact format (`lsst-build convert-manifest`) """
+        manifest = Manifest.load(args.input)
+        if args.compact:
+            with open(args.output, 'wb') as fp:
+                manifest.toCompactFile(fp)
+        else:
+            with open(args.output, 'w') as fp:
+                manifest.toFile(fp)
+
     @staticmethod
     def fromProductDict(productDict):
         """ Create a `Manifest` by topologically sorting the dict of `Product`s
@@ -147,11 +321,26 @@ class ProductFetcher(object):
         See `fetch` for further documentation.
 
         :ivar build_dir: The product will be cloned to build_dir/productName
+        :ivar repos: A `ReposIndex` of repos.yaml entries (see `loadRepos`), or None
         :ivar repository_patterns: A list of str.format() patterns used discover the URL of the remote git repository.
         :ivar refs: A list of refs to attempt to git-checkout
         :ivar no_fetch: If true, don't fetch, just checkout the first matching ref.
+        :ivar clone_filter: Default git partial clone filter (e.g., 'blob:none', 'tree:0'), or None
+        :ivar shallow: If true, by default clone and fetch only the tips of the candidate refs.
+
+        :ivar lfs_concurrency: Number of parallel git-lfs object transfers.
+        :ivar lfs_cache_dir: Host-wide git-lfs object storage shared between clones, or None.
+        :ivar timeout: Timeout (in seconds) of each network git operation, or None.
+        :ivar retries: Number of times a failed network git operation is retried.
+        :ivar hedge: If true, clone from the first two candidate URLs in parallel.
+        :ivar origins_fn: File remembering the URL each product was cloned from.
+
+        The clone_filter and shallow policies can be overridden per product
+        with the `clone_filter` and `shallow` keys of its repos.yaml entry.
     """
-    def __init__(self, build_dir, repos, repository_patterns, refs, no_fetch):
+    def __init__(self, build_dir, repos, repository_patterns, refs, no_fetch,
+                 clone_filter=None, shallow=False, lfs_concurrency=8, lfs_cache_dir=None,
+                 timeout=None, retries=0, hedge=False, origins_fn=None):
         self.build_dir = os.path.abspath(build_dir)
         self.refs = refs
         if repository_patterns:
@@ -159,14 +348,39 @@ class ProductFetcher(object):
         else:
             self.repository_patterns = None
         self.no_fetch = no_fetch
-        if repos:
-            if os.path.exists(repos):
-                with open(repos, 'r') as f:
-                    self.repos = yaml.safe_load(f)
-            else:
-                raise Exception("YAML repos file '%s' does not exist" % repos)
+        self.repos = repos
+        self.clone_filter = clone_filter
+        self.shallow = shallow
+        self.lfs_concurrency = lfs_concurrency
+        self.lfs_cache_dir = os.path.abspath(lfs_cache_dir) if lfs_cache_dir else None
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+
+        # base delay (in seconds) of the exponential backoff between retries
+        self.backoff = 2
+
+        # product -> URL it was last successfully cloned from; the file can
+        # be shared between build directories
+        if origins_fn:
+            self.origins_fn = os.path.abspath(origins_fn)
         else:
-            self.repos = None
+            self.origins_fn = os.path.join(self.build_dir, 'origins.txt')
+        self.origins = dict()
+        if os.path.exists(self.origins_fn):
+            with open(self.origins_fn) as fp:
+                for line in fp:
+                    arr = line.split()
+                    if len(arr) == 2:
+                        self.origins[arr[0]] = arr[1]
+
+    @staticmethod
+    def loadRepos(repos, cache_dir=None):
+        """ Load the repos.yaml file, returning a `ReposIndex` (cached in cache_dir, if given). """
+        if os.path.exists(repos):
+            return ReposIndex.fromFile(repos, cache_dir)
+        else:
+            raise Exception("YAML repos file '%s' does not exist" % repos)
 
     def _origin_candidates(self, product):
         """ Expand repository_patterns into URLs. """
@@ -178,8 +392,21 @@ class ProductFetcher(object):
             locations.append(yaml.url)
         if self.repository_patterns:
             locations += [pat % data for pat in self.repository_patterns]
+
+        # try the URL that worked the last time first
+        origin = self.origins.get(product)
+        if origin in locations:
+            locations.remove(origin)
+            locations.insert(0, origin)
+
         return locations
 
+    def _remember_origin(self, product, url):
+        if self.origins.get(product) != url:
+            self.origins[product] = url
+            with open(self.origins_fn, 'a') as fp:
+                print("%s %s" % (product, url), file=fp)
+
     def _ref_candidates(self, product):
         """ Generate a list of refs to attempt to checkout. """
 
@@ -188,7 +415,7 @@ class ProductFetcher(object):
         refs = copy.copy(self.refs)
         yaml = self._repos_yaml_lookup(product)
 
-        if yaml.ref:
+        if yaml and yaml.ref:
             refs.append(yaml.ref)
 
         # Add 'master' to list of refs, if not there already
@@ -198,24 +425,10 @@ class ProductFetcher(object):
         return refs
 
     def _repos_yaml_lookup(self, product):
-        """ Return repo specification [if present] from repos.yaml.
-            The multiple possible formats in repos.yaml are normalized into a
-            single consistent object.  No sanity checking is performed.
-        """
-        rs = None
-
-        if self.repos and product in self.repos:
-            spec = self.repos[product]
-            if isinstance(spec, str):
-                rs = RepoSpec(product, spec)
-            elif isinstance(spec, dict):
-                # the repos.yaml hash *must* not have keys that are not a
-                # RepoSpec constructor args
-                rs = RepoSpec(product, **spec)
-            else:
-                raise Exception('invalid repos.yaml repo specification -- please check the file with repos-lint')
-
-        return rs
+        """ Return the `RepoSpec` [if present] from repos.yaml, or None. """
+        if self.repos is None:
+            return None
+        return self.repos.get(product)
 
     def _origin_uses_lfs(self, product):
         """ Attempt to determine if this remote url needs git lfs support """
@@ -226,6 +439,226 @@ class ProductFetcher(object):
                 return True
         return False
 
+    def _clone_policy(self, product):
+        """ Return the (clone_filter, shallow) policy for the product. """
+        clone_filter, shallow = self.clone_filter, self.shallow
+
+        yaml = self._repos_yaml_lookup(product)
+        if yaml:
+            if yaml.clone_filter is not None:
+                clone_filter = yaml.clone_filter or None
+            if yaml.shallow is not None:
+                shallow = yaml.shallow
+
+        return clone_filter, shallow
+
+    def _shallow_refspecs(self, git, product):
+        """ Return the refspecs fetching only those candidate refs that exist in origin. """
+        remote_refs = set(line.split()[1] for line in self._network(git, 'ls-remote', 'origin').splitlines())
+
+        refspecs = []
+        for ref in self._ref_candidates(product):
+            if 'refs/heads/' + ref in remote_refs:
+                refspecs.append('+refs/heads/%s:refs/remotes/origin/%s' % (ref, ref))
+            if 'refs/tags/' + ref in remote_refs:
+                refspecs.append('+refs/tags/%s:refs/tags/%s' % (ref, ref))
+
+        return refspecs
+
+    def _deepen_to_tag(self, git, productdir, refspecs):
+        """ Deepen a shallow clone until git describe sees HEAD as it would
+            in a full clone.
+
+            pkgautoversion derives the version of a branch checkout from git
+            describe --tags: the most recent tag reachable from it, and the
+            number of commits since. On a shallow history, both may differ
+            from a full clone's (e.g., if a merged branch reaches beyond the
+            shallow boundary), giving the same SHA1 a different version. The
+            clone is deepened in exponentially growing steps, until describe
+            gives the same answer in two consecutive steps, or is otherwise
+            unshallowed.
+        """
+        step = 32
+        last = None
+        for _ in range(5):
+            if not os.path.exists(os.path.join(productdir, '.git', 'shallow')):
+                return
+            described, retcode = git.describe('--tags', 'HEAD', return_status=True)
+            if retcode:
+                described = None
+            if described is not None and described == last:
+                return
+            last = described
+
+            self._network(git, 'fetch', '--deepen=%d' % step, 'origin', *refspecs)
+            step *= 4
+
+        if os.path.exists(os.path.join(productdir, '.git', 'shallow')):
+            self._network(git, 'fetch', '--unshallow', 'origin', *refspecs)
+
+    def _lfs_config(self):
+        """ Return the list of (key, value) git config settings for lfs-backed clones.
+
+            `fetch` clones and checks out with smudging skipped (through
+            the environment, so that later checkouts of the clone and its
+            worktrees still smudge), leaving lfs pointer files in place; the
+            objects of the checked out ref are then downloaded with a single
+            `git lfs pull', which uses the batch API with lfs_concurrency
+            parallel transfers. If lfs_cache_dir is set, the objects are
+            stored there, shared between clones.
+        """
+        # lfs credential helper string, working around git-lfs prompting for
+        # credentials even when they are not required.
+        helper = '!f() { cat > /dev/null; echo username=; echo password=; }; f'
+
+        config = [
+            ('lfs.batch', 'true'),
+            ('lfs.concurrenttransfers', str(self.lfs_concurrency)),
+            ('filter.lfs.required', 'true'),
+            ('filter.lfs.smudge', 'git-lfs smudge -- %f'),
+            ('filter.lfs.process', 'git-lfs filter-process'),
+            ('filter.lfs.clean', 'git-lfs clean -- %f'),
+            ('credential.helper', helper),
+        ]
+        if self.lfs_cache_dir:
+            config.append(('lfs.storage', self.lfs_cache_dir))
+
+        return config
+
+    @staticmethod
+    def _remove_git_locks(productdir):
+        """ Remove the *.lock files left in a clone by killed git commands.
+
+            Must only be called with the clone locked (see `productLock`), when no
+            other lsst-build can be running git in it.
+        """
+        gitdir = os.path.join(productdir, '.git')
+        for dirpath, dirnames, filenames in os.walk(gitdir):
+            if dirpath == gitdir:
+                # the worktrees may be in use by builds
+                dirnames[:] = [dn for dn in dirnames if dn not in ('objects', 'lfs', 'worktrees')]
+            for fn in filenames:
+                if fn.endswith('.lock'):
+                    os.unlink(os.path.join(dirpath, fn))
+                    print("(removed stale %s) " % os.path.relpath(os.path.join(dirpath, fn), productdir),
+                          end='', file=sys.stderr)
+
+    def _network(self, git, *args):
+        """ Run a network git operation with the timeout, retrying it with exponential backoff. """
+        for attempt in range(self.retries + 1):
+            try:
+                return git(*args, timeout=self.timeout)
+            except GitError as e:
+                if isinstance(e, GitTimeout) and git.cwd is not None:
+                    # git was killed, possibly leaving lock files behind
+                    self._remove_git_locks(git.cwd)
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print("(retrying '%s' in %d sec: %s) " % (' '.join(args[:1]), delay, e.stderr.strip()),
+                      end='', file=sys.stderr)
+                time.sleep(delay)
+
+    def _clone_hedged(self, urls, productdir, args, env=None):
+        """ Clone from all urls in parallel, keeping the first clone to succeed.
+
+            Returns:
+                the URL of the successful clone, or None if all failed.
+        """
+        cancel = threading.Event()
+        lock = threading.Lock()
+        winner = []
+
+        def attempt(i, url):
+            dest = '%s.hedge%d' % (productdir, i)
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            _, retcode = Git.clone(*(args + [url, dest]), return_status=True, timeout=self.timeout,
+                                   cancel=cancel, env=env)
+            with lock:
+                if not retcode and not winner:
+                    winner.append(i)
+                    cancel.set()
+
+        threads = [threading.Thread(target=attempt, args=(i, url)) for i, url in enumerate(urls)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for i in range(len(urls)):
+            dest = '%s.hedge%d' % (productdir, i)
+            if winner and i == winner[0]:
+                os.rename(dest, productdir)
+            elif os.path.exists(dest):
+                shutil.rmtree(dest)
+
+        return urls[winner[0]] if winner else None
+
+    def _clone_from(self, urls, productdir, args, env=None):
+        """ Clone from the first of the urls that works; return it (or None if none does). """
+        if self.hedge and len(urls) > 1:
+            url = self._clone_hedged(urls[:2], productdir, args, env)
+            if url is not None:
+                return url
+            urls = urls[2:]
+
+        for url in urls:
+            # remove the remnants of a killed clone
+            if os.path.exists(productdir):
+                shutil.rmtree(productdir)
+            if not Git.clone(*(args + [url, productdir]), return_status=True, timeout=self.timeout,
+                             env=env)[1]:
+                return url
+
+        return None
+
+    def _probe(self, urls):
+        """ Return the subset of urls that point to existing repositories.
+
+            All urls are checked in parallel, with a git ls-remote each.
+        """
+        alive = [False] * len(urls)
+
+        def probe(i, url):
+            # never prompt for credentials (e.g., when the repository doesn't exist on GitHub)
+            _, retcode = Git()('ls-remote', url, 'HEAD', return_status=True, timeout=self.timeout,
+                               env={'GIT_TERMINAL_PROMPT': '0', 'GIT_ASKPASS': 'true', 'SSH_ASKPASS': 'true'})
+            alive[i] = not retcode
+
+        threads = [threading.Thread(target=probe, args=(i, url)) for i, url in enumerate(urls)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return [url for url, ok in zip(urls, alive) if ok]
+
+    def _clone(self, product, productdir, args, env=None):
+        """ Clone the product, retrying with exponential backoff if no URL works.
+
+            Unless it is known where the product was cloned from before, all
+            candidate URLs are first probed in parallel, and those that don't
+            point to existing repositories are skipped.
+        """
+        urls = self._origin_candidates(product)
+        if product not in self.origins and len(urls) > 1:
+            # if nothing responds, fall back to trying (and retrying) them all
+            urls = self._probe(urls) or urls
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                print("(retrying clone in %d sec) " % delay, end='', file=sys.stderr)
+                time.sleep(delay)
+
+            url = self._clone_from(urls, productdir, args, env)
+            if url is not None:
+                self._remember_origin(product, url)
+                return url
+
+        raise Exception("Failed to clone product '%s' from any of the offered repositories" % product)
+
     def fetch(self, product):
         """ Clone the product repository and checkout the first matching ref.
 
@@ -247,16 +680,27 @@ class ProductFetcher(object):
         Next, attempts to check out the refs listed in self.ref,
         until the first one succeeds.
 
-        """
+        If the product's clone policy is shallow, only the tips of the
+        candidate refs are fetched; if a branch is checked out, the history
+        is deepened until it describes HEAD as a full clone would (see
+        `_deepen_to_tag`).
 
+        The clone is locked while it is fetched (see `productLock`).
+        """
         t0 = time.time()
         sys.stderr.write("%20s: " % product)
 
         productdir = os.path.join(self.build_dir, product)
-        git = Git(productdir)
+        with productLock(self.build_dir, product):
+            self._remove_git_locks(productdir)
+            ref, sha1 = self._fetch(product, productdir)
 
-        # lfs credential helper string
-        helper = '!f() { cat > /dev/null; echo username=; echo password=; }; f'
+        print(" ok (%.1f sec)." % (time.time() - t0), file=sys.stderr)
+        return ref, sha1
+
+    def _fetch(self, product, productdir):
+        """ Fetch the product into productdir, with the clone locked (see `fetch`). """
+        git = Git(productdir)
 
         # determine if the repo is likely using lfs.
         # if the repos.yaml url is invalid, and a valid pattern generated
@@ -264,53 +708,58 @@ class ProductFetcher(object):
         # for that repo (if it needs it or not).  This should not break non-lfs
         # repos.
         lfs = self._origin_uses_lfs(product)
+        clone_filter, shallow = self._clone_policy(product)
+
+        # check out lfs pointer files, and then pull all objects at once (see `_lfs_config`)
+        env = LFS_SKIP_SMUDGE if lfs else None
 
         # verify the URL of origin hasn't changed
         if os.path.isdir(productdir):
             origin = git('config', '--get', 'remote.origin.url')
             if origin not in self._origin_candidates(product):
                 shutil.rmtree(productdir)
+            elif lfs:
+                # bring clones made by older versions of lsst-build up to date
+                for key, value in self._lfs_config():
+                    git('config', key, value)
 
         # clone
         if not os.path.isdir(productdir):
-            for url in self._origin_candidates(product):
-                args = []
-                if lfs:
-                    # need to work around git-lfs v1.0.0 always prompting
-                    # for credentials, even when they are not required.
-                    # migration to the batch API is required to resolved this:
-                    # https://github.com/github/git-lfs/issues/737#issuecomment-149689914
-
-                    # these env vars shouldn't have to removed with the cache
-                    # helper we are specifying but it doesn't hurt to be
-                    # paranoid
-                    if 'GIT_ASKPASS' in os.environ:
-                        del os.environ['GIT_ASKPASS']
-                    if 'SSH_ASKPASS' in os.environ:
-                        del os.environ['SSH_ASKPASS']
-
-                    # lfs will pickup the .gitconfig and pull lfs objects for
-                    # the default ref during clone.  Config options set on the
-                    # cli during the clone get recorded in `.git/config'
-                    args += ['-c', 'lfs.batch=false']
-                    args += ['-c', 'filter.lfs.required']
-                    args += ['-c', 'filter.lfs.smudge=git-lfs smudge %f']
-                    args += ['-c', 'filter.lfs.clean=git-lfs clean %f']
-                    args += ['-c', ('credential.helper=%s' % helper)]
-
-                args += [url, productdir]
-                if not Git.clone(*args, return_status=True)[1]:
-                        break
-            else:
-                raise Exception("Failed to clone product '%s' from any of the offered repositories" % product)
+            args = []
+            if lfs:
+                # these env vars shouldn't have to removed with the
+                # credential helper we are specifying but it doesn't
+                # hurt to be paranoid
+                if 'GIT_ASKPASS' in os.environ:
+                    del os.environ['GIT_ASKPASS']
+                if 'SSH_ASKPASS' in os.environ:
+                    del os.environ['SSH_ASKPASS']
+
+                # Config options set on the cli during the clone get
+                # recorded in `.git/config'.
+                for key, value in self._lfs_config():
+                    args += ['-c', '%s=%s' % (key, value)]
+
+            if clone_filter:
+                args += ['--filter=%s' % clone_filter]
+            if shallow:
+                args += ['--depth', '1', '--no-checkout']
+
+            self._clone(product, productdir, args, env)
 
         # update from origin
-        if not self.no_fetch:
+        refspecs = None
+        if not self.no_fetch and shallow:
+            refspecs = self._shallow_refspecs(git, product)
+            if refspecs:
+                self._network(git, 'fetch', '--depth=1', '-f', 'origin', *refspecs)
+        elif not self.no_fetch:
             # the line below should be equivalent to:
             #     git.fetch("origin", "--force", "--prune")
             #     git.fetch("origin", "--force", "--tags")
             # but avoids the overhead of two (possibly remote) git calls.
-            git.fetch("-fup", "origin", "+refs/heads/*:refs/heads/*", "refs/tags/*:refs/tags/*")
+            self._network(git, "fetch", "-fup", "origin",
+                          "+refs/heads/*:refs/heads/*", "refs/tags/*:refs/tags/*")
 
         # find a ref that matches, checkout it
         for ref in self._ref_candidates(product):
@@ -321,27 +770,39 @@ class ProductFetcher(object):
                 sha1, _ = git.rev_parse("-q", "--verify", "refs/tags/" + ref + "^0", return_status=True)
             if not sha1:
                 sha1, _ = git.rev_parse("-q", "--verify", "__dummy-g" + ref, return_status=True)
+            if not sha1 and refspecs is not None and re.match('^[0-9a-f]{7,40}$', ref):
+                # a commit not (yet) in the shallow clone; this requires
+                # the server to allow fetching of reachable SHA1s
+                if not git.fetch('--depth=1', 'origin', ref, return_status=True, timeout=self.timeout)[1]:
+                    sha1, _ = git.rev_parse("-q", "--verify", "__dummy-g" + ref, return_status=True)
             if not sha1:
                 continue
 
-            git.checkout("--force", ref)
+            git.checkout("--force", ref, env=env)
 
             if branch:
                 # profiling showed that git-pull took a lot of time; since
                 # we know we want the checked out branch to be at the remote sha1
                 # we'll just reset it
-                git.reset("--hard", sha1)
+                git.reset("--hard", sha1, env=env)
 
             assert(git.rev_parse("HEAD") == sha1)
             break
         else:
             raise Exception("None of the specified refs exist in product '%s'" % product)
 
+        # pkgautoversion needs the history up to the last tag to version a branch
+        if refspecs and branch:
+            self._deepen_to_tag(git, productdir, refspecs)
+
+        # download (in parallel) and check out the lfs objects of the checked out ref
+        if lfs:
+            self._network(git, 'lfs', 'pull')
+
         # clean up the working directory (eg., remove remnants of
         # previous builds)
         git.clean("-d", "-f", "-q", "-x")
 
-        print(" ok (%.1f sec)." % (time.time() - t0), file=sys.stderr)
         return ref, sha1
 
 
@@ -458,7 +919,8 @@ class VersionDbGit(VersionDbHash):
 
             self.added_entries = dict()	 # (version, suffix) -> [ (depName, depVersion) ]
 
-            self.dirty = False
+            self.dirty = False          # True if there are appended, but uncommitted, entries
+            self.offset = 0             # how much of the ver_db file has been loaded
 
         def __just_add(self, version, hash, suffix):
             assert isinstance(suffix, int)
@@ -497,16 +959,24 @@ class VersionDbGit(VersionDbHash):
                 for depName, depVersion in dependencies:
                     fileObjectDep.write("%s\t%d\t%s\t%s\n" % (version, suffix, depName, depVersion))
 
-            self.added_entries = []
-            self.dirty = False
+            self.added_entries = dict()
+            self.offset = fileObjectVer.tell()
 
-        @staticmethod
-        def fromFile(fileObject):
-            vm = VersionDbGit.VersionMap()
+        def load(self, fileObject):
+            # read the (version, hash, suffix) entries appended since the last load
+            fileObject.seek(self.offset)
             for line in iter(fileObject.readline, ''):
+                if not line.endswith('\n'):
+                    # partially written by a concurrent prepare; read it next time
+                    break
+                self.offset += len(line)
                 (version, hash, suffix) = line.strip().split()[:3]
-                vm.__just_add(version, hash, int(suffix))
+                self.__just_add(version, hash, int(suffix))
 
+        @staticmethod
+        def fromFile(fileObject):
+            vm = VersionDbGit.VersionMap()
+            vm.load(fileObject)
             return vm
 
     def __init__(self, dbdir, eupsObj):
@@ -525,14 +995,31 @@ class VersionDbGit(VersionDbHash):
     def __shafn(self):
         return os.path.join("manifests", 'content_sha.db.txt')
 
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive lock on the versiondb, shared with all other
+           lsst-build processes on this host.
+
+           Taken around +N suffix and build ID allocation, so that concurrent
+           prepares can use the same versiondb. It is not reentrant.
+        """
+        fd = os.open(os.path.join(self.dbdir, '.git', 'lsst-build.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
     def getSuffix(self, productName, productVersion, dependencies):
         hash = self._hash_dependencies(dependencies)
 
+        absverfn = os.path.join(self.dbdir, self.__verfn(productName))
+        absdepfn = os.path.join(self.dbdir, self.__depfn(productName))
+
         # Lazy-load/create
         try:
             vm = self.versionMaps[productName]
         except KeyError:
-            absverfn = os.path.join(self.dbdir, self.__verfn(productName))
             try:
                 vm = VersionDbGit.VersionMap.fromFile(open(absverfn))
             except IOError:
@@ -543,7 +1030,24 @@ class VersionDbGit(VersionDbHash):
         try:
             suffix = vm.suffix(productVersion, hash)
         except KeyError:
-            suffix = vm.new_suffix(productVersion, hash, dependencies)
+            # A concurrent prepare may have assigned a suffix to these
+            # dependencies since ver_db was loaded. Pick up its entries, and
+            # append ours right away (they're committed in commit()), all
+            # under the lock, so that no two prepares assign the same suffix.
+            with self.lock():
+                try:
+                    with open(absverfn) as fp:
+                        vm.load(fp)
+                except IOError:
+                    pass
+
+                try:
+                    suffix = vm.suffix(productVersion, hash)
+                except KeyError:
+                    suffix = vm.new_suffix(productVersion, hash, dependencies)
+                    with open(absverfn, 'a') as fpVer:
+                        with open(absdepfn, 'a') as fpDep:
+                            vm.appendAdditionsToFile(fpVer, fpDep)
 
         assert isinstance(suffix, int)
         if suffix == 0:
@@ -580,83 +1084,221 @@ class VersionDbGit(VersionDbHash):
 
                 return tag
 
+    def __commitFiles(self, git, paths, msg):
+        """Commit the given files (paths relative to dbdir) on top of HEAD.
+
+           Uses git plumbing, so that only the given files are hashed and no
+           other file in the working tree is stat-ed; the cost is
+           proportional to the number of changed files, not to the size of
+           the repository.
+
+           Returns:
+               str. the SHA1 of the new commit.
+        """
+        head, retcode = git.rev_parse('--verify', '-q', 'HEAD', return_status=True)
+        parents = ['-p', head] if not retcode else []
+
+        git('update-index', '--add', '--', *paths)
+        tree = git('write-tree')
+        commit = git('commit-tree', tree, '-m', msg, *parents)
+
+        # compare-and-swap: fails if HEAD moved since we looked
+        git('update-ref', '-m', 'commit: %s' % msg, 'HEAD', commit, head if not retcode else '')
+
+        return commit
+
     def commit(self, manifest, build_id):
+        # The build ID is reserved by tagging it, so hold the lock until then
+        with self.lock():
+            self.__commit(manifest, build_id)
+
+    def __commit(self, manifest, build_id):
         git = Git(self.dbdir)
 
         manifestSha = manifest.content_hash()
         manifest.buildID = self.__getBuildId(manifest, manifestSha) if build_id is None else build_id
 
-        # Write files
-        for (productName, vm) in self.versionMaps.iteritems():
-            if not vm.dirty:
-                continue
-
-            verfn = self.__verfn(productName)
-            depfn = self.__depfn(productName)
-            absverfn = os.path.join(self.dbdir, verfn)
-            absdepfn = os.path.join(self.dbdir, depfn)
-
-            with open(absverfn, 'a') as fpVer:
-                with open(absdepfn, 'a') as fpDep:
-                    vm.appendAdditionsToFile(fpVer, fpDep)
-
-            git.add(verfn, depfn)
+        # The ver_db/dep_db entries were appended by getSuffix(); committing
+        # the files as they are now also picks up (merges) any entries appended
+        # by concurrent prepares.
+        changed = []
+        dirty = [(productName, vm) for (productName, vm) in self.versionMaps.iteritems() if vm.dirty]
+        for (productName, vm) in dirty:
+            changed += [self.__verfn(productName), self.__depfn(productName)]
 
         # Store a copy of the manifest
         manfn = os.path.join('manifests', "%s.txt" % manifest.buildID)
         absmanfn = os.path.join(self.dbdir, manfn)
         with open(absmanfn, 'w') as fp:
             manifest.toFile(fp)
+        changed.append(manfn)
 
         if git.tag("-l", manifest.buildID) == manifest.buildID:
-            # If the buildID/manifest are being reused, VersionDB repository must be clean
-            if git.describe('--always', '--dirty=-prljavonakraju').endswith("-prljavonakraju"):
+            # If the buildID/manifest are being reused, the files we've written must
+            # match the committed ones (only those paths are checked, to avoid
+            # stat-ing the whole VersionDB working tree)
+            _, retcode = git('diff', '--quiet', 'HEAD', '--', *changed, return_status=True)
+            if retcode:
                 raise Exception("Trying to reuse the buildID, but the versionDB repository is dirty!")
         else:
-            # add the manifest file
-            git.add(manfn)
-
             # add the new manifest<->buildID mapping
             shafn = self.__shafn()
             absshafn = os.path.join(self.dbdir, shafn)
             with open(absshafn, 'a+') as fp:
                 fp.write("%s\t%s\n" % (manifestSha, manifest.buildID))
-            git.add(shafn)
+            changed.append(shafn)
 
-            # git-commit
+            # commit
             msg = "Updates for build %s." % manifest.buildID
-            git.commit('-m', msg)
+            commit = self.__commitFiles(git, changed, msg)
 
             # git-tag
             msg = "Build ID %s" % manifest.buildID
-            git.tag('-a', '-m', msg, manifest.buildID)
+            git.tag('-a', '-m', msg, manifest.buildID, commit)
+
+            for (productName, vm) in dirty:
+                vm.dirty = False
+
+        # Keep the query index in sync; it can always be rebuilt, so failing to
+        # update it must not fail the build.
+        try:
+            ManifestIndex(self.dbdir).update()
+        except (sqlite3.Error, EnvironmentError) as e:
+            print("warning: failed to update the versiondb query index: %s" % e, file=sys.stderr)
 
 
 class ExclusionResolver(object):
     """A class to determine whether a dependency should be excluded from
        build for a product, based on matching against a list of regular
        expression rules.
+
+       The dependency regexes of all rules applicable to a product are
+       compiled into alternations of up to `max_groups` groups, so each
+       dependency is matched in a few passes; the decisions are memoized.
+       Rules that can't be combined (with inline flags or back-references)
+       are matched one by one, in their turn.
     """
+
+    # Python 2's re supports at most 100 groups per regex (including group 0)
+    max_groups = 99
+
     def __init__(self, exclusion_patterns):
+        self.patterns = [tuple(p) for p in exclusion_patterns]
         self.exclusions = [
-            (re.compile(dep_re), re.compile(prod_re)) for (dep_re, prod_re) in exclusion_patterns
+            (re.compile(dep_re), re.compile(prod_re)) for (dep_re, prod_re) in self.patterns
         ]
 
+        self._product_matchers = dict()     # product -> [(combined regex or None, [(group, rule index)])]
+        self._decisions = dict()            # (dep, product) -> rule index or None
+
+    @staticmethod
+    def _combinable(pattern):
+        # inline flags (e.g., '(?i)') would apply to all alternatives, and
+        # back-references would refer to the wrong groups
+        return not re.search(r'\\[1-9]|\(\?P=|\(\?[aiLmsux-]+[:)]', pattern)
+
+    def _combine(self, rules):
+        """ Return the (combined regex, [(group, rule index)]) matchers of the given rules """
+        if len(rules) == 1:
+            return [(None, [(None, rules[0])])]
+
+        # wrap each rule's regex into a group, remembering its index so
+        # the matching rule can be identified
+        groups = []
+        group = 1
+        for i in rules:
+            groups.append((group, i))
+            group += 1 + self.exclusions[i][0].groups
+        try:
+            return [(re.compile('|'.join('(%s)' % self.patterns[i][0] for i in rules)), groups)]
+        except (re.error, AssertionError):
+            # (e.g., duplicate group names); match rule by rule
+            return [(None, [(None, i)]) for i in rules]
+
+    def _matcher(self, product):
+        """ Return the list of (combined regex, [(group, rule index)]) matchers of the rules
+            applicable to product, in rule order; a regex of None stands for the single rule
+            given, to be matched on its own.
+        """
+        try:
+            return self._product_matchers[product]
+        except KeyError:
+            pass
+
+        matcher = []
+        chunk, ngroups = [], 0
+        for i, (dep_re, prod_re) in enumerate(self.exclusions):
+            if not prod_re.match(product):
+                continue
+
+            n = 1 + dep_re.groups
+            if not self._combinable(self.patterns[i][0]) or n > self.max_groups:
+                if chunk:
+                    matcher += self._combine(chunk)
+                    chunk, ngroups = [], 0
+                matcher.append((None, [(None, i)]))
+                continue
+
+            if ngroups + n > self.max_groups:
+                matcher += self._combine(chunk)
+                chunk, ngroups = [], 0
+            chunk.append(i)
+            ngroups += n
+        if chunk:
+            matcher += self._combine(chunk)
+
+        self._product_matchers[product] = matcher
+        return matcher
+
+    def excluding_rule(self, dep, product):
+        """ Return the index of the rule excluding dependency 'dep' for product 'product', or None """
+        key = (dep, product)
+        try:
+            return self._decisions[key]
+        except KeyError:
+            pass
+
+        rule = None
+        for combined, groups in self._matcher(product):
+            if combined is None:
+                i = groups[0][1]
+                if self.exclusions[i][0].match(dep):
+                    rule = i
+                    break
+            else:
+                m = combined.match(dep)
+                if m:
+                    rule = next(i for group, i in groups if m.group(group) is not None)
+                    break
+
+        self._decisions[key] = rule
+        return rule
+
     def is_excluded(self, dep, product):
         """ Check if dependency 'dep' is excluded for product 'product' """
-        try:
-            rc = self._exclusion_regex_cache
-        except AttributeError:
-            rc = self._exclusion_regex_cache = dict()
+        return self.excluding_rule(dep, product) is not None
 
-        if product not in rc:
-            rc[product] = [dep_re for (dep_re, prod_re) in self.exclusions if prod_re.match(product)]
+    def filter_dependencies(self, product, deps):
+        """ Split the dependency names in deps into those kept and those excluded for product.
 
-        for dep_re in rc[product]:
-            if dep_re.match(dep):
-                return True
+            Args:
+                product (str): the product whose dependencies are filtered
+                deps (list): dependency names
 
-        return False
+            Returns:
+                (kept, excluded) tuple, where kept is the list of dependencies
+                that aren't excluded, and excluded a list of (dep, (dep_re, prod_re))
+                tuples giving the rule excluding each of the other ones.
+        """
+        kept, excluded = [], []
+        for dep in deps:
+            rule = self.excluding_rule(dep, product)
+            if rule is None:
+                kept.append(dep)
+            else:
+                excluded.append((dep, self.patterns[rule]))
+
+        return kept, excluded
 
     @staticmethod
     def fromFile(fileObject):
@@ -684,6 +1326,8 @@ class BuildDirectoryConstructor(object):
         self.version_db = version_db
         self.exclusion_resolver = exclusion_resolver
 
+        self.excluded = []  # (product, dependency, (dep_re, prod_re)) for each excluded dependency
+
     def _add_product_tree(self, products, productName):
         if productName in products:
             return products[productName]
@@ -696,12 +1340,18 @@ class BuildDirectoryConstructor(object):
         productdir = os.path.join(self.build_dir, productName)
         table_fn = os.path.join(productdir, 'ups', '%s.table' % productName)
         if os.path.isfile(table_fn):
-            # Prepare the non-excluded dependencies
-            for dep in eups.table.Table(table_fn).dependencies(self.eups):
-                (dprod, doptional) = dep[0:2]
+            deps = [dep[0:2] for dep in eups.table.Table(table_fn).dependencies(self.eups)]
+
+            # Find the excluded optional dependencies
+            optional = [dprod.name for (dprod, doptional) in deps if doptional]
+            _, excluded = self.exclusion_resolver.filter_dependencies(productName, optional)
+            self.excluded += [(productName, dep, rule) for (dep, rule) in excluded]
+            excluded = set(dep for (dep, _) in excluded)
 
+            # Prepare the non-excluded dependencies
+            for (dprod, doptional) in deps:
                 # skip excluded optional products, and implicit products
-                if doptional and self.exclusion_resolver.is_excluded(dprod.name, productName):
+                if doptional and dprod.name in excluded:
                     continue
                 if dprod.name == "implicitProducts":
                     continue
@@ -715,15 +1365,30 @@ class BuildDirectoryConstructor(object):
         products[productName] = Product(productName, sha1, version, dependencies)
         return products[productName]
 
+    def writeExclusionReport(self, fileObject):
+        """ Write out which dependencies were excluded, and by which exclusion map rule """
+        header = ("product", "excluded dependency", "dependency regex", "product regex")
+        print('# %-23s %-25s %-20s %s' % header, file=fileObject)
+        for (product, dep, (dep_re, prod_re)) in self.excluded:
+            print('%-25s %-25s %-20s %s' % (product, dep, dep_re, prod_re), file=fileObject)
+
     def construct(self, productNames):
         products = dict()
+        self.excluded = []
         for name in productNames:
             self._add_product_tree(products, name)
 
         return Manifest.fromProductDict(products)
 
     @staticmethod
-    def run(args):
+    def run(args, cache=None):
+        """Run `lsst-build prepare'.
+
+            Args:
+                args: the parsed command line arguments
+                cache: a `cache.WarmCache` with objects kept from previous runs
+                    (when running as a daemon), or None
+        """
         #
         # Ensure build directory exists and is writable
         #
@@ -733,23 +1398,44 @@ class BuildDirectoryConstructor(object):
 
         refs = args.ref
 
+        if cache is None:
+            cache = NullCache()
+
         #
         # Wire-up the BuildDirectoryConstructor constructor
         #
-        eupsObj = eups.Eups()
+        eupsPath = os.environ.get("EUPS_PATH", "")
+        eupsObj = cache.get(('eups', eupsPath), eupsDatabaseFiles(eupsPath), eups.Eups)
 
         if args.exclusion_map:
-            with open(args.exclusion_map) as fp:
-                exclusion_resolver = ExclusionResolver.fromFile(fp)
+            def loadExclusionMap():
+                with open(args.exclusion_map) as fp:
+                    return ExclusionResolver.fromFile(fp)
+            fn = os.path.abspath(args.exclusion_map)
+            exclusion_resolver = cache.get(('exclusion_map', fn), [fn], loadExclusionMap)
         else:
             exclusion_resolver = ExclusionResolver([])
 
         if args.version_git_repo:
-            version_db = VersionDbGit(args.version_git_repo, eupsObj)
+            dbdir = os.path.abspath(args.version_git_repo)
+            version_db = cache.get(('versiondb', dbdir, eupsPath),
+                                   gitStateFiles(dbdir) + eupsDatabaseFiles(eupsPath),
+                                   lambda: VersionDbGit(dbdir, eupsObj))
         else:
             version_db = VersionDbHash(args.sha_abbrev_len, eupsObj)
 
-        product_fetcher = ProductFetcher(build_dir, args.repos, args.repository_pattern, refs, args.no_fetch)
+        if args.repos:
+            fn = os.path.abspath(args.repos)
+            repos = cache.get(('repos', fn), [fn], lambda: ProductFetcher.loadRepos(args.repos, build_dir))
+        else:
+            repos = None
+
+        product_fetcher = ProductFetcher(build_dir, repos, args.repository_pattern, refs, args.no_fetch,
+                                         clone_filter=args.clone_filter, shallow=args.shallow,
+                                         lfs_concurrency=args.lfs_concurrency,
+                                         lfs_cache_dir=args.lfs_cache_dir,
+                                         timeout=args.git_timeout, retries=args.git_retries,
+                                         hedge=args.hedge, origins_fn=args.origins_cache)
         p = BuildDirectoryConstructor(build_dir, eupsObj, product_fetcher, version_db, exclusion_resolver)
 
         #
@@ -765,15 +1451,183 @@ class BuildDirectoryConstructor(object):
         with open(manifestFn, 'w') as fp:
             manifest.toFile(fp)
 
+        # For auditing, list the excluded dependencies in build_dir/excluded.txt
+        with open(os.path.join(build_dir, 'excluded.txt'), 'w') as fp:
+            p.writeExclusionReport(fp)
 
-class RepoSpec:
+
+class RepoSpec(object):
     """Represents a git repo specification in repos.yaml. """
 
-    def __init__(self, product, url, ref='master', lfs=False):
+    __slots__ = ('product', 'url', 'ref', 'lfs', 'clone_filter', 'shallow')
+
+    # repos.yaml key -> allowed value types
+    keys = {
+        'url': (str,),
+        'ref': (str,),
+        'lfs': (bool,),
+        'clone_filter': (str,),
+        'shallow': (bool,),
+    }
+
+    def __init__(self, product, url, ref='master', lfs=False, clone_filter=None, shallow=None):
         self.product = product
         self.url = url
         self.ref = ref
         self.lfs = lfs
+        self.clone_filter = clone_filter
+        self.shallow = shallow
 
     def __str__(self):
         return self.url
+
+    def toList(self):
+        return [self.url, self.ref, self.lfs, self.clone_filter, self.shallow]
+
+    @staticmethod
+    def fromList(product, arr):
+        url, ref, lfs, clone_filter, shallow = arr
+        return RepoSpec(intern(str(product)), str(url), intern(str(ref)), lfs,
+                        str(clone_filter) if clone_filter is not None else None, shallow)
+
+
+class ReposYamlError(Exception):
+    """Raised when repos.yaml fails validation; lists every invalid entry."""
+
+    def __init__(self, fn, errors):
+        self.fn = fn
+        self.errors = errors
+        Exception.__init__(self, "invalid repos.yaml file '%s':\n%s" % (
+            fn, '\n'.join('  %s: %s' % (product, err) for product, err in errors)))
+
+
+class ReposIndex(object):
+    """A validated, compiled index of repos.yaml product -> `RepoSpec` entries
+
+       Parsing and validating a large repos.yaml is costly, so the compiled
+       index can be cached in a JSON file (repos.index.json) in a cache
+       directory; `BuildDirectoryConstructor` uses the build directory. The
+       cached index is used if it was compiled from the same repos.yaml path,
+       and the modification time and size of repos.yaml match the ones
+       recorded in it, or failing that, if its SHA1 does.
+
+       :ivar specs: product name -> `RepoSpec` dict
+    """
+
+    version = 2
+
+    def __init__(self, specs):
+        self.specs = specs
+
+    def get(self, product):
+        """ Return the `RepoSpec` for product, or None if there isn't one. """
+        return self.specs.get(product)
+
+    def __contains__(self, product):
+        return product in self.specs
+
+    def __len__(self):
+        return len(self.specs)
+
+    @staticmethod
+    def fromDict(repos, fn='<repos.yaml>'):
+        """ Validate and compile the dict loaded from repos.yaml.
+
+            Each entry is either a URL string, or a dict with a mandatory
+            'url' and optional 'ref', 'lfs', 'clone_filter' and 'shallow' keys.
+            Raises `ReposYamlError` listing all invalid entries.
+        """
+        if repos is None:
+            repos = dict()
+        if not isinstance(repos, dict):
+            raise ReposYamlError(fn, [('<top level>', 'expected a map of product names to repositories')])
+
+        specs = dict()
+        errors = []
+        for product, spec in repos.items():
+            product = str(product)
+            if isinstance(spec, str):
+                spec = {'url': spec}
+            elif not isinstance(spec, dict):
+                errors.append((product, "expected a URL or a map, got '%s'" % (spec,)))
+                continue
+
+            ok = True
+            for key, value in spec.items():
+                if key not in RepoSpec.keys:
+                    errors.append((product, "unknown key '%s'" % key))
+                    ok = False
+                elif not isinstance(value, RepoSpec.keys[key]):
+                    errors.append((product, "invalid value '%s' for key '%s'" % (value, key)))
+                    ok = False
+            if 'url' not in spec:
+                errors.append((product, "missing 'url'"))
+                ok = False
+
+            if ok:
+                specs[product] = RepoSpec.fromList(product, RepoSpec(product, **spec).toList())
+
+        if errors:
+            raise ReposYamlError(fn, sorted(errors))
+
+        return ReposIndex(specs)
+
+    @staticmethod
+    def fromFile(fn, cache_dir=None):
+        """ Load the index for repos.yaml file fn, from the cache in cache_dir if it is up to date. """
+        st = os.stat(fn)
+        path = os.path.abspath(fn)
+        cachefn = os.path.join(cache_dir, 'repos.index.json') if cache_dir is not None else None
+
+        cached = None
+        if cachefn is not None:
+            try:
+                with open(cachefn) as fp:
+                    cached = json.load(fp)
+                if cached['version'] != ReposIndex.version or cached['path'] != path:
+                    cached = None
+            except (IOError, OSError, ValueError, KeyError):
+                cached = None
+
+        with open(fn, 'rb') as fp:
+            data = None
+            if cached is None or cached['mtime'] != st.st_mtime or cached['size'] != st.st_size:
+                data = fp.read()
+                sha1 = hashlib.sha1(data).hexdigest()
+            else:
+                sha1 = cached['sha1']
+
+        if cached is not None and cached['sha1'] == sha1:
+            index = ReposIndex(dict((product, RepoSpec.fromList(product, arr))
+                                    for product, arr in cached['specs'].items()))
+            if data is None:
+                return index
+        else:
+            try:
+                repos = yaml.safe_load(data)
+            except yaml.YAMLError as e:
+                raise ReposYamlError(fn, [('<file>', str(e))])
+            index = ReposIndex.fromDict(repos, fn)
+
+        if cachefn is None:
+            return index
+
+        # (re)write the cache; failing to do so only costs speed
+        cached = {
+            'version': ReposIndex.version,
+            'path': path,
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'sha1': sha1,
+            'specs': dict((product, spec.toList()) for product, spec in index.specs.items()),
+        }
+        try:
+            tmp = '%s.%d' % (cachefn, os.getpid())
+            with open(tmp, 'w') as fp:
+                json.dump(cached, fp)
+            os.rename(tmp, cachefn)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EROFS, errno.EPERM):
+                raise
+
+        return index
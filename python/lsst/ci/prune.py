@@ -0,0 +1,174 @@
+from __future__ import print_function
+from __future__ import absolute_import
+#############################################################################
+# Build directory garbage collector
+
+import os
+import re
+import sys
+import collections
+import glob
+import shutil
+
+from .prepare import Manifest, productLock
+from .logarchive import LogArchive, installLog
+
+# Files left in a product's build directory by a build
+BUILD_LOGS = ('_build.prep.log', '_build.log', '_build.tests.log')
+
+# The eupspkg commands traced in build logs, naming the product and version built
+EUPSPKG_RE = re.compile(r'\+ eupspkg PRODUCT=(\S+) VERSION=(\S+) ')
+
+
+def logVersion(logfile, name):
+    """Return the version of product name that logfile is a build log of, or
+       None if the log doesn't say.
+    """
+    with open(logfile) as fp:
+        for line in fp:
+            m = EUPSPKG_RE.search(line)
+            if m and m.group(1) == name:
+                return m.group(2)
+    return None
+
+
+def formatSize(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'T'
+    return ("%d%s" if unit == 'B' else "%.1f%s") % (size, unit)
+
+
+def treeSize(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class GarbageCollector(object):
+    """Remove what a build directory no longer needs (`lsst-build gc`).
+
+       The clones (and incremental build worktrees) of products that are not
+       in the build directory's current manifest are removed, along with the
+       _build.* files in them. The build logs found are first stored in the
+       log archive, if one is given, under the version they were written for
+       (which may be older than the manifest's); logs that don't name their
+       version are stored under the manifest's version, or '-' for removed
+       products. Products being fetched by a concurrent `lsst-build prepare`
+       (i.e., whose lock is held, see `productLock`) are skipped.
+
+       `compressInstalledLogs` archives the uncompressed _build.log and
+       _build.tests.log files of products installed into the given stacks
+       (by older versions of lsst-build), and replaces them with compressed
+       copies.
+
+       :ivar build_dir: the build directory
+       :ivar manifest: its current `Manifest`
+       :ivar archive: a `LogArchive`, or None
+       :ivar dry_run: if True, only report what would be removed
+    """
+
+    def __init__(self, build_dir, manifest, archive=None, dry_run=False, out=sys.stdout):
+        self.build_dir = build_dir
+        self.manifest = manifest
+        self.archive = archive
+        self.dry_run = dry_run
+        self.out = out
+        self.freed = 0
+
+    def _archive_logs(self, productdir, name, version):
+        if self.archive is None or self.dry_run:
+            return
+        for fn in BUILD_LOGS:
+            logfile = os.path.join(productdir, fn)
+            if os.path.isfile(logfile):
+                self.archive.add(logfile, name, logVersion(logfile, name) or version)
+
+    def _remove(self, path, what):
+        size = treeSize(path)
+        print("%s %s (%s)" % ("would remove" if self.dry_run else "removing", what, formatSize(size)),
+              file=self.out)
+        if not self.dry_run:
+            shutil.rmtree(path)
+        self.freed += size
+
+    def unreferenced(self):
+        """Return the names of products not in the manifest, and the paths of
+           their worktrees and clones (the worktrees first), as a list of
+           (name, [path, ...]) tuples
+        """
+        res = collections.OrderedDict()
+        for top in (os.path.join(self.build_dir, '_incremental'), self.build_dir):
+            if not os.path.isdir(top):
+                continue
+            for name in sorted(os.listdir(top)):
+                path = os.path.join(top, name)
+                if name in self.manifest.products or not os.path.exists(os.path.join(path, '.git')):
+                    continue
+                res.setdefault(name, []).append(path)
+        return sorted(res.items())
+
+    def prune(self):
+        """Archive the logs of all products, and remove the clones of unreferenced ones"""
+        for name, paths in self.unreferenced():
+            with productLock(self.build_dir, name, wait=False) as locked:
+                if not locked:
+                    print("skipping %s (being fetched)" % name, file=self.out)
+                    continue
+                for path in paths:
+                    self._archive_logs(path, name, '-')
+                    self._remove(path, os.path.relpath(path, self.build_dir))
+
+        for product in self.manifest.products.values():
+            for path in (os.path.join(self.build_dir, product.name),
+                         os.path.join(self.build_dir, '_incremental', product.name)):
+                self._archive_logs(path, product.name, product.version)
+
+    def compressInstalledLogs(self, eups_paths):
+        """Replace the uncompressed build logs of products installed into eups_paths with compressed ones"""
+        for path in eups_paths:
+            # <EUPS_PATH>/<flavor>/<product>/<version>/_build.log
+            for fn in BUILD_LOGS[1:]:
+                for logfile in sorted(glob.glob(os.path.join(path, '*', '*', '*', fn))):
+                    installdir = os.path.dirname(logfile)
+                    name, version = installdir.split(os.sep)[-2:]
+                    size = os.path.getsize(logfile)
+                    if self.dry_run:
+                        print("would compress %s (%s)" % (logfile, formatSize(size)), file=self.out)
+                        self.freed += size
+                        continue
+
+                    if self.archive is not None:
+                        self.archive.add(logfile, name, version)
+                    gzfn = installLog(logfile, installdir)
+                    os.unlink(logfile)
+                    self.freed += size - os.path.getsize(gzfn)
+
+    @staticmethod
+    def run(args, cache=None):
+        build_dir = args.build_dir
+        manifest = Manifest.load(os.path.join(build_dir, 'manifest.txt'))
+
+        archive = LogArchive(args.log_archive) if args.log_archive else None
+        gc = GarbageCollector(build_dir, manifest, archive, args.dry_run)
+        gc.prune()
+
+        if args.installed_logs:
+            eups_paths = [p for p in os.environ.get("EUPS_PATH", "").split(':') if p]
+            gc.compressInstalledLogs(eups_paths)
+
+        if archive is not None and args.keep_days is not None and not args.dry_run:
+            count, size = archive.expire(args.keep_days * 24 * 3600)
+            if count:
+                print("expired %d archived logs (%s)" % (count, formatSize(size)), file=gc.out)
+                gc.freed += size
+
+        print("%s %s" % ("would free" if args.dry_run else "freed", formatSize(gc.freed)), file=gc.out)
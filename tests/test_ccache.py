@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Test that each product's ccache hit rate comes from its own statistics
+# log, not from the counters of the cache shared with other builds.
+#
+# ccache is replaced by a stand-in script reporting the version given in
+# $FAKE_CCACHE_VERSION.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.build import CompilerCache                        # noqa: E402
+
+
+class CompilerCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.makedirs(bindir)
+        fn = os.path.join(bindir, 'ccache')
+        with open(fn, 'w') as fp:
+            fp.write(textwrap.dedent("""\
+                #!/bin/bash
+                [ "$1" != --version ] || echo "ccache version ${FAKE_CCACHE_VERSION:-4.9.1}"
+                """))
+        os.chmod(fn, 0o755)
+
+        self.oldEnv = dict(os.environ)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.oldEnv)
+        shutil.rmtree(self.tmpdir)
+
+    def testScript(self):
+        cache = CompilerCache(os.path.join(self.tmpdir, 'cache'))
+        self.assertTrue(cache.has_statslog)
+        script = cache.script('/build/prod', '/build/prod/_build.ccache.log')
+        self.assertIn('export CCACHE_STATSLOG=/build/prod/_build.ccache.log', script)
+        self.assertIn('export CCACHE_BASEDIR=/build/prod', script)
+
+    def testOldCcacheHasNoStatsLog(self):
+        os.environ['FAKE_CCACHE_VERSION'] = '3.7.12'
+        self.assertFalse(CompilerCache(os.path.join(self.tmpdir, 'cache')).has_statslog)
+
+    def testLogStats(self):
+        statslog = os.path.join(self.tmpdir, '_build.ccache.log')
+        self.assertEqual(CompilerCache.logStats(statslog), (0, 0))
+
+        with open(statslog, 'w') as fp:
+            fp.write(textwrap.dedent("""\
+                # /build/prod/src/a.cc
+                direct_cache_hit
+                # /build/prod/src/b.cc
+                cache_miss
+                # /build/prod/src/c.cc
+                preprocessed_cache_hit
+                # /build/prod/src/d.cc
+                cache_miss
+                # /build/prod/src/e.cc
+                direct_cache_hit
+                """))
+        self.assertEqual(CompilerCache.logStats(statslog), (3, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Test that the build script defers the unit tests of sconsUtils products
+# only, and runs those of other products right away.
+#
+# eupspkg is replaced by a stand-in script that records the $SCONSFLAGS it
+# was run with, and fails a unit test if asked to.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Product                             # noqa: E402
+from lsst.ci.build import Builder                               # noqa: E402
+
+
+class BuildCommandsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.makedirs(bindir)
+        fn = os.path.join(bindir, 'eupspkg')
+        with open(fn, 'w') as fp:
+            fp.write(textwrap.dedent("""\
+                #!/bin/bash
+                echo "SCONSFLAGS=$SCONSFLAGS" >> eupspkg.log
+                if [ -n "$FAIL_TESTS" ]; then
+                    mkdir -p tests/.tests && touch tests/.tests/test.failed
+                fi
+                """))
+        os.chmod(fn, 0o755)
+
+        self.productdir = os.path.join(self.tmpdir, 'prod')
+        os.makedirs(self.productdir)
+        self.oldEnv = dict(os.environ)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ.pop('SCONSFLAGS', None)
+
+        self.product = Product('prod', '0' * 40, '1.0', [])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.oldEnv)
+        shutil.rmtree(self.tmpdir)
+
+    def runBuild(self, deferred_tests):
+        builder = Builder(self.tmpdir, None, None, None, deferred_tests=deferred_tests)
+        if deferred_tests:
+            builder.tests = object()
+        script = '\n'.join(['set -e'] + builder._build_commands(self.product)) + '\n'
+        with open(os.devnull, 'w') as devnull:
+            retcode = subprocess.call(['bash', '-c', script], cwd=self.productdir, stdout=devnull)
+        with open(os.path.join(self.productdir, 'eupspkg.log')) as fp:
+            sconsflags = fp.read().strip()
+        deferred = os.path.exists(os.path.join(self.productdir, Builder.deferred_marker))
+        return retcode, sconsflags, deferred
+
+    def testSconsUtilsProduct(self):
+        open(os.path.join(self.productdir, 'SConstruct'), 'w').close()
+        retcode, sconsflags, deferred = self.runBuild(2)
+        self.assertEqual(retcode, 0)
+        self.assertEqual(sconsflags.split(), ['SCONSFLAGS='] + list(Builder.untested_targets))
+        self.assertTrue(deferred)
+
+    def testOtherProduct(self):
+        retcode, sconsflags, deferred = self.runBuild(2)
+        self.assertEqual(retcode, 0)
+        self.assertEqual(sconsflags, 'SCONSFLAGS=')
+        self.assertFalse(deferred)
+
+    def testOtherProductTestsFail(self):
+        os.environ['FAIL_TESTS'] = '1'
+        retcode, sconsflags, deferred = self.runBuild(2)
+        self.assertNotEqual(retcode, 0)
+        self.assertFalse(deferred)
+
+    def testStaleMarkerIsRemoved(self):
+        open(os.path.join(self.productdir, Builder.deferred_marker), 'w').close()
+        self.assertFalse(self.runBuild(2)[2])
+
+    def testTestsNotDeferred(self):
+        open(os.path.join(self.productdir, 'SConstruct'), 'w').close()
+        retcode, sconsflags, deferred = self.runBuild(0)
+        self.assertEqual(sconsflags, 'SCONSFLAGS=')
+        self.assertFalse(deferred)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Test that ExclusionResolver, which matches dependencies against chunks of
+# combined exclusion rules, decides as matching the rules one by one would.
+#
+from __future__ import print_function
+
+import os
+import re
+import sys
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import ExclusionResolver                   # noqa: E402
+
+
+def sequentialRule(rules, dep, product):
+    # the first rule, in file order, excluding dep for product
+    for i, (dep_re, prod_re) in enumerate(rules):
+        if prod_re.match(product) and dep_re.match(dep):
+            return i
+    return None
+
+
+class ExclusionResolverTestCase(unittest.TestCase):
+
+    def assertSequential(self, patterns, deps, products):
+        resolver = ExclusionResolver(patterns)
+        rules = [(re.compile(dep_re), re.compile(prod_re)) for dep_re, prod_re in patterns]
+        for product in products:
+            for dep in deps:
+                self.assertEqual(resolver.excluding_rule(dep, product),
+                                 sequentialRule(rules, dep, product), (dep, product))
+        return resolver
+
+    def testManyRules(self):
+        # more rules (and groups) than fit into one regex, some with groups
+        # of their own, matching overlapping sets of dependencies
+        patterns = []
+        for i in range(250):
+            if i % 3 == 0:
+                patterns.append(('dep%d$' % i, '.*'))
+            elif i % 3 == 1:
+                patterns.append(('(dep)(%d)(x)?$' % (i - 1), 'prod[0-4]'))
+            else:
+                patterns.append(('dep%d.*' % (i // 10), 'prod[5-9]'))
+        deps = ['dep%d' % i for i in range(260)] + ['dep%dx' % i for i in range(0, 260, 7)]
+        products = ['prod%d' % i for i in range(10)] + ['other']
+
+        resolver = self.assertSequential(patterns, deps, products)
+        matchers = resolver._matcher('prod0')
+        self.assertGreater(len(matchers), 1)
+        for combined, groups in matchers:
+            self.assertLessEqual(combined.groups, ExclusionResolver.max_groups)
+
+    def testUncombinableRules(self):
+        patterns = [
+            ('a.*', 'p'),
+            ('(?i)CASE.*', '.*'),               # inline flags
+            ('(x)\\1', '.*'),                   # back-reference
+            ('(?P<n>y)(?P=n)', '.*'),           # named back-reference
+            ('(?P<n>z)', '.*'),                 # same group name in two rules
+            ('(?P<n>w)', '.*'),
+            ('case', '.*'),
+            ('.*', 'catchall'),
+        ]
+        deps = ['abc', 'Case', 'casex', 'CASE', 'xx', 'xy', 'yy', 'z', 'w', 'b']
+        resolver = self.assertSequential(patterns, deps, ['p', 'q', 'catchall'])
+        self.assertTrue(resolver.is_excluded('Case', 'q'))
+        self.assertFalse(resolver.is_excluded('b', 'q'))
+
+    def testFilterDependencies(self):
+        resolver = ExclusionResolver.fromFile(StringIO(
+            "# dependency  product\n"
+            "\n"
+            "doxygen       .*\n"
+            "afw.*         base   # comment\n"
+        ))
+        kept, excluded = resolver.filter_dependencies('base', ['utils', 'doxygen', 'afwdata', 'geom'])
+        self.assertEqual(kept, ['utils', 'geom'])
+        self.assertEqual(excluded, [('doxygen', ('doxygen', '.*')), ('afwdata', ('afw.*', 'base'))])
+        self.assertEqual(resolver.filter_dependencies('utils', ['afwdata']), (['afwdata'], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Test that concurrent fetches of the same product are serialized, and that
+# an interrupted fetch doesn't leave the clone locked.
+#
+# The remote is a local repository, served by a git-upload-pack stand-in
+# that is as slow as $SLOW_UPLOAD_PACK seconds.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.git import Git, GitError                           # noqa: E402
+from lsst.ci.prepare import ProductFetcher                      # noqa: E402
+
+
+class FetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        realGit = subprocess.check_output(['sh', '-c', 'command -v git']).decode().strip()
+        fn = os.path.join(self.tmpdir, 'upload-pack')
+        with open(fn, 'w') as fp:
+            fp.write(textwrap.dedent("""\
+                #!/bin/bash
+                sleep ${SLOW_UPLOAD_PACK:-0}
+                exec %s upload-pack "$@"
+                """ % realGit))
+        os.chmod(fn, 0o755)
+
+        self.oldEnv = dict(os.environ)
+        os.environ.update({'GIT_CONFIG_COUNT': '1',
+                           'GIT_CONFIG_KEY_0': 'remote.origin.uploadpack',
+                           'GIT_CONFIG_VALUE_0': fn})
+
+        self.origin = os.path.join(self.tmpdir, 'origin')
+        os.makedirs(self.origin)
+        git = Git(self.origin)
+        git('-c', 'init.defaultBranch=master', 'init', '-q')
+        with open(os.path.join(self.origin, 'README'), 'w') as fp:
+            fp.write('test\n')
+        git.add('README')
+        git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'initial')
+        self.sha1 = git.rev_parse('HEAD')
+
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        os.makedirs(self.build_dir)
+        self.clonedir = os.path.join(self.build_dir, 'prod')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.oldEnv)
+        shutil.rmtree(self.tmpdir)
+
+    def fetcher(self, **kwargs):
+        return ProductFetcher(self.build_dir, None, 'file://' + self.tmpdir + '/origin', [], False, **kwargs)
+
+    def testConcurrentFetch(self):
+        os.environ['SLOW_UPLOAD_PACK'] = '1'
+        results, errors = [], []
+
+        def fetch():
+            try:
+                results.append(self.fetcher().fetch('prod'))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [('master', self.sha1)] * 3)
+        self.assertEqual(Git(self.clonedir).rev_parse('HEAD'), self.sha1)
+
+    def testTimedOutFetch(self):
+        self.fetcher().fetch('prod')
+
+        # a git command killed by the timeout leaves its lock files behind
+        os.environ['SLOW_UPLOAD_PACK'] = '10'
+        with open(os.path.join(self.clonedir, '.git', 'index.lock'), 'w'):
+            pass
+        with self.assertRaises(GitError):
+            self.fetcher(timeout=0.5).fetch('prod')
+
+        os.environ['SLOW_UPLOAD_PACK'] = '0'
+        self.assertEqual(self.fetcher().fetch('prod'), ('master', self.sha1))
+        self.assertFalse(os.path.exists(os.path.join(self.clonedir, '.git', 'index.lock')))
+
+    def testKilledFetch(self):
+        self.fetcher().fetch('prod')
+
+        # kill a prepare (and its git) while it fetches, holding the lock
+        os.environ['SLOW_UPLOAD_PACK'] = '10'
+        pid = os.fork()
+        if pid == 0:
+            os.setpgrp()
+            try:
+                self.fetcher().fetch('prod')
+            finally:
+                os._exit(0)
+        time.sleep(1)
+        os.killpg(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+        with open(os.path.join(self.clonedir, '.git', 'HEAD.lock'), 'w'):
+            pass
+
+        os.environ['SLOW_UPLOAD_PACK'] = '0'
+        t0 = time.time()
+        self.assertEqual(self.fetcher(timeout=5).fetch('prod'), ('master', self.sha1))
+        self.assertLess(time.time() - t0, 5)
+        self.assertFalse(os.path.exists(os.path.join(self.clonedir, '.git', 'HEAD.lock')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Test the sqlite query index over the versiondb: queries, and incremental
+# updates as manifests and dependency table entries are added.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.index import ManifestIndex                         # noqa: E402
+
+SHA1 = dict((c, c * 40) for c in 'abcdef')
+
+
+class ManifestIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+        for subdir in ('.git', 'manifests', 'dep_db'):
+            os.makedirs(os.path.join(self.dbdir, subdir))
+        with open(os.path.join(self.dbdir, 'manifests', 'content_sha.db.txt'), 'w') as fp:
+            fp.write('0123 b1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dbdir)
+
+    def writeManifest(self, build, products):
+        with open(os.path.join(self.dbdir, 'manifests', build + '.txt'), 'w') as fp:
+            print('# %-23s %-41s %-30s' % ("product", "SHA1", "Version"), file=fp)
+            print('BUILD=%s' % build, file=fp)
+            for name, sha1, version in products:
+                print('%-25s %-41s %s' % (name, SHA1[sha1], version), file=fp)
+
+    def appendDeps(self, product, text):
+        with open(os.path.join(self.dbdir, 'dep_db', product + '.txt'), 'a') as fp:
+            fp.write(text)
+
+    def testProducts(self):
+        self.writeManifest('b2', [('base', 'a', '1.0'), ('afw', 'b', '2.0+1')])
+        self.writeManifest('b10', [('base', 'a', '1.0'), ('afw', 'c', '2.1+1')])
+        self.writeManifest('b9', [('base', 'a', '1.0'), ('afw', 'b', '2.0+1')])
+        index = ManifestIndex(self.dbdir)
+        self.assertEqual(index.update(), 3)
+
+        # in build order, not in the order of the file names
+        self.assertEqual([row[0] for row in index.products(name='base')], ['b2', 'b9', 'b10'])
+        self.assertEqual(index.products(sha1='ccccc'), [('b10', 'afw', SHA1['c'], '2.1+1')])
+        self.assertEqual(index.products(name='afw', version='2.0+1', build='b9'),
+                         [('b9', 'afw', SHA1['b'], '2.0+1')])
+        self.assertEqual(len(index.products()), 6)
+        self.assertEqual(index.changes('afw'), [('b2', 'afw', SHA1['b'], '2.0+1'),
+                                                ('b10', 'afw', SHA1['c'], '2.1+1')])
+        self.assertEqual(index.changes('geom'), [])
+
+    def testIncrementalUpdate(self):
+        self.writeManifest('b1', [('base', 'a', '1.0')])
+        index = ManifestIndex(self.dbdir)
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.update(), 0)
+
+        # a new manifest, seen by another instance reading the same index
+        self.writeManifest('b2', [('base', 'd', '1.1')])
+        index = ManifestIndex(self.dbdir)
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.changes('base'), [('b1', 'base', SHA1['a'], '1.0'),
+                                                 ('b2', 'base', SHA1['d'], '1.1')])
+        self.assertEqual(len(index.products()), 2)
+
+    def testDependencies(self):
+        self.writeManifest('b1', [])
+        self.appendDeps('afw', "2.0 1 base 1.0\n2.0 1 utils 3.0\n")
+        index = ManifestIndex(self.dbdir)
+        index.update()
+        self.assertEqual(index.dependencies('afw', '2.0+1'), [(1, 'base', '1.0'), (1, 'utils', '3.0')])
+
+        # a partially written line is left for the next update
+        self.appendDeps('afw', "2.0 2 base 1.1\n2.0 2 uti")
+        index.update()
+        self.assertEqual(index.dependencies('afw', '2.0+2'), [(2, 'base', '1.1')])
+        self.appendDeps('afw', "ls 3.0\n")
+        index.update()
+        self.assertEqual(index.dependencies('afw', '2.0+2'), [(2, 'base', '1.1'), (2, 'utils', '3.0')])
+
+        # without a +N suffix, the dependencies of all suffixes
+        self.assertEqual([row[0] for row in index.dependencies('afw', '2.0')], [1, 1, 2, 2])
+        self.assertEqual(index.dependencies('afw', '2.0+3'), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+#
+# Test that git-lfs smudging is skipped only while prepare fetches a product,
+# and that the objects are then pulled, both into the clone and into the
+# worktrees (and scratch stages) lsst-build build creates.
+#
+# In LfsTestCase, git-lfs is replaced by a stand-in script recording how it
+# was invoked; git itself is wrapped to record whether GIT_LFS_SKIP_SMUDGE
+# was set. LfsServerTestCase runs the real git-lfs (if installed) against a
+# minimal LFS server implementing the batch API.
+#
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.git import Git                                     # noqa: E402
+from lsst.ci.prepare import Product, ProductFetcher, ReposIndex  # noqa: E402
+from lsst.ci.build import Builder, ScratchArea                  # noqa: E402
+
+
+def writeScript(fn, text):
+    with open(fn, 'w') as fp:
+        fp.write(textwrap.dedent(text))
+    os.chmod(fn, 0o755)
+
+
+class LfsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.calls = os.path.join(self.tmpdir, 'calls.txt')
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.makedirs(bindir)
+
+        realGit = subprocess.check_output(['sh', '-c', 'command -v git']).decode().strip()
+        writeScript(os.path.join(bindir, 'git'), """\
+            #!/bin/bash
+            echo "git ${GIT_LFS_SKIP_SMUDGE:-0} $1" >> %(calls)s
+            exec %(git)s "$@"
+            """ % {'calls': self.calls, 'git': realGit})
+
+        # `ls-files' lists the files named in .lfsfiles; `pull' replaces them with their content
+        writeScript(os.path.join(bindir, 'git-lfs'), """\
+            #!/bin/bash
+            echo "lfs ${GIT_LFS_SKIP_SMUDGE:-0} $1" >> %(calls)s
+            case "$1" in
+                ls-files) [ ! -f .lfsfiles ] || cat .lfsfiles ;;
+                pull) [ ! -f .lfsfiles ] || for f in $(cat .lfsfiles); do echo content > $f; done ;;
+            esac
+            """ % {'calls': self.calls})
+
+        self.oldEnv = dict(os.environ)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['EUPS_PATH'] = os.path.join(self.tmpdir, 'stack')
+        for var in ('GIT_LFS_SKIP_SMUDGE', 'GIT_DIR', 'GIT_WORK_TREE'):
+            os.environ.pop(var, None)
+
+        # the origin repository, with one (stand-in) lfs file
+        self.origin = os.path.join(self.tmpdir, 'origin')
+        os.makedirs(self.origin)
+        git = Git(self.origin)
+        git('-c', 'init.defaultBranch=master', 'init', '-q')
+        with open(os.path.join(self.origin, '.lfsfiles'), 'w') as fp:
+            fp.write('data.bin\n')
+        with open(os.path.join(self.origin, 'data.bin'), 'w') as fp:
+            fp.write('pointer\n')
+        git.add('.lfsfiles', 'data.bin')
+        git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'initial')
+        self.sha1 = git.rev_parse('HEAD')
+
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        os.makedirs(self.build_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.oldEnv)
+        shutil.rmtree(self.tmpdir)
+
+    def readCalls(self):
+        with open(self.calls) as fp:
+            calls = [line.split() for line in fp]
+        os.unlink(self.calls)
+        return calls
+
+    def fetch(self):
+        repos = ReposIndex.fromDict({'prod': {'url': self.origin, 'lfs': True}})
+        fetcher = ProductFetcher(self.build_dir, repos, None, [], False)
+        return fetcher.fetch('prod')
+
+    def testFetchSkipsSmudgeOnlyWhileFetching(self):
+        ref, sha1 = self.fetch()
+        self.assertEqual((ref, sha1), ('master', self.sha1))
+
+        calls = self.readCalls()
+        for cmd in ('clone', 'checkout', 'reset'):
+            self.assertIn(['git', '1', cmd], calls)
+        self.assertIn(['lfs', '0', 'pull'], calls)
+        self.assertNotIn(['lfs', '1', 'pull'], calls)
+
+        clonedir = os.path.join(self.build_dir, 'prod')
+        with open(os.path.join(clonedir, 'data.bin')) as fp:
+            self.assertEqual(fp.read(), 'content\n')
+
+        # the skipping must not be recorded in the clone's configuration
+        config = Git(clonedir)('config', '--get-regexp', r'^filter\.lfs\.')
+        self.assertNotIn('--skip', config)
+        self.assertIn('git-lfs smudge', config)
+
+    def testExistingClonesAreReconfigured(self):
+        self.fetch()
+        clonedir = os.path.join(self.build_dir, 'prod')
+        Git(clonedir)('config', 'filter.lfs.smudge', 'git-lfs smudge --skip -- %f')
+
+        self.fetch()
+        self.assertEqual(Git(clonedir)('config', '--get', 'filter.lfs.smudge'), 'git-lfs smudge -- %f')
+
+    def testIncrementalWorktreeIsPulled(self):
+        self.fetch()
+        self.readCalls()
+
+        builder = Builder(self.build_dir, None, None, None, incremental=True)
+        worktree = builder._product_dir(Product('prod', self.sha1, '1.0', []))
+        self.assertEqual(worktree, os.path.join(self.build_dir, '_incremental', 'prod'))
+
+        calls = self.readCalls()
+        self.assertIn(['git', '1', 'worktree'], calls)
+        self.assertIn(['lfs', '0', 'pull'], calls)
+        with open(os.path.join(worktree, 'data.bin')) as fp:
+            self.assertEqual(fp.read(), 'content\n')
+
+    def testStagedTreeIsPulled(self):
+        self.fetch()
+        self.readCalls()
+
+        scratch = ScratchArea(os.path.join(self.tmpdir, 'scratch'), self.build_dir)
+        scratch.setup()
+        clonedir = os.path.join(self.build_dir, 'prod')
+        stagedir = scratch.stage(Product('prod', self.sha1, '1.0', []), clonedir)
+        self.assertTrue(scratch.contains(stagedir))
+
+        calls = self.readCalls()
+        self.assertIn(['git', '1', 'worktree'], calls)
+        self.assertIn(['lfs', '0', 'pull'], calls)
+        with open(os.path.join(stagedir, 'data.bin')) as fp:
+            self.assertEqual(fp.read(), 'content\n')
+
+    def testPreppedTreeIsStaged(self):
+        self.fetch()
+        clonedir = os.path.join(self.build_dir, 'prod')
+        with open(os.path.join(clonedir, 'prepped.txt'), 'w') as fp:
+            fp.write('prepped\n')
+
+        scratch = ScratchArea(os.path.join(self.tmpdir, 'scratch'), self.build_dir)
+        scratch.setup()
+        stagedir = scratch.stage(Product('prod', self.sha1, '1.0', []), clonedir, prepped=True)
+
+        for fn, content in (('prepped.txt', 'prepped\n'), ('data.bin', 'content\n')):
+            with open(os.path.join(stagedir, fn)) as fp:
+                self.assertEqual(fp.read(), content)
+        self.assertEqual(Git(stagedir).rev_parse('HEAD'), self.sha1)
+        self.assertEqual(Git(stagedir)('ls-files').split(), ['.lfsfiles', 'data.bin'])
+
+        scratch.release(stagedir, clonedir)
+        self.assertFalse(os.path.exists(stagedir))
+
+    def testNoPullWithoutLfsFiles(self):
+        self.assertFalse(Git(self.build_dir).lfs_pull_if_tracked())
+        self.assertNotIn(['lfs', '0', 'pull'], self.readCalls())
+
+
+def hasGitLfs():
+    with open(os.devnull, 'w') as devnull:
+        try:
+            return subprocess.call(['git', 'lfs', 'version'], stdout=devnull, stderr=devnull) == 0
+        except OSError:
+            return False
+
+
+class LfsServer(ThreadingMixIn, HTTPServer):
+    """A git-lfs server implementing the batch API (downloads only), for the
+       objects in the dict objects (sha256 -> content). Each object download
+       takes delay seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, objects, delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LfsRequestHandler)
+        self.objects = objects
+        self.delay = delay
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.batches = []       # the oids of each batch request
+        self.downloads = []     # the oids downloaded
+        self.running = 0
+        self.max_running = 0    # the maximum number of concurrent downloads
+
+
+class LfsRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body, contentType='application/vnd.git-lfs+json'):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        if self.path.strip('/') != 'objects/batch' or request.get('operation') != 'download':
+            return self._reply(404, b'{"message": "not found"}')
+
+        objects = []
+        for obj in request['objects']:
+            res = dict(oid=obj['oid'], size=obj['size'], authenticated=True)
+            if obj['oid'] in server.objects:
+                res['actions'] = dict(download=dict(href=server.url + 'objects/' + obj['oid']))
+            else:
+                res['error'] = dict(code=404, message='object not found')
+            objects.append(res)
+        with server.lock:
+            server.batches.append(sorted(obj['oid'] for obj in request['objects']))
+        self._reply(200, json.dumps(dict(transfer='basic', objects=objects)).encode('utf-8'))
+
+    def do_GET(self):
+        server = self.server
+        oid = self.path.rsplit('/', 1)[-1]
+        if oid not in server.objects:
+            return self._reply(404, b'{"message": "not found"}')
+
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.delay)
+        with server.lock:
+            server.running -= 1
+            server.downloads.append(oid)
+        self._reply(200, server.objects[oid], 'application/octet-stream')
+
+
+@unittest.skipIf(not hasGitLfs(), "git-lfs is not installed")
+class LfsServerTestCase(unittest.TestCase):
+
+    files = 12
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.oldEnv = dict(os.environ)
+        os.environ.update(HOME=self.tmpdir, GIT_CONFIG_NOSYSTEM='1')
+        for var in ('GIT_LFS_SKIP_SMUDGE', 'GIT_DIR', 'GIT_WORK_TREE'):
+            os.environ.pop(var, None)
+
+        self.contents = dict(('data%d.bin' % i, ('content %d\n' % i).encode('utf-8') * 1000)
+                             for i in range(self.files))
+        objects = dict((hashlib.sha256(content).hexdigest(), content) for content in self.contents.values())
+        self.server = LfsServer(objects, delay=0.2)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # the origin repository, with lfs pointers to the server's objects
+        self.origin = os.path.join(self.tmpdir, 'origin')
+        os.makedirs(self.origin)
+        git = Git(self.origin)
+        git('-c', 'init.defaultBranch=master', 'init', '-q')
+        files = {
+            '.gitattributes': '*.bin filter=lfs diff=lfs merge=lfs -text\n',
+            '.lfsconfig': '[lfs]\n\turl = %s\n' % self.server.url,
+        }
+        for fn, content in self.contents.items():
+            files[fn] = 'version https://git-lfs.github.com/spec/v1\noid sha256:%s\nsize %d\n' % (
+                hashlib.sha256(content).hexdigest(), len(content))
+        for fn, text in files.items():
+            with open(os.path.join(self.origin, fn), 'w') as fp:
+                fp.write(text)
+        git.add(*sorted(files))
+        git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'initial')
+
+        self.cache_dir = os.path.join(self.tmpdir, 'lfs-cache')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.clear()
+        os.environ.update(self.oldEnv)
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, build_dir):
+        os.makedirs(build_dir)
+        repos = ReposIndex.fromDict({'prod': {'url': self.origin, 'lfs': True}})
+        fetcher = ProductFetcher(build_dir, repos, None, [], False, lfs_concurrency=4,
+                                 lfs_cache_dir=self.cache_dir)
+        fetcher.fetch('prod')
+        return os.path.join(build_dir, 'prod')
+
+    def assertCheckedOut(self, clonedir):
+        for fn, content in self.contents.items():
+            with open(os.path.join(clonedir, fn), 'rb') as fp:
+                self.assertEqual(fp.read(), content)
+
+    def testBatchedParallelFetch(self):
+        clonedir = self.fetch(os.path.join(self.tmpdir, 'build'))
+        self.assertCheckedOut(clonedir)
+
+        # all objects were requested in one batch, and downloaded once, in parallel
+        oids = sorted(self.server.objects)
+        self.assertEqual(self.server.batches, [oids])
+        self.assertEqual(sorted(self.server.downloads), oids)
+        self.assertGreater(self.server.max_running, 1)
+        self.assertLessEqual(self.server.max_running, 4)
+
+        # ... into the shared storage
+        stored = set()
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            stored.update(filenames)
+        self.assertTrue(stored.issuperset(oids))
+
+        # later checkouts smudge (from the storage)
+        git = Git(clonedir)
+        self.assertEqual(git('config', '--get', 'filter.lfs.smudge'), 'git-lfs smudge -- %f')
+        self.assertEqual(git('config', '--get', 'lfs.concurrenttransfers'), '4')
+        os.unlink(os.path.join(clonedir, 'data0.bin'))
+        git.checkout('--', 'data0.bin')
+        self.assertCheckedOut(clonedir)
+        self.assertEqual(len(self.server.downloads), self.files)
+
+    def testSharedStorage(self):
+        self.fetch(os.path.join(self.tmpdir, 'build1'))
+        clonedir = self.fetch(os.path.join(self.tmpdir, 'build2'))
+        self.assertCheckedOut(clonedir)
+        self.assertEqual(len(self.server.downloads), self.files)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Test the content-addressed build log archive: deduplication, expiry, and
+# adding and expiring logs from several threads and processes at once.
+#
+from __future__ import print_function
+
+import os
+import gzip
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.logarchive import LogArchive                       # noqa: E402
+
+
+class LogArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archiveDir = os.path.join(self.tmpdir, 'archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeLog(self, name, text):
+        fn = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, 'w') as fp:
+            fp.write(text)
+        return fn
+
+    def readIndex(self):
+        with open(os.path.join(self.archiveDir, 'index.txt')) as fp:
+            return [tuple(line.split()[1:]) for line in fp]
+
+    def testAdd(self):
+        archive = LogArchive(self.archiveDir)
+        log1 = self.writeLog('a/_build.log', 'log\n')
+        log2 = self.writeLog('b/_build.log', 'log\n')
+
+        sha1 = archive.add(log1, 'a', '1.0')
+        self.assertEqual(archive.add(log1, 'a', '1.0'), sha1)
+        self.assertEqual(archive.add(log2, 'b', '2.0'), sha1)
+
+        # one object, and one index line per (log, product, version, name)
+        self.assertEqual(os.listdir(os.path.dirname(archive.path(sha1))), [sha1 + '.gz'])
+        with gzip.open(archive.path(sha1)) as fp:
+            self.assertEqual(fp.read(), b'log\n')
+        self.assertEqual(self.readIndex(), [(sha1, 'a', '1.0', '_build.log'),
+                                            (sha1, 'b', '2.0', '_build.log')])
+
+    def testExpire(self):
+        archive = LogArchive(self.archiveDir)
+        old = archive.add(self.writeLog('_build.log', 'old\n'), 'a', '1.0')
+        new = archive.add(self.writeLog('_build.tests.log', 'new\n'), 'a', '1.0')
+        past = time.time() - 3600
+        os.utime(archive.path(old), (past, past))
+
+        count, size = archive.expire(60)
+        self.assertEqual(count, 1)
+        self.assertGreater(size, 0)
+        self.assertFalse(os.path.exists(archive.path(old)))
+        self.assertEqual(self.readIndex(), [(new, 'a', '1.0', '_build.tests.log')])
+
+        # an expired log added again is indexed again
+        archive.add(os.path.join(self.tmpdir, '_build.log'), 'a', '1.0')
+        self.assertIn((old, 'a', '1.0', '_build.log'), self.readIndex())
+
+    def testConcurrentAddAndExpire(self):
+        # threads of this process and another process add logs while a third
+        # process keeps expiring old ones; no added entry may be lost
+        logs = [self.writeLog('logs/%d/_build.log' % i, 'log %d\n' % i) for i in range(40)]
+        expired = self.writeLog('expired.log', 'expired\n')
+        archive = LogArchive(self.archiveDir)
+        sha1 = archive.add(expired, 'x', '1.0')
+        past = time.time() - 3600
+        os.utime(archive.path(sha1), (past, past))
+
+        pids = []
+        for target in ('add', 'expire'):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    other = LogArchive(self.archiveDir)
+                    for logfile in logs:
+                        if target == 'add':
+                            other.add(logfile, 'other', '1.0')
+                        else:
+                            other.expire(60)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        def add(logfiles):
+            for logfile in logfiles:
+                archive.add(logfile, 'this', '1.0')
+
+        threads = [threading.Thread(target=add, args=(logs[i::4],)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        index = self.readIndex()
+        for product in ('this', 'other'):
+            entries = sorted(entry[0] for entry in index if entry[1] == product)
+            self.assertEqual(entries, sorted(LogArchive._hash(logfile) for logfile in logs))
+        for entry in index:
+            self.assertTrue(os.path.exists(archive.path(entry[0])))
+
+
+if __name__ == "__main__":
+    unittest.main()
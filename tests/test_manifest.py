@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Test the compact (binary) manifest format: it must round-trip the text
+# format exactly, and be told apart from it by Manifest.load.
+#
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Manifest                            # noqa: E402
+
+TEXT = """\
+BUILD=b1234
+base      aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa  1.0
+utils     bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb  2.0+1   base
+geom      cccccccccccccccccccccccccccccccccccccccc  1.0     base
+afw       dddddddddddddddddddddddddddddddddddddddd  4.0+1   utils,geom,base
+"""
+
+
+class CompactManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = Manifest.fromFile(StringIO(TEXT))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeCompact(self, manifest, name='manifest.bin'):
+        fn = os.path.join(self.tmpdir, name)
+        with open(fn, 'wb') as fp:
+            manifest.toCompactFile(fp)
+        return fn
+
+    def toText(self, manifest):
+        out = StringIO()
+        manifest.toFile(out)
+        return out.getvalue()
+
+    def testRoundTrip(self):
+        fn = self.writeCompact(self.manifest)
+        self.assertTrue(Manifest.isCompactFile(fn))
+        manifest = Manifest.fromCompactFile(fn)
+
+        self.assertEqual(manifest.buildID, 'b1234')
+        self.assertEqual(list(manifest.products), ['base', 'utils', 'geom', 'afw'])
+        self.assertEqual(self.toText(manifest), self.toText(self.manifest))
+        self.assertEqual(manifest.content_hash(), self.manifest.content_hash())
+
+        # dependencies are the manifest's own products
+        afw = manifest.products['afw']
+        self.assertEqual([dep.name for dep in afw.dependencies], ['utils', 'geom', 'base'])
+        self.assertIs(afw.dependencies[0], manifest.products['utils'])
+        self.assertEqual(manifest.products['base'].dependencies, [])
+        self.assertEqual(set(prod.name for prod in afw.flat_dependencies()), set(['utils', 'geom', 'base']))
+
+    def testNoBuildID(self):
+        fn = self.writeCompact(Manifest(self.manifest.products))
+        self.assertIsNone(Manifest.fromCompactFile(fn).buildID)
+
+    def testLoad(self):
+        textfn = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(textfn, 'w') as fp:
+            self.manifest.toFile(fp)
+        self.assertFalse(Manifest.isCompactFile(textfn))
+        with self.assertRaises(Exception):
+            Manifest.fromCompactFile(textfn)
+
+        for fn in (textfn, self.writeCompact(self.manifest)):
+            self.assertEqual(self.toText(Manifest.load(fn)), self.toText(self.manifest))
+
+    def testConvert(self):
+        textfn = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(textfn, 'w') as fp:
+            fp.write(TEXT)
+        compactfn = os.path.join(self.tmpdir, 'manifest.bin')
+        roundfn = os.path.join(self.tmpdir, 'roundtrip.txt')
+
+        Manifest.convert(argparse.Namespace(input=textfn, output=compactfn, compact=True))
+        Manifest.convert(argparse.Namespace(input=compactfn, output=roundfn, compact=False))
+        self.assertTrue(Manifest.isCompactFile(compactfn))
+        with open(roundfn) as fp:
+            self.assertEqual(fp.read(), self.toText(self.manifest))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Test the rebuild planner (`lsst-build plan`): which products of a new
+# manifest must be rebuilt relative to an old one, why, and at what cost.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Manifest                            # noqa: E402
+from lsst.ci.history import BuildHistory                        # noqa: E402
+from lsst.ci.plan import RebuildPlanner, formatDuration         # noqa: E402
+
+
+def manifest(text):
+    return Manifest.fromFile(StringIO(textwrap.dedent(text)))
+
+
+OLD = manifest("""\
+    BUILD=b1
+    base      aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa  1.0
+    utils     bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb  2.0+1   base
+    geom      cccccccccccccccccccccccccccccccccccccccc  3.0+1   base
+    afw       dddddddddddddddddddddddddddddddddddddddd  4.0+1   utils,geom
+    legacy    eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee  5.0     base
+    """)
+
+
+class RebuildPlannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testUnchanged(self):
+        self.assertEqual(RebuildPlanner(OLD, OLD).plan(), [])
+
+    def testReasons(self):
+        new = manifest("""\
+            BUILD=b2
+            base      aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa  1.0
+            utils     ffffffffffffffffffffffffffffffffffffffff  2.1+1   base
+            geom      cccccccccccccccccccccccccccccccccccccccc  3.0+1   base
+            afw       dddddddddddddddddddddddddddddddddddddddd  4.0+2   utils,geom
+            display   1111111111111111111111111111111111111111  1.0+1   afw
+            """)
+        plan = [(prod.name, reasons) for prod, reasons in RebuildPlanner(OLD, new).plan()]
+        self.assertEqual(plan, [
+            ('utils', ["own SHA1 changed (bbbbbbbbbb -> ffffffffff)"]),
+            ('afw', ["dependency version changed (utils)"]),
+            ('display', ["new product"]),
+        ])
+
+    def testDependenciesChanged(self):
+        new = manifest("""\
+            BUILD=b2
+            base      aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa  1.0
+            utils     bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb  2.0+1   base
+            geom      cccccccccccccccccccccccccccccccccccccccc  3.0+1   base
+            legacy    eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee  5.0     base
+            afw       dddddddddddddddddddddddddddddddddddddddd  4.0+3   utils,legacy
+            """)
+        (prod, reasons), = RebuildPlanner(OLD, new).plan()
+        self.assertEqual(prod.name, 'afw')
+        self.assertEqual(reasons, ["dependencies changed (+legacy, -geom)"])
+
+    def testVersionOnlyChanged(self):
+        new = manifest("""\
+            BUILD=b2
+            base      aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa  1.0.1
+            """)
+        self.assertEqual(RebuildPlanner(OLD, new).plan()[0][1], ["version changed (1.0 -> 1.0.1)"])
+
+    def testEstimateAndReport(self):
+        history = BuildHistory(os.path.join(self.tmpdir, 'history.txt'))
+        for seconds in (100, 5000, 110, 120):
+            history.record('utils', '2.0+1', seconds, 0)
+        history.record('utils', '2.0+1', 1, 1)     # failed builds don't count
+
+        new = manifest("""\
+            BUILD=b2
+            base      aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa  1.0
+            utils     ffffffffffffffffffffffffffffffffffffffff  2.1+1   base
+            display   1111111111111111111111111111111111111111  1.0+1   utils
+            """)
+        planner = RebuildPlanner(OLD, new, BuildHistory(history.fn))
+        self.assertEqual(planner.estimate(planner.plan()), (120., ['display']))
+
+        out = StringIO()
+        planner.report(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split()[:2], ['utils', '2m'])
+        self.assertEqual(lines[2].split()[:2], ['display', '?'])
+        self.assertIn('# removed: geom, afw, legacy', lines)
+        self.assertIn('# 2 of 3 products to rebuild; estimated build time: 2m 00s', lines)
+        self.assertIn('# (no build history for 1 products: display)', lines)
+
+    def testFormatDuration(self):
+        self.assertEqual(formatDuration(59.4), '59s')
+        self.assertEqual(formatDuration(61), '1m 01s')
+        self.assertEqual(formatDuration(7322), '2h 02m')
+
+
+if __name__ == "__main__":
+    unittest.main()
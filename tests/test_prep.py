@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Test that the preps run ahead of time by PrepStage are killed by their
+# watchdog, by a build that gives up waiting for them, and when the stage is
+# stopped (e.g., on interrupt).
+#
+# `eupspkg prep' is replaced by a script that hangs.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Product                             # noqa: E402
+from lsst.ci.build import Builder, BuildLimits, PrepStage       # noqa: E402
+
+
+class HangingBuilder(Builder):
+    def _eups_dir(self):
+        return None
+
+    def _prep_product(self, product, eupsdir, watchdog=None):
+        productdir = os.path.join(self.build_dir, product.name)
+        os.makedirs(productdir)
+        script = os.path.join(productdir, '_build.prep.sh')
+        with open(script, 'w') as fp:
+            fp.write('#!/bin/bash\nsleep 30\n')
+        os.chmod(script, 0o755)
+        logfile = os.path.join(productdir, '_build.prep.log')
+        with open(logfile, 'w') as logfp:
+            retcode = self._run_script(script, productdir, logfp, watchdog=watchdog)
+        return (productdir, retcode, logfile)
+
+
+class Progress(object):
+    def __init__(self):
+        self.notes = []
+
+    def reportProgress(self):
+        pass
+
+    def addNote(self, note):
+        self.notes.append(note)
+
+
+class PrepStageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        self.products = [Product('prod%d' % i, '0' * 40, '1.0', []) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+
+    def prepStage(self, limits=None, jobs=1):
+        builder = HangingBuilder(self.build_dir, None, None, None, limits=limits)
+        stage = PrepStage(builder, self.products, jobs)
+        stage.start()
+        return stage
+
+    def testStalledPrepIsKilled(self):
+        stage = self.prepStage(BuildLimits(stall_timeout=1))
+        t0 = time.time()
+        productdir, retcode, logfile = stage.wait(self.products[0], Progress())
+        self.assertLess(time.time() - t0, 10)
+        self.assertNotEqual(retcode, 0)
+        with open(logfile) as fp:
+            self.assertIn('killed after producing no output for 1 sec', fp.read())
+        stage.stop()
+
+    def testWaitTimeout(self):
+        stage = self.prepStage(jobs=1)
+        progress = Progress()
+
+        # the running prep is killed, and the pending ones are cancelled
+        t0 = time.time()
+        self.assertIsNone(stage.wait(self.products[0], progress, timeout=1))
+        self.assertIsNone(stage.wait(self.products[2], progress, timeout=1))
+        self.assertLess(time.time() - t0, 10)
+        self.assertEqual(progress.notes, ["prep killed after 1 sec"] * 2)
+        self.assertNotIn(self.products[2], stage.pending)
+        stage.stop()
+
+    def testStopKillsRunningPreps(self):
+        stage = self.prepStage(jobs=2)
+        time.sleep(1)
+        t0 = time.time()
+        stage.stop()
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(stage.watchdogs, {})
+        self.assertFalse(os.path.exists(os.path.join(self.build_dir, self.products[2].name)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Test that lsst-build gc removes the clones and worktrees of products that
+# are no longer in the manifest (archiving their logs under the version they
+# name), and leaves alone those being fetched by a concurrent prepare.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Manifest, Product, productLock      # noqa: E402
+from lsst.ci.logarchive import LogArchive                       # noqa: E402
+from lsst.ci.prune import GarbageCollector, logVersion          # noqa: E402
+
+
+class GarbageCollectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        for path in ('a', 'b', 'c', '_incremental/b'):
+            os.makedirs(os.path.join(self.build_dir, path, '.git'))
+        with open(os.path.join(self.build_dir, 'b', '_build.log'), 'w') as fp:
+            fp.write("[2026-01-01T00:00:00Z] + eupspkg PRODUCT=b VERSION=2.0 FLAVOR=generic config\n")
+
+        products = dict(a=Product('a', '0' * 40, '1.0', []))
+        self.manifest = Manifest.fromProductDict(products)
+        self.archive = LogArchive(os.path.join(self.tmpdir, 'archive'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.build_dir, path))
+
+    def testUnreferenced(self):
+        gc = GarbageCollector(self.build_dir, self.manifest)
+        self.assertEqual(gc.unreferenced(), [
+            ('b', [os.path.join(self.build_dir, '_incremental', 'b'), os.path.join(self.build_dir, 'b')]),
+            ('c', [os.path.join(self.build_dir, 'c')]),
+        ])
+
+    def testPrune(self):
+        out = StringIO()
+        gc = GarbageCollector(self.build_dir, self.manifest, self.archive, out=out)
+        with productLock(self.build_dir, 'c'):
+            gc.prune()
+
+        self.assertTrue(self.exists('a'))
+        self.assertFalse(self.exists('b'))
+        self.assertFalse(self.exists('_incremental/b'))
+        self.assertTrue(self.exists('c'))
+        self.assertIn("skipping c (being fetched)", out.getvalue())
+
+        # the log is archived under the version it was written for
+        self.assertEqual([line.split()[2:] for line in open(self.archive.indexfn)],
+                         [['b', '2.0', '_build.log']])
+
+    def testDryRun(self):
+        gc = GarbageCollector(self.build_dir, self.manifest, self.archive, dry_run=True, out=StringIO())
+        gc.prune()
+        for path in ('a', 'b', 'c', '_incremental/b'):
+            self.assertTrue(self.exists(path))
+        self.assertGreater(gc.freed, 0)
+
+    def testLogVersion(self):
+        logfile = os.path.join(self.build_dir, 'b', '_build.log')
+        self.assertEqual(logVersion(logfile, 'b'), '2.0')
+        self.assertIsNone(logVersion(logfile, 'a'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Test the registry of products being built into a stack: a product is built
+# by only one lsst-build process at a time, and the others wait for it.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Product                             # noqa: E402
+from lsst.ci.build import BuildRegistry                         # noqa: E402
+
+
+class Progress(object):
+    def __init__(self):
+        self.notes = []
+
+    def reportProgress(self):
+        pass
+
+    def addNote(self, note):
+        self.notes.append(note)
+
+
+class BuildRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lock_dir = os.path.join(self.tmpdir, 'locks')
+        self.products = [Product('prod%d' % i, '0' * 40, '1.0', []) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fork(self, target):
+        # run target() in a child process, exiting with 1 if it raises
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                target()
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        return pid
+
+    def testAcquireRelease(self):
+        registry = BuildRegistry(self.lock_dir, self.tmpdir)
+        product = self.products[0]
+        self.assertFalse(registry.busy(product))
+
+        progress = Progress()
+        claim, waited = registry.acquire(product, progress)
+        self.assertFalse(waited)
+        self.assertEqual(progress.notes, [])
+        self.assertTrue(registry.busy(product))
+
+        # other versions and SHA1s are claimed separately
+        self.assertFalse(registry.busy(Product(product.name, '0' * 40, '1.1', [])))
+        self.assertFalse(registry.busy(Product(product.name, '1' * 40, '1.0', [])))
+        self.assertFalse(registry.busy(self.products[1]))
+
+        registry.release(claim)
+        self.assertFalse(registry.busy(product))
+
+    def testConcurrentBuilds(self):
+        # several processes build the same products; each logs when it
+        # starts and ends building each, and the notes it got
+        nproc = 4
+        logfn = os.path.join(self.tmpdir, 'builds.log')
+        rfd, wfd = os.pipe()
+
+        def build(i):
+            os.close(wfd)
+            os.read(rfd, 1)
+            registry = BuildRegistry(self.lock_dir, os.path.join(self.tmpdir, 'build%d' % i))
+            for product in self.products:
+                progress = Progress()
+                claim, waited = registry.acquire(product, progress)
+                try:
+                    with open(logfn, 'a') as fp:
+                        fp.write('start %s %d\n' % (product.name, i))
+                    time.sleep(0.1)
+                    with open(logfn, 'a') as fp:
+                        fp.write('end %s %d\n' % (product.name, i))
+                        for note in progress.notes:
+                            fp.write('note %s %d %s\n' % (product.name, i, note))
+                finally:
+                    registry.release(claim)
+
+        pids = [self.fork(lambda: build(i)) for i in range(nproc)]
+        os.close(rfd)
+        os.close(wfd)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        with open(logfn) as fp:
+            lines = [line.split(None, 3) for line in fp]
+
+        # no product was being built by two processes at once
+        building = dict()
+        for line in lines:
+            event, name, i = line[:3]
+            if event == 'start':
+                self.assertNotIn(name, building, line)
+                building[name] = i
+            elif event == 'end':
+                self.assertEqual(building.pop(name), i)
+        for product in self.products:
+            starts = [line for line in lines if line[0] == 'start' and line[1] == product.name]
+            self.assertEqual(len(starts), nproc)
+
+        # those that waited were told whom they waited for
+        notes = [line[3] for line in lines if line[0] == 'note']
+        self.assertTrue(notes)
+        for note in notes:
+            self.assertRegexpMatches(note, r'^waited for pid \d+ on .*, building in .*/build\d\n$')
+
+    def testHolderKilled(self):
+        # the claim of a process that's killed is released
+        rfd, wfd = os.pipe()
+
+        def hold():
+            BuildRegistry(self.lock_dir, self.tmpdir).acquire(self.products[0], Progress())
+            os.write(wfd, b'x')
+            time.sleep(60)
+
+        pid = self.fork(hold)
+        os.read(rfd, 1)
+        os.close(rfd)
+        os.close(wfd)
+        registry = BuildRegistry(self.lock_dir, self.tmpdir)
+        self.assertTrue(registry.busy(self.products[0]))
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+        t0 = time.time()
+        claim, waited = registry.acquire(self.products[0], Progress())
+        self.assertLess(time.time() - t0, 5)
+        registry.release(claim)
+
+
+if __name__ == "__main__":
+    unittest.main()
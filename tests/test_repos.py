@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Test the compiled repos.yaml index: validation of the entries, and the
+# repos.index.json cache that saves re-parsing an unchanged repos.yaml.
+#
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+import lsst.ci.prepare as prepare                               # noqa: E402
+from lsst.ci.prepare import ReposIndex, ReposYamlError          # noqa: E402
+
+REPOS = {
+    'base': 'https://example.com/base.git',
+    'afw': {'url': 'https://example.com/afw.git', 'ref': 'main', 'lfs': True},
+    'testdata': {'url': 'https://example.com/testdata.git', 'clone_filter': 'blob:none', 'shallow': True},
+}
+
+
+def loadJson(data):
+    # like yaml.safe_load, return str (not unicode) strings on Python 2
+    def native(obj):
+        if isinstance(obj, dict):
+            return dict((native(key), native(value)) for key, value in obj.items())
+        if not isinstance(obj, (str, bool, int, type(None))):
+            return str(obj)
+        return obj
+    return native(json.loads(data.decode('utf-8')))
+
+
+class ReposIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'repos.yaml')
+        self.writeRepos(REPOS)
+
+        # count the parses of repos.yaml; JSON is a subset of YAML, so this
+        # also works where PyYAML isn't installed
+        self.parses = 0
+        self.safe_load = getattr(prepare.yaml, 'safe_load', loadJson)
+
+        def safe_load(data):
+            self.parses += 1
+            return self.safe_load(data)
+        prepare.yaml.safe_load = safe_load
+
+    def tearDown(self):
+        if self.safe_load is loadJson:
+            del prepare.yaml.safe_load
+        else:
+            prepare.yaml.safe_load = self.safe_load
+        shutil.rmtree(self.tmpdir)
+
+    def writeRepos(self, repos):
+        with open(self.fn, 'w') as fp:
+            json.dump(repos, fp, indent=2)
+
+    def assertSpecs(self, index):
+        self.assertEqual(len(index), 3)
+        self.assertIn('afw', index)
+        self.assertNotIn('geom', index)
+        self.assertIsNone(index.get('geom'))
+        self.assertEqual(dict((product, spec.toList()) for product, spec in index.specs.items()), {
+            'base': ['https://example.com/base.git', 'master', False, None, None],
+            'afw': ['https://example.com/afw.git', 'main', True, None, None],
+            'testdata': ['https://example.com/testdata.git', 'master', False, 'blob:none', True],
+        })
+
+    def testFromDict(self):
+        self.assertSpecs(ReposIndex.fromDict(REPOS))
+        self.assertEqual(len(ReposIndex.fromDict(None)), 0)
+
+    def testValidation(self):
+        repos = {
+            'ok': 'https://example.com/ok.git',
+            'number': 42,
+            'nourl': {'ref': 'main'},
+            'typo': {'url': 'https://example.com/typo.git', 'rfe': 'main'},
+            'badlfs': {'url': 'https://example.com/badlfs.git', 'lfs': 'yes'},
+        }
+        with self.assertRaises(ReposYamlError) as cm:
+            ReposIndex.fromDict(repos, 'repos.yaml')
+        self.assertEqual(cm.exception.fn, 'repos.yaml')
+        self.assertEqual(cm.exception.errors, [
+            ('badlfs', "invalid value 'yes' for key 'lfs'"),
+            ('nourl', "missing 'url'"),
+            ('number', "expected a URL or a map, got '42'"),
+            ('typo', "unknown key 'rfe'"),
+        ])
+        self.assertIn("  nourl: missing 'url'", str(cm.exception))
+
+        with self.assertRaises(ReposYamlError):
+            ReposIndex.fromDict(['https://example.com/ok.git'])
+
+    def testUncached(self):
+        self.assertSpecs(ReposIndex.fromFile(self.fn))
+        self.assertSpecs(ReposIndex.fromFile(self.fn))
+        self.assertEqual(self.parses, 2)
+
+    def testCached(self):
+        cachefn = os.path.join(self.tmpdir, 'repos.index.json')
+        self.assertSpecs(ReposIndex.fromFile(self.fn, self.tmpdir))
+        self.assertTrue(os.path.exists(cachefn))
+        self.assertSpecs(ReposIndex.fromFile(self.fn, self.tmpdir))
+        self.assertEqual(self.parses, 1)
+
+        # touched, but unchanged: the SHA1 still matches
+        st = os.stat(self.fn)
+        os.utime(self.fn, (st.st_atime, st.st_mtime + 10))
+        self.assertSpecs(ReposIndex.fromFile(self.fn, self.tmpdir))
+        self.assertEqual(self.parses, 1)
+
+        # changed
+        repos = dict(REPOS, geom='https://example.com/geom.git')
+        self.writeRepos(repos)
+        index = ReposIndex.fromFile(self.fn, self.tmpdir)
+        self.assertEqual(self.parses, 2)
+        self.assertEqual(index.get('geom').url, 'https://example.com/geom.git')
+
+        # a cache compiled from another repos.yaml isn't used
+        other = os.path.join(self.tmpdir, 'other.yaml')
+        shutil.copy(self.fn, other)
+        ReposIndex.fromFile(other, self.tmpdir)
+        self.assertEqual(self.parses, 3)
+
+        # nor is a corrupt one
+        with open(cachefn, 'w') as fp:
+            fp.write('{')
+        self.assertEqual(len(ReposIndex.fromFile(self.fn, self.tmpdir)), 4)
+        self.assertEqual(self.parses, 4)
+
+    def testCachedInvalid(self):
+        ReposIndex.fromFile(self.fn, self.tmpdir)
+        self.writeRepos(dict(REPOS, geom={'url': 'https://example.com/geom.git', 'lfs': 'no'}))
+        for _ in range(2):
+            with self.assertRaises(ReposYamlError):
+                ReposIndex.fromFile(self.fn, self.tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
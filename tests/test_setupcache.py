@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Test the cache of environments set up by the build scripts: its keys, and
+# that a cached environment is applied only where setup would give the same.
+#
+# setup is replaced by a shell function that logs its calls, and sets,
+# changes and unsets a variable each.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.prepare import Product                             # noqa: E402
+from lsst.ci.build import SetupCache                            # noqa: E402
+
+SETUP = """\
+setup() {
+    echo "setup $*" >> setup.log
+    export FOO_DIR="/stack/foo dir"
+    export PATH="/stack/foo/bin:$PATH"
+    unset BAR
+}
+"""
+
+REPORT = """\
+echo "FOO_DIR=${FOO_DIR-unset}" > result.txt
+echo "PATH=$PATH" >> result.txt
+echo "BAR=${BAR-unset}" >> result.txt
+"""
+
+
+class SetupCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.productdir = os.path.join(self.tmpdir, 'foo')
+        os.makedirs(os.path.join(self.productdir, 'ups'))
+        self.writeTable('setupRequired(base)\n')
+        self.cache = SetupCache(os.path.join(self.tmpdir, 'cache'))
+
+        self.oldEnv = dict(os.environ)
+        os.environ['EUPS_PATH'] = os.path.join(self.tmpdir, 'stack')
+        os.environ['BAR'] = 'bar'
+        os.environ.pop('FOO_DIR', None)
+
+        self.base = Product('base', 'a' * 40, '1.0', [])
+        self.product = Product('foo', 'b' * 40, '2.0', [self.base])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.oldEnv)
+        shutil.rmtree(self.tmpdir)
+
+    def writeTable(self, text):
+        with open(os.path.join(self.productdir, 'ups', 'foo.table'), 'w') as fp:
+            fp.write(text)
+
+    def runScript(self, key):
+        # run the setup part of a build script, returning the note for the
+        # progress report, whether setup ran, and the resulting environment
+        try:
+            os.remove(os.path.join(self.productdir, 'setup.log'))
+        except OSError:
+            pass
+        script = '\n'.join([SETUP] + self.cache.script(key) + [REPORT])
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['bash', '-c', script], cwd=self.productdir, stdout=devnull)
+
+        note = self.cache.collect(key, self.productdir)
+        ran = os.path.exists(os.path.join(self.productdir, 'setup.log'))
+        with open(os.path.join(self.productdir, 'result.txt')) as fp:
+            env = fp.read()
+        return note, ran, env
+
+    def testKey(self):
+        key = self.cache.key(self.product, self.productdir)
+        self.assertEqual(self.cache.key(self.product, self.productdir), key)
+
+        # a different version of an indirect dependency
+        util = Product('util', 'c' * 40, '3.0', [self.base])
+        util11 = Product('util', 'c' * 40, '3.0', [Product('base', 'a' * 40, '1.1', [])])
+        self.assertNotEqual(self.cache.key(Product('foo', 'b' * 40, '2.0', [util]), self.productdir),
+                            self.cache.key(Product('foo', 'b' * 40, '2.0', [util11]), self.productdir))
+
+        # a different table file, EUPS_PATH or directory
+        self.writeTable('setupRequired(base)\nsetupOptional(util)\n')
+        self.assertNotEqual(self.cache.key(self.product, self.productdir), key)
+        self.writeTable('setupRequired(base)\n')
+        os.environ['EUPS_PATH'] = os.path.join(self.tmpdir, 'other')
+        self.assertNotEqual(self.cache.key(self.product, self.productdir), key)
+        os.environ['EUPS_PATH'] = os.path.join(self.tmpdir, 'stack')
+        self.assertNotEqual(self.cache.key(self.product, self.tmpdir), key)
+        self.assertEqual(self.cache.key(self.product, self.productdir), key)
+
+    def testCachedEnvironment(self):
+        key = self.cache.key(self.product, self.productdir)
+        note, ran, env = self.runScript(key)
+        self.assertEqual(note, "setup env recorded")
+        self.assertTrue(ran)
+
+        # the environment setup gave, without running setup
+        note, ran, cachedEnv = self.runScript(key)
+        self.assertTrue(note.startswith("setup cached (saved "), note)
+        self.assertFalse(ran)
+        self.assertEqual(cachedEnv, env)
+        self.assertIn('FOO_DIR=/stack/foo dir\n', env)
+        self.assertIn('BAR=unset\n', env)
+        self.assertEqual(self.cache.hits, 1)
+
+    def testChangedEnvironment(self):
+        key = self.cache.key(self.product, self.productdir)
+        self.runScript(key)
+
+        # a variable setup changes has another value: setup runs again
+        os.environ['PATH'] = '/usr/local/bin:' + os.environ['PATH']
+        note, ran, env = self.runScript(key)
+        self.assertTrue(ran)
+        self.assertEqual(note, "setup env recorded")
+
+        # the entry was re-recorded; unrelated variables don't matter
+        os.environ['UNRELATED'] = 'x'
+        self.assertFalse(self.runScript(key)[1])
+        self.assertEqual(self.cache.hits, 1)
+
+        # a variable setup sets is already set: setup runs again
+        os.environ['FOO_DIR'] = '/elsewhere'
+        self.assertTrue(self.runScript(key)[1])
+
+    def testNoSetup(self):
+        # a build script that failed before setup leaves nothing to collect
+        self.assertIsNone(self.cache.collect(self.cache.key(self.product, self.productdir), self.productdir))
+
+
+if __name__ == "__main__":
+    unittest.main()
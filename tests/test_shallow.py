@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Test that shallow clones of branches are deepened until git describe (from
+# which pkgautoversion computes versions) sees HEAD as in a full clone.
+#
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.git import Git                                     # noqa: E402
+from lsst.ci.prepare import ProductFetcher                      # noqa: E402
+
+
+class ShallowFetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmpdir, 'origin')
+        os.makedirs(self.origin)
+        self.git = Git(self.origin)
+        self.git('-c', 'init.defaultBranch=master', 'init', '-q')
+        self.tree = self.git('hash-object', '-t', 'tree', '-w', '/dev/null')
+        self.count = 0
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        os.makedirs(self.build_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def commits(self, n, *parents):
+        # create a chain of n empty commits on top of parents, returning the last
+        for _ in range(n):
+            self.count += 1
+            args = ['commit-tree', self.tree, '-m', 'commit %d' % self.count]
+            for parent in parents:
+                args += ['-p', parent]
+            parents = [self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com', *args)]
+        return parents[0]
+
+    def fetchShallow(self):
+        self.git('update-ref', 'refs/heads/master', self.head)
+        fetcher = ProductFetcher(self.build_dir, None, 'file://' + self.origin, [], False, shallow=True)
+        self.assertEqual(fetcher.fetch('prod'), ('master', self.head))
+
+        clone = Git(os.path.join(self.build_dir, 'prod'))
+        self.assertEqual(clone.describe('--tags', 'HEAD'), self.git.describe('--tags', self.head))
+        return clone
+
+    def testTagBeyondFirstStep(self):
+        tagged = self.commits(5)
+        self.git.tag('v1', tagged)
+        self.head = self.commits(50, tagged)
+
+        clone = self.fetchShallow()
+        self.assertEqual(clone.describe('--tags', '--abbrev=0', 'HEAD'), 'v1')
+
+    def testMergeBeyondShallowBoundary(self):
+        # a branch forked long before the tag, and merged after it: at the
+        # depth at which the tag is first reached, describe counts only part
+        # of the branch's commits
+        fork = self.commits(5)
+        tagged = self.commits(100, fork)
+        self.git.tag('v1', tagged)
+        master = self.commits(10, tagged)
+        branch = self.commits(50, fork)
+        self.head = self.commits(1, master, branch)
+
+        self.fetchShallow()
+
+
+if __name__ == "__main__":
+    unittest.main()
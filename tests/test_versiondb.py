@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Test the git-backed version database: commits made with git plumbing, and
+# several prepares assigning +N suffixes and build IDs at the same time.
+#
+from __future__ import print_function
+
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from lsst.ci.git import Git                                     # noqa: E402
+from lsst.ci.prepare import Manifest, Product, VersionDbGit     # noqa: E402
+
+
+class FakeEups(object):
+    class Tags(object):
+        def getTagNames(self):
+            return ['b2']
+
+    def __init__(self):
+        self.tags = FakeEups.Tags()
+
+
+# the dependency sets of the product versioned in the tests
+DEPSETS = [
+    [Product('base', 'a' * 40, '1.0', [])],
+    [Product('base', 'a' * 40, '1.1', [])],
+    [Product('base', 'a' * 40, '1.0', []), Product('utils', 'b' * 40, '2.0', [])],
+    [Product('base', 'a' * 40, '1.1', []), Product('utils', 'b' * 40, '2.0', [])],
+]
+
+
+class VersionDbGitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbdir = os.path.join(self.tmpdir, 'versiondb')
+        os.makedirs(self.dbdir)
+        self.git = Git(self.dbdir)
+        self.git('init', '-q')
+        self.git('config', 'user.name', 'test')
+        self.git('config', 'user.email', 'test@example.com')
+        for d in ('ver_db', 'dep_db', 'manifests'):
+            os.makedirs(os.path.join(self.dbdir, d))
+            open(os.path.join(self.dbdir, d, '.gitignore'), 'w').close()
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'Empty versiondb')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def prepare(self, depsets, extra=None):
+        # assign versions to afw built against each of depsets, and commit the manifest
+        versionDb = VersionDbGit(self.dbdir, FakeEups())
+        products = [Product('afw', 'c' * 40, '3.0+' + versionDb.getSuffix('afw', '3.0', DEPSETS[i]), [])
+                    for i in depsets]
+        if extra is not None:
+            products.append(Product(extra, 'd' * 40, '1.0', []))
+        manifest = Manifest(collections.OrderedDict((str(i), prod) for i, prod in enumerate(products)))
+        versionDb.commit(manifest, None)
+        return [prod.version for prod in products], manifest.buildID
+
+    def committed(self, path):
+        return self.git('show', 'HEAD:' + path).splitlines()
+
+    def testCommit(self):
+        with open(os.path.join(self.dbdir, 'untracked.txt'), 'w') as fp:
+            fp.write('not to be committed\n')
+
+        self.assertEqual(self.prepare([0, 1]), (['3.0+', '3.0+1'], 'b1'))
+        self.assertEqual(self.git('describe', '--tags', 'HEAD'), 'b1')
+        changed = self.git('diff-tree', '--no-commit-id', '--name-only', '-r', 'HEAD').split()
+        self.assertEqual(sorted(changed), ['dep_db/afw.txt', 'manifests/b1.txt',
+                                           'manifests/content_sha.db.txt', 'ver_db/afw.txt'])
+        self.assertEqual(self.git('status', '--porcelain'), '?? untracked.txt')
+        self.assertEqual(len(self.committed('ver_db/afw.txt')), 2)
+        self.assertEqual(self.committed('dep_db/afw.txt'),
+                         ['3.0\t0\tbase\t1.0', '3.0\t1\tbase\t1.1'])
+
+        # the same dependencies get the same suffix, and the same manifest the
+        # same build ID, without a new commit; b2 is taken by an EUPS tag
+        head = self.git.rev_parse('HEAD')
+        self.assertEqual(self.prepare([0, 1]), (['3.0+', '3.0+1'], 'b1'))
+        self.assertEqual(self.git.rev_parse('HEAD'), head)
+        self.assertEqual(self.prepare([1, 2]), (['3.0+1', '3.0+2'], 'b3'))
+        self.assertEqual(self.git('rev-list', '--count', 'HEAD'), '3')
+        self.assertEqual(len(self.committed('ver_db/afw.txt')), 3)
+
+    def testConcurrentPrepares(self):
+        # start all prepares at once, each assigning suffixes to two
+        # dependency sets shared with other prepares, and committing a
+        # manifest of its own
+        nproc = 8
+        rfd, wfd = os.pipe()
+        pids = []
+        for i in range(nproc):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    os.close(wfd)
+                    os.read(rfd, 1)
+                    versions, buildID = self.prepare([i % 4, (i + 1) % 4], extra='proc%d' % i)
+                    with open(os.path.join(self.tmpdir, 'result.%d' % i), 'w') as fp:
+                        json.dump({'versions': versions, 'build': buildID}, fp)
+                    status = 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        os.close(rfd)
+        os.close(wfd)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        suffixes = dict()
+        builds = set()
+        for i in range(nproc):
+            with open(os.path.join(self.tmpdir, 'result.%d' % i)) as fp:
+                result = json.load(fp)
+            for depset, version in zip([i % 4, (i + 1) % 4], result['versions']):
+                suffixes.setdefault(depset, set()).add(version)
+            builds.add(result['build'])
+
+        # each dependency set got one suffix, and each a different one
+        self.assertEqual(len(suffixes), 4)
+        self.assertTrue(all(len(versions) == 1 for versions in suffixes.values()))
+        self.assertEqual(len(set(versions.pop() for versions in suffixes.values())), 4)
+
+        # each prepare got a build ID of its own, and committed on top of the others
+        self.assertEqual(builds, set(['b1', 'b3', 'b4', 'b5', 'b6', 'b7', 'b8', 'b9']))
+        self.assertEqual(sorted(self.git.tag('-l').split()), sorted(builds))
+        self.assertEqual(self.git('rev-list', '--count', 'HEAD'), str(1 + nproc))
+        self.assertEqual(len(self.committed('ver_db/afw.txt')), 4)
+        self.assertEqual(len(self.committed('manifests/content_sha.db.txt')), nproc)
+        self.assertEqual(self.git('status', '--porcelain'), '')
+
+
+if __name__ == "__main__":
+    unittest.main()